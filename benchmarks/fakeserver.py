@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the qBittorrent WebUI API, serving synthetic torrents.
+
+Implements the endpoints qbtools uses: auth, app, torrents/info, files,
+trackers, categories, tags, reannounce, delete, sync/maindata and the transfer
+limits. Every request is counted per endpoint in `FakeQbittorrent.calls`.
+sync/maindata keeps its rid per session, so a new process gets a full update
+first and deltas of the changed fields after it.
+
+Usage:
+    python benchmarks/fakeserver.py --torrents 10000 --port 8080
+"""
+
+import os
+import json
+import time
+import random
+import secrets
+import argparse
+import threading
+import collections
+
+from urllib.parse import parse_qs, urlsplit
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STATES = [
+    ("uploading", 30),
+    ("stalledUP", 40),
+    ("stoppedUP", 10),
+    ("downloading", 5),
+    ("stalledDL", 10),
+    ("queuedDL", 5),
+]
+
+FILTERS = {
+    "downloading": {"downloading", "stalledDL", "queuedDL", "metaDL", "forcedDL"},
+    "seeding": {"uploading", "stalledUP", "forcedUP"},
+    "completed": {"uploading", "stalledUP", "stoppedUP", "queuedUP", "forcedUP"},
+    "stopped": {"stoppedUP", "stoppedDL"},
+    "paused": {"stoppedUP", "stoppedDL"},
+    "active": {"uploading", "downloading", "forcedUP", "forcedDL"},
+    "stalled": {"stalledUP", "stalledDL"},
+    "stalled_uploading": {"stalledUP"},
+    "stalled_downloading": {"stalledDL"},
+}
+
+NO_CONTENT = {"auth/logout", "torrents/createTags", "torrents/reannounce"}
+
+# Pseudo trackers qBittorrent lists first, with a negative tier
+PSEUDO_TRACKERS = [
+    dict(url="** [DHT] **", status=2, tier=-1, msg=""),
+    dict(url="** [PeX] **", status=2, tier=-1, msg=""),
+    dict(url="** [LSD] **", status=2, tier=-1, msg=""),
+]
+
+
+class FakeQbittorrent:
+    """
+    In-memory qBittorrent instance with deterministic synthetic torrents
+
+    About 5% of the torrents are unregistered, 2% have a tracker down, 3% share
+    their content with another torrent and 10% are tagged `expired`.
+    """
+
+    def __init__(
+        self, torrents=1000, categories=4, files=3, sites=5, root="/downloads", seed=0
+    ):
+        rng = random.Random(seed)
+        now = int(time.time())
+
+        self.root = root
+        # One registered domain per site, as the `trackers` configuration expects
+        self.sites = [f"site{i}.org" for i in range(sites)]
+        self.categories = {
+            f"category{i}": dict(name=f"category{i}", savePath=f"{root}/category{i}")
+            for i in range(categories)
+        }
+        self.torrents = {}
+        self.trackers = {}
+        self.files = {}
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        # SID -> state of the sync/maindata session, qBittorrent keeps it per session
+        self.sessions = {}
+        self.download_limit = 0
+
+        states, weights = zip(*STATES)
+        for i in range(torrents):
+            torrent_hash = f"{rng.getrandbits(160):040x}"
+            category = f"category{i % categories}"
+            save_path = self.categories[category]["savePath"]
+            name = f"Torrent.{i}.2160p.WEB-DL"
+            content_path = f"{save_path}/{name}"
+            if i and rng.random() < 0.03:
+                # Cross-seeded content of an earlier torrent
+                other = self.torrents[rng.choice(list(self.torrents))]
+                category, save_path = other["category"], other["save_path"]
+                content_path = other["content_path"]
+            folder = os.path.basename(content_path)
+
+            state = rng.choices(states, weights)[0]
+            site = rng.choice(self.sites)
+            roll = rng.random()
+            if roll < 0.05:
+                status, msg = 4, "Unregistered torrent"
+            elif roll < 0.07:
+                status, msg = 4, "Tracker is down for maintenance"
+            else:
+                status, msg = 2, ""
+
+            added_on = now - rng.randrange(365 * 86400)
+            self.torrents[torrent_hash] = dict(
+                hash=torrent_hash,
+                name=name,
+                category=category,
+                tags="expired" if rng.random() < 0.1 else "",
+                content_path=content_path,
+                save_path=save_path,
+                added_on=added_on,
+                completion_on=added_on + 600,
+                last_activity=now - rng.randrange(30 * 86400),
+                ratio=rng.random() * 5,
+                seeding_time=rng.randrange(now - added_on + 1),
+                time_active=rng.randrange(7200),
+                size=files * 2**30,
+                progress=0.5 if state.endswith("DL") else 1,
+                state=state,
+                num_seeds=rng.randrange(3) if state != "stalledDL" else 0,
+                num_leechs=rng.randrange(3) if state != "stalledDL" else 0,
+                num_complete=rng.randrange(50),
+                trackers_count=1,
+                tracker=f"https://tracker.{site}/announce" if status == 2 else "",
+                dlspeed=0,
+                upspeed=0,
+            )
+            self.trackers[torrent_hash] = PSEUDO_TRACKERS + [
+                dict(
+                    url=f"https://tracker.{site}/announce",
+                    status=status,
+                    tier=0,
+                    msg=msg,
+                )
+            ]
+            self.files[torrent_hash] = [
+                dict(index=j, name=f"{folder}/{folder}.part{j}.mkv", size=2**30)
+                for j in range(files)
+            ]
+
+    def tags(self):
+        return sorted(
+            {tag for t in self.torrents.values() for tag in split_tags(t["tags"])}
+        )
+
+    def torrents_info(self, params):
+        hashes = set(params["hashes"].split("|")) if params.get("hashes") else None
+        states = FILTERS.get(params.get("filter", "all"))
+        torrents = []
+        for torrent_hash, t in self.torrents.items():
+            if hashes is not None and torrent_hash not in hashes:
+                continue
+            if "category" in params and t["category"] != params["category"]:
+                continue
+            if "tag" in params and params["tag"] not in split_tags(t["tags"]):
+                continue
+            if states is not None and t["state"] not in states:
+                continue
+            if params.get("includeTrackers", "").lower() == "true":
+                t = dict(t, trackers=self.trackers[torrent_hash])
+            torrents.append(t)
+
+        if params.get("sort"):
+            torrents.sort(
+                key=lambda t: t.get(params["sort"]) or 0,
+                reverse=params.get("reverse") == "true",
+            )
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 0)) or len(torrents)
+        return torrents[offset : offset + limit]
+
+    def maindata(self, params, sid=None):
+        """
+        Full update for an unknown rid, otherwise the changes since the state last
+        sent to the session, like qBittorrent
+        """
+        current = dict(
+            torrents={
+                h: {k: v for k, v in t.items() if k != "hash"}
+                for h, t in self.torrents.items()
+            },
+            categories={name: dict(c) for name, c in self.categories.items()},
+            tags=self.tags(),
+            server_state=dict(
+                dl_info_speed=0, dl_rate_limit=self.download_limit, up_info_speed=0
+            ),
+        )
+        session = self.sessions.get(sid)
+        rid = int(params.get("rid", 0))
+        if not session or not rid or rid != session["rid"]:
+            rid = (session["rid"] if session else 0) + 1
+            self.sessions[sid] = dict(rid=rid, sent=current)
+            return dict(rid=rid, full_update=True, **current)
+
+        sent = session["sent"]
+        rid = session["rid"] + 1
+        self.sessions[sid] = dict(rid=rid, sent=current)
+        data = dict(rid=rid)
+        torrents = {
+            h: {k: v for k, v in t.items() if sent["torrents"].get(h, {}).get(k) != v}
+            for h, t in current["torrents"].items()
+        }
+        torrents = {h: delta for h, delta in torrents.items() if delta}
+        removed = sorted(sent["torrents"].keys() - current["torrents"].keys())
+        categories = {
+            name: c
+            for name, c in current["categories"].items()
+            if sent["categories"].get(name) != c
+        }
+        categories_removed = sorted(
+            sent["categories"].keys() - current["categories"].keys()
+        )
+        server_state = {
+            k: v
+            for k, v in current["server_state"].items()
+            if sent["server_state"].get(k) != v
+        }
+        for key, value in (
+            ("torrents", torrents),
+            ("torrents_removed", removed),
+            ("categories", categories),
+            ("categories_removed", categories_removed),
+            ("tags", sorted(set(current["tags"]) - set(sent["tags"]))),
+            ("tags_removed", sorted(set(sent["tags"]) - set(current["tags"]))),
+            ("server_state", server_state),
+        ):
+            if value:
+                data[key] = value
+        return data
+
+    def churn(self, fraction=0.01, seed=1):
+        """
+        Change some torrents like a running instance does between two runs: their
+        activity, a few states and tracker counts, and remove a few torrents
+        :return: number of torrents changed or removed
+        """
+        rng = random.Random(seed)
+        now = int(time.time())
+        states = [state for state, _ in STATES]
+        hashes = rng.sample(sorted(self.torrents), int(len(self.torrents) * fraction))
+        for torrent_hash in hashes:
+            t = self.torrents[torrent_hash]
+            roll = rng.random()
+            if roll < 0.1:
+                del self.torrents[torrent_hash]
+                continue
+            t["ratio"] += rng.random()
+            t["seeding_time"] += 3600
+            t["last_activity"] = now
+            if roll < 0.3:
+                t["state"] = rng.choice(states)
+            elif roll < 0.4:
+                t["num_complete"] += 1
+        return len(hashes)
+
+    def change_tags(self, params, add):
+        tags = set(params["tags"].split(","))
+        for torrent_hash in params["hashes"].split("|"):
+            t = self.torrents.get(torrent_hash)
+            if t:
+                current = split_tags(t["tags"])
+                current = current | tags if add else current - tags
+                t["tags"] = ", ".join(sorted(current))
+
+    def handle(self, endpoint, params, sid=None):
+        """
+        :return: (status, body) of the response
+        """
+        with self.lock:
+            self.calls[endpoint] += 1
+            if endpoint == "auth/login":
+                return 200, "Ok."
+            if endpoint in NO_CONTENT:
+                return 200, ""
+            if endpoint == "app/version":
+                return 200, "v5.1.0"
+            if endpoint == "app/webapiVersion":
+                return 200, "2.11.4"
+            if endpoint == "app/preferences":
+                return 200, dict(save_path=self.root)
+            if endpoint == "torrents/categories":
+                return 200, self.categories
+            if endpoint == "torrents/tags":
+                return 200, self.tags()
+            if endpoint == "torrents/info":
+                return 200, self.torrents_info(params)
+            if endpoint == "torrents/files":
+                if params.get("hash") not in self.files:
+                    return 404, "Torrent hash was not found"
+                return 200, self.files[params["hash"]]
+            if endpoint == "torrents/trackers":
+                if params.get("hash") not in self.trackers:
+                    return 404, "Torrent hash was not found"
+                return 200, self.trackers[params["hash"]]
+            if endpoint in ("torrents/addTags", "torrents/removeTags"):
+                self.change_tags(params, endpoint == "torrents/addTags")
+                return 200, ""
+            if endpoint == "torrents/deleteTags":
+                return 200, ""
+            if endpoint == "torrents/delete":
+                for torrent_hash in params["hashes"].split("|"):
+                    self.torrents.pop(torrent_hash, None)
+                return 200, ""
+            if endpoint == "sync/maindata":
+                return 200, self.maindata(params, sid)
+            if endpoint == "transfer/downloadLimit":
+                return 200, str(self.download_limit)
+            if endpoint == "transfer/setDownloadLimit":
+                self.download_limit = int(params.get("limit", 0))
+                return 200, ""
+            return 404, "Not Found"
+
+    def make_tree(self, orphans=0.1, seed=0):
+        """
+        Create the files of every torrent below `root`, plus orphaned files
+        :param orphans: fraction of the torrents getting orphaned files
+        :return: number of orphaned files created
+        """
+        rng = random.Random(seed)
+        created = 0
+        for torrent_hash, t in self.torrents.items():
+            for f in self.files[torrent_hash]:
+                touch(os.path.join(t["save_path"], f["name"]))
+            if rng.random() < orphans:
+                touch(os.path.join(t["content_path"], "sample.mkv"))
+                touch(os.path.join(t["save_path"], f"{t['name']}.orphan", "a.mkv"))
+                created += 2
+        return created
+
+
+def split_tags(tags):
+    return {tag.strip() for tag in tags.split(",") if tag.strip()}
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a"):
+        pass
+
+
+def make_handler(qbittorrent):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.respond()
+
+        def do_POST(self):
+            self.respond()
+
+        def respond(self):
+            url = urlsplit(self.path)
+            params = parse_qs(url.query, keep_blank_values=True)
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                body = self.rfile.read(length).decode()
+                params.update(parse_qs(body, keep_blank_values=True))
+            params = {k: v[0] for k, v in params.items()}
+
+            endpoint = url.path.split("/api/v2/", 1)[-1]
+            # Every login starts a new session, with its own sync/maindata rid
+            if endpoint == "auth/login":
+                sid = secrets.token_hex(16)
+            else:
+                cookie = SimpleCookie(self.headers.get("Cookie", ""))
+                sid = cookie["SID"].value if "SID" in cookie else None
+            status, body = qbittorrent.handle(endpoint, params, sid)
+            if not isinstance(body, str):
+                body = json.dumps(body)
+            body = body.encode()
+
+            self.send_response(status)
+            if endpoint == "auth/login":
+                self.send_header("Set-Cookie", f"SID={sid}; HttpOnly; path=/")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(qbittorrent, host="127.0.0.1", port=0):
+    server = ThreadingHTTPServer((host, port), make_handler(qbittorrent))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--torrents", type=int, default=1000)
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--files", type=int, default=3)
+    parser.add_argument("--sites", type=int, default=5)
+    parser.add_argument("--root", default="/downloads")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    qbittorrent = FakeQbittorrent(
+        args.torrents, args.categories, args.files, args.sites, args.root
+    )
+    server = serve(qbittorrent, args.host, args.port)
+    print(f"Serving {args.torrents} torrents on http://{args.host}:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(dict(qbittorrent.calls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of the rules engine of the tagging command.
+
+Evaluates generated rules over synthetic torrent records with the vectorised
+evaluator, in batches like the tagging command, and with a per-torrent interpreter
+of the same rules, which is only run up to --interpreted-max torrents. The tags
+of both are compared.
+
+The vectorised evaluator is timed cold, compiling the rules and evaluating them
+once with empty caches like a single tagging run, and warm, as the fastest of
+--repeat further evaluations like the later runs of the daemon.
+
+Usage:
+    python benchmarks/rules.py --sizes 10000 100000 --rules 50
+"""
+
+import gc
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "qbtools"))
+
+from fakeserver import FakeQbittorrent  # noqa: E402
+from commands import tagging  # noqa: E402
+from qbtools import columns, records, rules, utils  # noqa: E402
+
+
+def synthetic_records(count, sites):
+    qbittorrent = FakeQbittorrent(count, sites=sites)
+    record = records.record_type(tuple(tagging.FIELDS))
+    return qbittorrent, [
+        record(dict(t, trackers=qbittorrent.trackers[h]))
+        for h, t in qbittorrent.torrents.items()
+    ]
+
+
+def synthetic_rules(count, qbittorrent, seed=0):
+    rng = random.Random(seed)
+    names = [site.split(".")[0] for site in qbittorrent.sites]
+
+    def predicate():
+        return rng.choice(
+            [
+                lambda: {"ratio": {">=": round(rng.uniform(0, 5), 2)}},
+                lambda: {"seeding_days": {">": rng.randrange(60)}},
+                lambda: {"added_days": {"<=": rng.randrange(365)}},
+                lambda: {"activity_days": {">": rng.randrange(30)}},
+                lambda: {"category": rng.sample(list(qbittorrent.categories), 2)},
+                lambda: {"site": rng.choice(names)},
+                lambda: {"state": {"in": ["stalledUP", "uploading"]}},
+                lambda: {"message": {"contains": "unregistered"}},
+                lambda: {"working": rng.random() < 0.5},
+                lambda: {"tags": {"contains": "expired"}},
+                lambda: {"content_path": {"matches": r"\.[0-9]*7\."}},
+            ]
+        )()
+
+    def condition(depth=0):
+        roll = rng.random()
+        if depth < 2 and roll < 0.4:
+            key = rng.choice(["all", "any"])
+            return {key: [condition(depth + 1) for _ in range(rng.randrange(2, 4))]}
+        if depth < 2 and roll < 0.5:
+            return {"not": condition(depth + 1)}
+        return predicate()
+
+    return [dict(tag=f"rule:{i}", when=condition()) for i in range(count)]
+
+
+def interpret(condition, t, site, now):
+    """Per-torrent reference evaluation of a condition"""
+    results = []
+    for key, value in condition.items():
+        if key == "all":
+            results.append(all(interpret(c, t, site, now) for c in value))
+        elif key == "any":
+            results.append(any(interpret(c, t, site, now) for c in value))
+        elif key == "not":
+            results.append(not interpret(value, t, site, now))
+        else:
+            if not isinstance(value, dict):
+                value = {"in": value} if isinstance(value, list) else {"==": value}
+            results.extend(
+                check(field_value(key, t, site, now), op, v) for op, v in value.items()
+            )
+    return all(results)
+
+
+def field_value(field, t, site, now):
+    trackers = [s for s in records.trackers(t) if s.tier >= 0]
+    if field == "site":
+        return site(t.tracker or (trackers[0].url if trackers else "")) or ""
+    if field == "message":
+        return "\n".join(s.msg for s in trackers if s.msg)
+    if field == "working":
+        return any(s.status == 2 for s in trackers)
+    if field == "seeding_days":
+        return t.seeding_time / 86400
+    if field == "added_days":
+        return (now - t.added_on) / 86400
+    if field == "activity_days":
+        return (now - t.last_activity) / 86400
+    if field == "tags":
+        return {tag.lower() for tag in utils.split_tags(t.tags)}
+    return t[field]
+
+
+def check(actual, op, value):
+    if op == "contains" and isinstance(actual, set):
+        return str(value).lower() in actual
+    if op == "contains":
+        return str(value).lower() in actual.lower()
+    if op == "matches":
+        return re.search(value, actual, re.IGNORECASE) is not None
+    if op == "in":
+        return actual in value
+    return {
+        "==": actual == value,
+        "!=": actual != value,
+        "<": actual < value,
+        "<=": actual <= value,
+        ">": actual > value,
+        ">=": actual >= value,
+    }[op]
+
+
+def vectorised(ruleset, torrents, site, now):
+    # Hashes are gathered in lists like the tagging command does
+    tags = collections.defaultdict(list)
+    for batch in utils.batches(torrents, tagging.BATCH_SIZE):
+        batch_columns = columns.Columns(batch, site, now)
+        for tag, hashes in ruleset.evaluate(batch_columns).items():
+            tags[tag].extend(hashes)
+    return tags
+
+
+def compiled(config, torrents, site, now):
+    """Compile the rules and evaluate them once"""
+    ruleset = rules.RuleSet(config)
+    return ruleset, vectorised(ruleset, torrents, site, now)
+
+
+def interpreted(config, torrents, site, now):
+    tags = collections.defaultdict(set)
+    for t in torrents:
+        for rule in config:
+            if interpret(rule["when"], t, site, now):
+                tags[rule["tag"]].add(t.hash)
+    return tags
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rules engine micro-benchmark")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000])
+    parser.add_argument("--rules", type=int, default=50)
+    parser.add_argument("--sites", type=int, default=20)
+    parser.add_argument("--interpreted-max", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    app = parser.parse_args()
+
+    now = time.time()
+    print(
+        f"{'torrents':>10} {'interpreted':>12} {'cold':>10} {'warm':>10} "
+        f"{'speedup':>10}"
+    )
+    for size in app.sizes:
+        qbittorrent, torrents = synthetic_records(size, app.sites)
+        config = synthetic_rules(app.rules, qbittorrent)
+        # The tagging command streams the torrents, keep the garbage collector from
+        # scanning all of them while measuring
+        gc.freeze()
+        names = {
+            f"https://tracker.{s}/announce": s.split(".")[0] for s in qbittorrent.sites
+        }
+        site = names.get
+
+        columns.shared_tracker_fields.cache_clear()
+        cold_time, (ruleset, vectorised_result) = measure(
+            compiled, config, torrents, site, now
+        )
+        warm_time = min(
+            measure(vectorised, ruleset, torrents, site, now)[0]
+            for _ in range(app.repeat)
+        )
+
+        if size <= app.interpreted_max:
+            interpreted_time, interpreted_result = measure(
+                interpreted, config, torrents, site, now
+            )
+            matched = {
+                tag: set(hashes) for tag, hashes in vectorised_result.items() if hashes
+            }
+            if interpreted_result != matched:
+                print(f"warning: results differ at {size} torrents")
+            print(
+                f"{size:>10} {interpreted_time:>11.3f}s {cold_time:>9.3f}s "
+                f"{warm_time:>9.3f}s {interpreted_time / cold_time:>9.1f}x"
+            )
+        else:
+            print(
+                f"{size:>10} {'skipped':>12} {cold_time:>9.3f}s {warm_time:>9.3f}s "
+                f"{'-':>10}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""
+End to end benchmark of the commands against a local fake qBittorrent WebUI.
+
+Every command runs in its own process against a fresh synthetic instance served by
+`fakeserver.py`, the orphaned command against a synthetic download tree. The wall
+time, the API calls per endpoint and the peak RSS of each run are reported.
+Looping commands (reannounce, limiter) run a single pass. The incremental tagging
+scenario is measured on a second run, after 1% of the torrents changed.
+
+Usage:
+    python benchmarks/suite.py --torrents 1000 10000
+    python benchmarks/suite.py --commands tagging prune --state-db --json out.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import yaml
+
+from fakeserver import FakeQbittorrent, serve
+
+QBTOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "qbtools")
+
+TAGGING = [
+    "tagging",
+    "--added-on",
+    "--duplicates",
+    "--expired",
+    "--last-activity",
+    "--not-working",
+    "--sites",
+    "--unregistered",
+    "--link-cache-file={tmp}/links.json",
+    "--domain-cache-file={tmp}/domains.json",
+]
+
+SCENARIOS = {
+    "tagging": TAGGING,
+    "tagging-incremental": [
+        *TAGGING,
+        "--incremental",
+        "--state-file={tmp}/tagging-state.json",
+    ],
+    "prune": [
+        "prune",
+        "--include-tag=expired",
+        "--include-category=category0",
+        "--dry-run",
+    ],
+    "orphaned": [
+        "orphaned",
+        "--dry-run",
+        "--files-cache-file={tmp}/files.json",
+        "--scan-state-file={tmp}/scan.json",
+        "--journal-file={tmp}/journal.jsonl",
+    ],
+    "reannounce": ["reannounce"],
+}
+
+# Scenarios measured on a second run, after a first run and some changes to the
+# torrents, so the sync/maindata deltas of a new session are exercised
+SECOND_RUN = {"tagging-incremental"}
+
+
+def write_config(path, qbittorrent):
+    config = dict(
+        trackers=[
+            dict(
+                name=site.split(".")[0],
+                urls=[site],
+                required_seed_ratio=1.0,
+                required_seed_days=7,
+            )
+            for site in qbittorrent.sites
+        ],
+        tracker_messages=dict(unregistered=["unregistered torrent"]),
+    )
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+
+
+def run_command(argv, log_file):
+    """
+    Run qbtools in a child process
+    :return: (wall time in seconds, peak RSS in bytes, exit status)
+    """
+    started = time.perf_counter()
+    with open(log_file, "w") as log:
+        process = subprocess.Popen(
+            [sys.executable, __file__, "--child", *argv],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        # wait4 reaps the child and reports its own resource usage
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - started
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, usage.ru_maxrss * 1024, process.returncode
+
+
+def benchmark(command, torrents, app):
+    with tempfile.TemporaryDirectory(prefix="qbtools-bench-") as tmp:
+        root = os.path.join(tmp, "downloads")
+        qbittorrent = FakeQbittorrent(
+            torrents, app.categories, app.files, app.sites, root
+        )
+        if command == "orphaned":
+            qbittorrent.make_tree()
+
+        server = serve(qbittorrent)
+        try:
+            write_config(os.path.join(tmp, "config.yaml"), qbittorrent)
+            argv = [arg.format(tmp=tmp) for arg in SCENARIOS[command]]
+            argv += [
+                f"--config={tmp}/config.yaml",
+                "--server=127.0.0.1",
+                f"--port={server.server_address[1]}",
+            ]
+            if app.state_db:
+                argv.append(f"--state-db={tmp}/state.db")
+
+            log_file = os.path.join(tmp, "output.log")
+            if command in SECOND_RUN:
+                run_command(argv, log_file)
+                qbittorrent.churn()
+                qbittorrent.calls.clear()
+            elapsed, rss, status = run_command(argv, log_file)
+            if status:
+                with open(log_file) as f:
+                    sys.stderr.write(f.read()[-4000:])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    return dict(
+        command=command,
+        torrents=torrents,
+        seconds=round(elapsed, 3),
+        peak_rss=rss,
+        calls=dict(sorted(qbittorrent.calls.items())),
+        status=status,
+    )
+
+
+def child(argv):
+    """Run one pass of a command in this process, like `qbtools.py <argv>`"""
+    import importlib
+
+    sys.path.insert(0, QBTOOLS)
+    sys.argv = [os.path.join(QBTOOLS, "qbtools.py"), *argv]
+
+    import qbtools
+
+    mod = importlib.import_module(f"commands.{qbtools.selected_command(argv)}")
+    if hasattr(mod, "run"):
+        mod.__init__ = mod.run
+    qbtools.main()
+
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        return child(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description="qbtools command benchmarks")
+    parser.add_argument("--torrents", nargs="+", type=int, default=[1000, 10000])
+    parser.add_argument(
+        "--commands", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS)
+    )
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--files", type=int, default=3)
+    parser.add_argument("--sites", type=int, default=5)
+    parser.add_argument(
+        "--state-db",
+        action="store_true",
+        help="Run the commands with a fresh SQLite state store",
+    )
+    parser.add_argument("--json", help="Also write the results to this file")
+    app = parser.parse_args()
+
+    sys.path.insert(0, QBTOOLS)
+    from qbtools import utils
+
+    results = []
+    print(
+        f"{'command':<20} {'torrents':>10} {'time':>10} {'peak rss':>12} {'calls':>8}"
+    )
+    for torrents in app.torrents:
+        for command in app.commands:
+            result = benchmark(command, torrents, app)
+            results.append(result)
+            calls = ", ".join(f"{k}={v}" for k, v in result["calls"].items())
+            print(
+                f"{command:<20} {torrents:>10} {result['seconds']:>9.3f}s "
+                f"{utils.format_bytes(result['peak_rss']):>12} "
+                f"{sum(result['calls'].values()):>8}  {calls}"
+                + (f"  (exit status {result['status']})" if result["status"] else "")
+            )
+
+    if app.json:
+        with open(app.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return 1 if any(result["status"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of the tag diff and duplicate detection in the tagging command.
+
+Compares the previous list based implementation with the set based indexes on
+synthetic torrents. The list based implementation is quadratic, so it is only
+run up to --legacy-max torrents.
+
+Usage:
+    python benchmarks/tagging.py --sizes 1000 10000 100000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import collections
+
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "qbtools"))
+
+from commands import tagging  # noqa: E402
+from qbtools import utils  # noqa: E402
+
+TAGS = ["added:1d", "added:7d", "added:30d", "site:a", "site:b", "expired", "dupe"]
+
+
+def synthetic_torrents(count, seed=0):
+    rng = random.Random(seed)
+    torrents = []
+    for i in range(count):
+        content_path = f"/downloads/{rng.randrange(count // 2 or 1)}"
+        torrents.append(
+            SimpleNamespace(
+                hash=f"{i:040x}",
+                tags=", ".join(rng.sample(TAGS, rng.randrange(3))),
+                content_path=content_path,
+                save_path="/downloads",
+            )
+        )
+    desired = {
+        t.hash: rng.sample([x for x in TAGS if x != "dupe"], 2) for t in torrents
+    }
+    return torrents, desired
+
+
+def legacy(torrents, desired):
+    tags = collections.defaultdict(list)
+    paths = []
+    for t in torrents:
+        tags_to_add = list(desired[t.hash])
+        if t.content_path in paths and not t.content_path == t.save_path:
+            tags_to_add.append("dupe")
+        else:
+            paths.append(t.content_path)
+        for tag in tags_to_add:
+            tags[tag].append(t)
+
+    changes = {}
+    for tag, tagged in sorted(tags.items()):
+        old_hashes = [t.hash for t in torrents if tag in t.tags and not t in tagged]
+        new_hashes = [t.hash for t in tagged if not tag in t.tags]
+        changes[tag] = (len(new_hashes), len(old_hashes))
+    return changes
+
+
+def indexed(torrents, desired):
+    current = {t.hash: utils.split_tags(t.tags) for t in torrents}
+    tags = collections.defaultdict(set)
+    for t in torrents:
+        for tag in desired[t.hash]:
+            tags[tag].add(t.hash)
+    tags["dupe"].update(tagging.find_duplicates(torrents))
+
+    additions, removals = tagging.diff_tags(current, tags)
+    return {tag: (len(additions[tag]), len(removals[tag])) for tag in sorted(tags)}
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tagging diff micro-benchmark")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--legacy-max", type=int, default=10000)
+    app = parser.parse_args()
+
+    print(f"{'torrents':>10} {'legacy':>12} {'indexed':>12} {'speedup':>10}")
+    for size in app.sizes:
+        torrents, desired = synthetic_torrents(size)
+        indexed_time, indexed_result = measure(indexed, torrents, desired)
+
+        if size <= app.legacy_max:
+            legacy_time, legacy_result = measure(legacy, torrents, desired)
+            if legacy_result != indexed_result:
+                print(f"warning: results differ at {size} torrents")
+            print(
+                f"{size:>10} {legacy_time:>11.3f}s {indexed_time:>11.3f}s "
+                f"{legacy_time / indexed_time:>9.1f}x"
+            )
+        else:
+            print(f"{size:>10} {'skipped':>12} {indexed_time:>11.3f}s {'-':>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import time
+import asyncio
+import contextlib
+import metrics
+import records
+
+
+class AsyncClient:
+    """
+    qBittorrent WebUI client built on httpx.AsyncClient
+
+    Requests share one pool of keep-alive connections and are optionally limited to
+    `concurrency` requests in flight. They are sent in the WebUI session of the
+    synchronous `client`, which is logged in again when qBittorrent rejects it, so a
+    command only ever holds one session. Torrents are returned as `TorrentDictionary`
+    bound to `client`, so commands can use them the same way.
+    """
+
+    def __init__(self, host, client, pool_size=10, concurrency=None):
+        # Imported here, commands only load it when they talk to qBittorrent
+        import httpx
+
+        if "://" not in host:
+            host = f"http://{host}"
+        self.client = client
+        self.http = httpx.AsyncClient(
+            base_url=f"{host.rstrip('/')}/api/v2/",
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+            timeout=httpx.Timeout(60.0),
+        )
+        self.semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        self.cookies = None
+
+    def authenticate(self, expired=None):
+        """
+        Send the session cookies of the synchronous client with the next requests
+        :param expired: cookies qBittorrent rejected, the client logs in again unless
+            another request already did
+        """
+        if expired is not None and expired == self.cookies:
+            self.client.auth_log_in()
+        cookies = session_cookies(self.client)
+        if cookies != self.cookies:
+            self.http.cookies.clear()
+            self.http.cookies.update(cookies)
+            self.cookies = cookies
+
+    async def request(self, method, endpoint, **kwargs):
+        async with self.semaphore or contextlib.nullcontext():
+            self.authenticate()
+            cookies = self.cookies
+            response = await self.send(method, endpoint, **kwargs)
+            if response.status_code == 403:
+                # The session expired, log in again and retry once
+                self.authenticate(expired=cookies)
+                response = await self.send(method, endpoint, **kwargs)
+        response.raise_for_status()
+        return response
+
+    async def stream(self, method, endpoint, **kwargs):
+        """
+        Like `request`, yielding the response body in chunks as it arrives
+        """
+        async with self.semaphore or contextlib.nullcontext():
+            self.authenticate()
+            for attempt in range(2):
+                cookies = self.cookies
+                started = time.perf_counter()
+                received = 0
+                async with self.http.stream(method, endpoint, **kwargs) as response:
+                    try:
+                        if response.status_code != 403 or attempt:
+                            response.raise_for_status()
+                            async for chunk in response.aiter_bytes():
+                                received += len(chunk)
+                                yield chunk
+                            return
+                    finally:
+                        metrics.observe_request(
+                            "qbittorrent",
+                            endpoint,
+                            method,
+                            response.status_code,
+                            time.perf_counter() - started,
+                            len(response.request.content),
+                            received,
+                        )
+                # The session expired, log in again and retry once
+                self.authenticate(expired=cookies)
+
+    async def send(self, method, endpoint, **kwargs):
+        started = time.perf_counter()
+        response = await self.http.request(method, endpoint, **kwargs)
+        metrics.observe_request(
+            "qbittorrent",
+            endpoint,
+            method,
+            response.status_code,
+            time.perf_counter() - started,
+            len(response.request.content),
+            len(response.content),
+        )
+        return response
+
+    async def app_preferences(self):
+        return (await self.request("GET", "app/preferences")).json()
+
+    async def torrents_categories(self):
+        return (await self.request("GET", "torrents/categories")).json()
+
+    async def torrents_info(self, **params):
+        import qbittorrentapi
+
+        response = await self.request("POST", "torrents/info", data=params)
+        return [
+            qbittorrentapi.TorrentDictionary(data, client=self.client)
+            for data in response.json()
+        ]
+
+    async def torrents_stream(self, fields, **params):
+        """
+        Decode `torrents/info` incrementally into compact records
+        :param fields: fields to keep in the records
+        :return: async generator of lists of records, one per received chunk
+        """
+        record = records.record_type(tuple(fields))
+        decoder = records.ArrayDecoder()
+        async for chunk in self.stream("POST", "torrents/info", data=params):
+            batch = [record(data) for data in decoder.feed(chunk)]
+            if batch:
+                yield batch
+        batch = [record(data) for data in decoder.feed(b"", final=True)]
+        if batch:
+            yield batch
+
+    async def torrents_files(self, torrent_hash):
+        response = await self.request(
+            "POST", "torrents/files", data=dict(hash=torrent_hash)
+        )
+        return response.json()
+
+    async def torrents_reannounce(self, torrent_hashes):
+        await self.request(
+            "POST", "torrents/reannounce", data=dict(hashes="|".join(torrent_hashes))
+        )
+
+    async def torrents_delete(self, torrent_hashes, delete_files=False):
+        await self.request(
+            "POST",
+            "torrents/delete",
+            data=dict(
+                hashes="|".join(torrent_hashes),
+                deleteFiles=str(bool(delete_files)).lower(),
+            ),
+        )
+
+    async def aclose(self):
+        # The session belongs to the synchronous client, which logs out
+        await self.http.aclose()
+
+
+def session_cookies(client):
+    """
+    :return: cookies of the WebUI session of a `qbittorrentapi.Client`, the name of
+        the session cookie is configurable in qBittorrent
+    """
+    http = getattr(client, "_http_session", None)
+    return {cookie.name: cookie.value for cookie in http.cookies} if http else {}
+
+
+class Session:
+    """
+    Event loop and async client kept for the lifetime of a command
+    """
+
+    def __init__(self, app):
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncClient(
+            f"{app.server}:{app.port}",
+            app.client,
+            pool_size=app.pool_size,
+            concurrency=app.concurrency,
+        )
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def iterate(self, batches, timer=None):
+        """
+        Consume an async generator of batches from synchronous code
+        :param timer: `metrics.Timer` the time spent waiting for batches is counted
+            in as its `fetch` phase, whatever phase consumes the items
+        :return: generator of the items of every batch
+        """
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    batch = self.run(anext(batches))
+                except StopAsyncIteration:
+                    return
+                finally:
+                    if timer:
+                        timer.credit("fetch", time.perf_counter() - started)
+                yield from batch
+        finally:
+            self.run(batches.aclose())
+
+    def close(self):
+        try:
+            self.run(self.client.aclose())
+        finally:
+            self.loop.close()
+
+
+def session(app):
+    if not app.aio:
+        app.aio = Session(app)
+    return app.aio
@@ -0,0 +1,52 @@
+import re
+import collections
+
+
+class MessageClassifier:
+    """
+    Classify tracker messages by the substrings they contain
+
+    The patterns of every category are compiled into one case-insensitive regex,
+    searched on its own so categories matching at the same position are all found,
+    and the categories of every distinct message are memoized, since most torrents
+    share a handful of messages. `hits` counts how many classified items matched each category.
+    """
+
+    def __init__(self, patterns):
+        """
+        :param patterns: category -> list of substrings, in priority order
+        """
+        self.regexes = [
+            (category, re.compile("|".join(map(re.escape, substrings)), re.IGNORECASE))
+            for category, substrings in patterns.items()
+            if substrings
+        ]
+        self.memo = {}
+        self.hits = collections.Counter()
+
+    def classify(self, message):
+        """
+        :return: set of categories the message matches
+        """
+        if message in self.memo:
+            return self.memo[message]
+
+        categories = frozenset(
+            category
+            for category, regex in self.regexes
+            if message and regex.search(message)
+        )
+        self.memo[message] = categories
+        return categories
+
+    def match(self, messages, count=1):
+        """
+        Classify all messages of one item and count its hits
+        :param count: number of items sharing these messages
+        :return: set of categories any of the messages matches
+        """
+        categories = set()
+        for message in messages:
+            categories.update(self.classify(message))
+        self.hits.update(dict.fromkeys(categories, count))
+        return categories
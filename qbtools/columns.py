@@ -0,0 +1,214 @@
+import time
+import operator
+import functools
+import itertools
+import numpy as np
+import records
+import utils
+
+from qbittorrentapi import TorrentState, TrackerStatus
+
+WORKING = TrackerStatus.WORKING.value
+
+TIMESTAMP_FIELDS = {"added_on", "last_activity"}
+
+# Ages in whole days are bucketed with `np.digitize`, a torrent added in the future
+# falls in the first bucket and is labelled like one added this week
+DATE_BINS = [0, 1, 8, 31, 181]
+DATE_LABELS = ["7d", "1d", "7d", "30d", "180d", ">180d"]
+
+
+class Columns:
+    """
+    Columnar view of a batch of torrents
+
+    A column is only extracted, into a NumPy array, when it is first read. Text
+    columns are factorized into codes and distinct values, so work on text runs
+    once per distinct value instead of once per torrent. `results` memoizes
+    derived masks for the predicates of the rules.
+    """
+
+    def __init__(self, torrents, site, now=None):
+        """
+        :param torrents: records or `TorrentDictionary` of the batch
+        :param site: announce URL -> name of the tracker site, or None
+        :param now: timestamp the ages are relative to
+        """
+        self.torrents = torrents
+        self.size = len(torrents)
+        self.site = site
+        self.now = time.time() if now is None else now
+        self.columns = {}
+        self.results = {}
+
+    @property
+    def hashes(self):
+        if "hash" not in self.columns:
+            self.columns["hash"] = np.array(self.values("hash"), dtype=object)
+        return self.columns["hash"]
+
+    def trackers(self):
+        """
+        :return: field -> values of the site, message and working fields, read in a
+            single pass over the trackers, leaving out DHT, PeX and LSD
+        """
+        if "trackers" not in self.columns:
+            torrents = self.torrents
+            if torrents and isinstance(torrents[0], records.Record):
+                # Records share their tracker tuples, the fields are read once per
+                # distinct tuple
+                rows = list(
+                    map(
+                        shared_tracker_fields,
+                        map(operator.attrgetter("tracker"), torrents),
+                        map(operator.attrgetter("trackers"), torrents),
+                    )
+                )
+            else:
+                rows = [
+                    tracker_fields(t.tracker, records.trackers(t)) for t in torrents
+                ]
+            urls, messages, working = zip(*rows) if rows else ((), (), ())
+            sites = {url: self.site(url) or "" for url in set(urls)}
+            self.columns["trackers"] = dict(
+                site=list(map(sites.__getitem__, urls)),
+                message=messages,
+                working=working,
+            )
+        return self.columns["trackers"]
+
+    def values(self, field):
+        """
+        :return: the raw values of a field, one per torrent
+        """
+        if field in ("site", "message", "working"):
+            return self.trackers()[field]
+        return list(map(operator.attrgetter(field), self.torrents))
+
+    def numeric(self, field):
+        if field not in self.columns:
+            # Missing values become NaN
+            self.columns[field] = np.array(self.values(field), dtype=np.float64)
+        return self.columns[field]
+
+    def days(self, field):
+        """
+        :return: age in days of a timestamp field, or a duration field in days
+        """
+        key = f"{field}:days"
+        if key not in self.columns:
+            column = self.numeric(field)
+            if field in TIMESTAMP_FIELDS:
+                column = self.now - column
+            self.columns[key] = column / 86400
+        return self.columns[key]
+
+    def text(self, field):
+        """
+        :return: (codes, distinct values) of a text column
+        """
+        if field not in self.columns:
+            values = self.values(field)
+            index = dict(zip(dict.fromkeys(values), itertools.count()))
+            codes = np.fromiter(
+                map(index.__getitem__, values), dtype=np.intp, count=self.size
+            )
+            self.columns[field] = codes, [v or "" for v in index]
+        return self.columns[field]
+
+    def boolean(self, field):
+        if field not in self.columns:
+            self.columns[field] = np.fromiter(
+                self.values(field), dtype=bool, count=self.size
+            )
+        return self.columns[field]
+
+    def complete(self):
+        """
+        :return: mask of the torrents in a complete state
+        """
+        codes, states = self.text("state")
+        return np.array([is_complete(s) for s in states], dtype=bool)[codes]
+
+    def select(self, mask):
+        """
+        :return: hashes of the torrents in `mask`
+        """
+        return self.hashes[mask].tolist()
+
+    def group(self, codes, labels):
+        """
+        :param codes: index into `labels` of every torrent, labels may repeat
+        :return: label -> hashes of the torrents with that label, None is left out
+        """
+        order = np.argsort(codes, kind="stable")
+        bounds = np.cumsum(np.bincount(codes, minlength=len(labels)))[:-1]
+        groups = {}
+        for label, indices in zip(labels, np.split(order, bounds)):
+            if label is not None and len(indices):
+                groups.setdefault(label, []).extend(self.hashes[indices].tolist())
+        return groups
+
+
+def tracker_fields(url, trackers):
+    """
+    :param url: current announce URL of the torrent, empty when it has none
+    :param trackers: trackers of the torrent, None when unknown
+    :return: (announce URL, messages, working) of the trackers, leaving out DHT,
+        PeX and LSD
+    """
+    texts = []
+    up = False
+    for s in trackers or ():
+        if s.tier < 0:
+            continue
+        url = url or s.url
+        if s.msg:
+            texts.append(s.msg)
+        if s.status == WORKING:
+            up = True
+    return url or "", "\n".join(texts), up
+
+
+shared_tracker_fields = functools.lru_cache(maxsize=4096)(tracker_fields)
+
+
+def is_complete(state):
+    try:
+        return TorrentState(state).is_complete
+    except ValueError:
+        return False
+
+
+def date_buckets(columns, field):
+    """
+    :return: index into `DATE_LABELS` of the age of every torrent
+    """
+    return np.digitize(np.floor(columns.days(field)), DATE_BINS)
+
+
+def expired(columns, trackers):
+    """
+    :param trackers: site name -> configuration of the tracker
+    :return: mask of the complete torrents that reached the required seed ratio or
+        seed days of their site
+    """
+    codes, sites = columns.text("site")
+    required = [trackers.get(site) or {} for site in sites]
+    ratios = np.array(
+        [tracker.get("required_seed_ratio") or np.inf for tracker in required]
+    )
+    seconds = np.array(
+        [
+            (
+                utils.seconds(tracker["required_seed_days"])
+                if tracker.get("required_seed_days")
+                else np.inf
+            )
+            for tracker in required
+        ]
+    )
+    return columns.complete() & (
+        (columns.numeric("ratio") >= ratios[codes])
+        | (columns.numeric("seeding_time") >= seconds[codes])
+    )
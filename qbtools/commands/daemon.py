@@ -0,0 +1,121 @@
+import time
+import argparse
+import importlib
+
+from qbtools import asyncclient, metrics, snapshot
+
+DEFAULT_INTERVALS = {
+    "limiter": 5,
+    "orphaned": 86400,
+    "prune": 3600,
+    "reannounce": 5,
+    "tagging": 3600,
+}
+
+
+class Job:
+    def __init__(self, command, mod, app, interval):
+        self.command = command
+        self.mod = mod
+        self.app = app
+        self.interval = interval
+        self.next_run = 0
+
+    def run(self, logger):
+        """
+        :return: seconds until the next run
+        """
+        timer = metrics.Timer("daemon")
+        timer.phase(self.command)
+
+        # Looping commands expose a single pass as `run`, which may return the delay
+        # until their next pass, like the adaptive reannounce passes
+        delay = None
+        if hasattr(self.mod, "run"):
+            delay = self.mod.run(self.app, logger)
+        else:
+            self.mod.__init__(self.app, logger)
+
+        timer.stop()
+        return self.interval if delay is None else delay
+
+
+def __init__(app, logger):
+    logger.info("Starting daemon process...")
+
+    if not app.snapshot:
+        app.snapshot = snapshot.Snapshot()
+    jobs = load_jobs(app)
+    if not jobs:
+        logger.error("No jobs configured in the daemon section of the configuration")
+        return
+
+    for job in jobs:
+        logger.info(f"Scheduled {job.command} every {job.interval}s")
+
+    while True:
+        now = time.monotonic()
+        due = [job for job in jobs if job.next_run <= now]
+
+        if due:
+            try:
+                changed = app.snapshot.update(app.client)
+            except Exception as e:
+                logger.error(f"Error syncing torrents: {e}")
+                time.sleep(app.retry_interval)
+                continue
+
+            logger.debug(
+                f"Synced {len(changed)} changed torrents of {len(app.snapshot)}"
+            )
+
+            for job in due:
+                delay = job.interval
+                try:
+                    delay = job.run(logger)
+                except Exception:
+                    logger.error(f"Error executing job: {job.command}", exc_info=True)
+                job.next_run = time.monotonic() + delay
+
+        time.sleep(max(0, min(job.next_run for job in jobs) - time.monotonic()))
+
+
+def load_jobs(app):
+    jobs = []
+    for command, options in (app.config.get("daemon") or {}).items():
+        if command not in DEFAULT_INTERVALS:
+            raise ValueError(f"Unsupported daemon job: {command}")
+
+        options = options or {}
+        mod = importlib.import_module(f"commands.{command}")
+
+        # Each job gets its own namespace parsed from the configured arguments
+        parser = argparse.ArgumentParser(prog=f"qbtools.py daemon {command}")
+        mod.add_arguments(command, parser.add_subparsers(dest="command"))
+        job_app = parser.parse_args([command, *options.get("args", [])])
+        job_app.client = app.client
+        job_app.config = app.config
+        job_app.snapshot = app.snapshot
+        job_app.store = app.store
+        job_app.aio = asyncclient.session(app)
+
+        interval = options.get("interval", DEFAULT_INTERVALS[command])
+        jobs.append(Job(command, mod, job_app, interval))
+
+    return jobs
+
+
+def add_arguments(command, subparser):
+    """
+    Description:
+        Keep one session and one torrent snapshot and run the commands configured in the daemon section of config.yaml on their own intervals.
+    Usage:
+        qbtools.py daemon --help
+    """
+    parser = subparser.add_parser(command)
+    parser.add_argument(
+        "--retry-interval",
+        type=int,
+        default=5,
+        help="The interval to retry syncing with qBittorrent in seconds after an error",
+    )
@@ -2,18 +2,91 @@ import time
 import httpx
 
 from httpx import URL
-from qbtools import utils
+from qbtools import metrics, snapshot, utils
+from qbittorrentapi import TorrentState
 from typing import Optional, Tuple
 
+DOWNLOADING_STATES = {s.value for s in TorrentState if s.is_downloading}
+
+# The state store is synced without tracker lists, the limiter never reads them
+TRACKERS = False
+
+
+class Controller:
+    """
+    Hysteresis and smoothing of the limiter decisions
+
+    Whether both clients are downloading only changes once the change held for
+    `hold` seconds, and the throughput share of qBittorrent is averaged
+    exponentially, so brief gaps between downloads do not flap the limits.
+    """
+
+    def __init__(self, hold, smoothing):
+        self.hold = hold
+        self.smoothing = smoothing
+        self.both = None
+        self.pending = None
+        self.since = None
+        self.share = 0.5
+
+    def both_downloading(self, both, now):
+        if self.both is None:
+            self.both = both
+        if both == self.both:
+            self.pending = None
+            return self.both
+
+        if self.pending != both:
+            self.pending, self.since = both, now
+        if now - self.since >= self.hold:
+            self.both, self.pending = both, None
+        return self.both
+
+    def weigh(self, qbittorrent, sabnzbd):
+        """
+        :param qbittorrent: demand of qBittorrent in bytes/s
+        :param sabnzbd: demand of SABnzbd in bytes/s
+        :return: smoothed share of the line for qBittorrent
+        """
+        if qbittorrent + sabnzbd:
+            target = qbittorrent / (qbittorrent + sabnzbd)
+            self.share += self.smoothing * (target - self.share)
+        return self.share
+
 
 def __init__(app, logger):
     logger.info("Starting limiter process...")
 
+    # Counting the downloading torrents from sync deltas is far cheaper than listing them
+    if not app.snapshot:
+        app.snapshot = snapshot.Snapshot()
+
+    try:
+        while True:
+            # A pass is skipped when the sync fails, like when qBittorrent restarts
+            try:
+                app.snapshot.update(app.client, trackers=False)
+            except Exception as e:
+                logger.error(e)
+            else:
+                run(app, logger)
+            time.sleep(app.interval)
+    finally:
+        if vars(app).get("sabnzbd"):
+            app.sabnzbd.close()
+
+
+def run(app, logger):
     app.sabnzbd_host = parse_sabnzbd_host(app)
+    controller = vars(app).setdefault("controller", Controller(app.hold, app.smoothing))
 
     def process():
-        qbittorrent_queue, qbittorrent_current_limit = qbittorrent_data(app)
-        sabnzbd_queue, sabnzbd_current_limit = sabnzbd_data(app)
+        timer = metrics.Timer("limiter")
+        timer.phase("fetch")
+        qbittorrent_queue, qbittorrent_current_limit, qbittorrent_speed = (
+            qbittorrent_data(app)
+        )
+        sabnzbd_queue, sabnzbd_current_limit, sabnzbd_speed = sabnzbd_data(app)
 
         qbittorrent_current_limit = int(qbittorrent_current_limit / 1024 / 1024)
         sabnzbd_current_limit = int(sabnzbd_current_limit / 1024 / 1024)
@@ -25,44 +98,73 @@ def __init__(app, logger):
             f"SabNZBD: {sabnzbd_queue} item(s) @ max {sabnzbd_current_limit} MB/s"
         )
 
-        percentage = (
-            app.limit_percent
-            if qbittorrent_queue and sabnzbd_queue
-            else app.max_percent
+        timer.phase("evaluate")
+        both = controller.both_downloading(
+            bool(qbittorrent_queue and sabnzbd_queue), time.monotonic()
         )
 
-        limit = int(app.max_line_speed_mbps * percentage)
+        if not both:
+            qbittorrent_percentage = sabnzbd_percentage = app.max_percent
+        elif app.share == "throughput":
+            share = controller.weigh(
+                demand(qbittorrent_speed, qbittorrent_current_limit),
+                demand(sabnzbd_speed, sabnzbd_current_limit),
+            )
+            # Shares move in steps and neither side is starved
+            share = round(share / app.share_step) * app.share_step
+            share = min(max(share, app.min_share), 1 - app.min_share)
+            qbittorrent_percentage = app.max_percent * share
+            sabnzbd_percentage = app.max_percent * (1 - share)
+        else:
+            qbittorrent_percentage = sabnzbd_percentage = app.limit_percent
+
+        qbittorrent_limit = int(app.max_line_speed_mbps * qbittorrent_percentage)
+        sabnzbd_limit = int(app.max_line_speed_mbps * sabnzbd_percentage)
+
+        timer.phase("mutate")
 
-        if qbittorrent_current_limit != limit:
-            app.client.transfer_set_download_limit(limit * 1024 * 1024)
+        if qbittorrent_current_limit != qbittorrent_limit:
+            app.client.transfer_set_download_limit(qbittorrent_limit * 1024 * 1024)
             logger.info(
-                f"qbittorrent download limit set to {limit} MB/s "
+                f"qbittorrent download limit set to {qbittorrent_limit} MB/s "
                 f"(was {qbittorrent_current_limit} MB/s)..."
             )
 
-        if sabnzbd_current_limit != limit:
+        if sabnzbd_current_limit != sabnzbd_limit:
             handle_request(
+                app,
                 url=f"{app.sabnzbd_host}/api",
                 method="POST",
                 data=dict(
                     apikey=app.sabnzbd_apikey,
                     mode="config",
                     name="speedlimit",
-                    value=int(percentage * 100),
+                    value=round(sabnzbd_percentage * 100),
                 ),
             )
             logger.info(
-                f"sabnzbd download limit set to {limit} MB/s "
+                f"sabnzbd download limit set to {sabnzbd_limit} MB/s "
                 f"(was {sabnzbd_current_limit} MB/s)..."
             )
 
-    while True:
-        try:
-            process()
-        except Exception as e:
-            logger.error(e)
+        timer.stop()
+
+    try:
+        process()
+    except Exception as e:
+        logger.error(e)
 
-        time.sleep(app.interval)
+
+def demand(speed, limit):
+    """
+    Estimate the bandwidth a client wants from its measured speed
+    :param speed: measured speed in bytes/s
+    :param limit: current limit in MB/s, 0 when unlimited
+    """
+    # A client running at its limit may want more, let its share grow
+    if limit and speed >= 0.9 * limit * 1024 * 1024:
+        return speed * 1.25
+    return speed
 
 
 def parse_sabnzbd_host(app) -> str:
@@ -76,26 +178,61 @@ def parse_sabnzbd_host(app) -> str:
     return url
 
 
-def qbittorrent_data(app) -> Tuple[int, int]:
-    torrents = len(app.client.torrents.info(status_filter="downloading"))
-    download_limit = app.client.transfer_download_limit()
-    return torrents, download_limit
+def qbittorrent_data(app) -> Tuple[int, int, int]:
+    if app.snapshot:
+        torrents = app.snapshot.count(DOWNLOADING_STATES)
+        server_state = app.snapshot.server_state
+    else:
+        torrents = len(app.client.torrents.info(status_filter="downloading"))
+        server_state = {}
+
+    download_limit = server_state.get("dl_rate_limit")
+    if download_limit is None:
+        download_limit = app.client.transfer_download_limit()
+    return torrents, download_limit, server_state.get("dl_info_speed", 0)
 
 
-def sabnzbd_data(app) -> Tuple[int, int]:
+def sabnzbd_data(app) -> Tuple[int, int, int]:
     data = handle_request(
-        f"{app.sabnzbd_host}/api?apikey={app.sabnzbd_apikey}&mode=queue&output=json"
+        app,
+        f"{app.sabnzbd_host}/api?apikey={app.sabnzbd_apikey}&mode=queue&output=json",
     )
+    queue = data.get("queue", {}) if data else {}
     return (
-        int(data.get("queue", {}).get("noofslots", 0)) if data else 0,
-        int(data.get("queue", {}).get("speedlimit_abs", 0)) if data else 0,
+        int(queue.get("noofslots", 0)),
+        int(queue.get("speedlimit_abs", 0) or 0),
+        int(float(queue.get("kbpersec", 0) or 0) * 1024),
     )
 
 
+def sabnzbd_client(app) -> httpx.Client:
+    # Keep the connection alive between polls instead of reconnecting every time
+    if not vars(app).get("sabnzbd"):
+        app.sabnzbd = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=1,
+                max_keepalive_connections=1,
+                keepalive_expiry=max(30, app.interval * 2),
+            ),
+            timeout=10,
+        )
+    return app.sabnzbd
+
+
 def handle_request(
-    url: str, method: str = "GET", data: Optional[dict] = None
+    app, url: str, method: str = "GET", data: Optional[dict] = None
 ) -> Optional[dict]:
-    response = httpx.request(method=method, url=url, data=data)
+    started = time.perf_counter()
+    response = sabnzbd_client(app).request(method=method, url=url, data=data)
+    metrics.observe_request(
+        "sabnzbd",
+        response.url.params.get("mode") or (data or {}).get("mode", ""),
+        method,
+        response.status_code,
+        time.perf_counter() - started,
+        len(response.request.content),
+        len(response.content),
+    )
     response.raise_for_status()
     return response.json() if method == "GET" else None
 
@@ -153,3 +290,33 @@ def add_arguments(command, subparser):
         default=5,
         help="The interval to check the speeds in seconds",
     )
+    parser.add_argument(
+        "--hold",
+        type=int,
+        default=15,
+        help="The time in seconds a change of the queues must hold before the limits change",
+    )
+    parser.add_argument(
+        "--share",
+        choices=["fixed", "throughput"],
+        default="fixed",
+        help="Share the line by --limit-percent or by the measured throughput of each side when both are downloading",
+    )
+    parser.add_argument(
+        "--smoothing",
+        type=float,
+        default=0.3,
+        help="The weight of the latest measurement in the averaged throughput share",
+    )
+    parser.add_argument(
+        "--share-step",
+        type=float,
+        default=0.05,
+        help="The step the throughput share is rounded to",
+    )
+    parser.add_argument(
+        "--min-share",
+        type=float,
+        default=0.1,
+        help="The minimum share of the line speed each side keeps in throughput mode",
+    )
@@ -1,80 +1,305 @@
 import os
-import shutil
 
 from fnmatch import fnmatch
+from qbtools import asyncclient, deleter, filelists, journal, metrics, scanstate
+
+# Marks trie nodes of paths owned by qBittorrent, never a valid path component
+OWNED = ""
+
+# The state store is synced without tracker lists, this command never reads them
+TRACKERS = False
 
 
 def __init__(app, logger):
     logger.info("Checking for orphaned files on disk not in qBittorrent...")
 
-    completed_dir = app.client.application.preferences.save_path
+    completed_dir, trie = owned(app)
+    cleanup(app, logger, completed_dir, trie)
+
+
+def run_instances(instances, executor):
+    """
+    Clean up the download roots of several instances
+
+    The paths owned by all instances are merged before any root is scanned, so
+    instances sharing a root, or saving into the root of another, keep each other's
+    files. A root is skipped when any of its instances could not report what it
+    owns, and every root when the root of that instance is not even known.
+    :param instances: list of (namespace, logger) of the connected instances
+    :return: list of the instances that failed
+    """
+
+    def fetch(instance, logger):
+        logger.info("Gathering the files owned by qBittorrent...")
+        try:
+            return owned(instance)
+        except Exception:
+            logger.error("Error gathering the owned files", exc_info=True)
+            return None
+
+    roots = {}
+    trie = {}
+    failed = []
+    for (instance, logger), result in zip(
+        instances, executor.map(lambda i: fetch(*i), instances)
+    ):
+        if result is None:
+            failed.append(instance)
+            if "completed_dir" not in vars(instance):
+                logger.error(
+                    "Skipping the cleanup, the root of this instance is unknown"
+                )
+            continue
+        completed_dir, owned_paths = result
+        roots.setdefault(os.path.normpath(completed_dir), []).append((instance, logger))
+        merge(trie, owned_paths)
+
+    if any("completed_dir" not in vars(i) for i in failed):
+        return failed
+
+    for completed_dir, owners in roots.items():
+        instance, logger = owners[0]
+        names = ", ".join(i.name for i, _ in owners)
+        unreported = [i.name for i in failed if i.completed_dir == completed_dir]
+        if unreported:
+            logger.error(
+                f"Skipping {completed_dir}, the files of {', '.join(unreported)} "
+                "are unknown"
+            )
+            continue
+
+        logger.info(f"Checking for orphaned files in {completed_dir} of {names}...")
+        try:
+            cleanup(instance, logger, completed_dir, trie)
+        except Exception:
+            logger.error(f"Error cleaning up {completed_dir}", exc_info=True)
+            failed.extend(i for i, _ in owners)
+
+    return failed
+
+
+def owned(app):
+    """
+    Gather the paths owned by qBittorrent
+    :return: (completed directory, trie of the owned paths and category folders)
+    """
+    aio = asyncclient.session(app)
+    timer = metrics.Timer("orphaned")
+    timer.phase("fetch")
+
+    completed_dir = aio.run(aio.client.app_preferences())["save_path"]
+    app.completed_dir = os.path.normpath(completed_dir)
+    if app.snapshot:
+        categories = app.snapshot.categories.values()
+    else:
+        categories = aio.run(aio.client.torrents_categories()).values()
     categories = [
-        os.path.join(completed_dir, category.savePath)
-        for (_, category) in app.client.torrent_categories.categories.items()
+        os.path.join(completed_dir, category["savePath"]) for category in categories
     ]
+
+    qbittorrent_items = set()
+    if app.snapshot:
+        torrents = app.snapshot.torrents_info(app.client)
+    else:
+        torrents = aio.run(aio.client.torrents_info())
+
+    file_lists = filelists.FileLists(aio.client, app.files_cache_file, app.store)
+    files = aio.run(file_lists.fetch(torrents))
+    file_lists.save()
+
+    for torrent in torrents:
+        if files[torrent.hash]:
+            qbittorrent_items.update(
+                os.path.join(torrent.save_path, name) for name in files[torrent.hash]
+            )
+        else:
+            qbittorrent_items.add(torrent.content_path)
+
+    timer.phase("evaluate")
+
+    # Category folders are kept even when no torrent owns anything inside them
+    trie = {}
+    for path in qbittorrent_items:
+        insert(trie, path)[OWNED] = True
+    for path in categories:
+        insert(trie, path)
+
+    timer.stop()
+    return completed_dir, trie
+
+
+def cleanup(app, logger, completed_dir, trie):
+    """
+    Delete the files and folders below `completed_dir` that are not in `trie`
+
+    Folders checked without finding anything to delete are recorded in
+    `scan_state_file` and not listed again while they are unchanged, deletions are
+    written to `journal_file` first. Deletions an interrupted run did not finish
+    are completed first when the paths are still orphaned.
+    :return: (items deleted, bytes freed), what would be with `dry_run`
+    """
     exclude_patterns = [i for s in app.exclude_pattern for i in s]
+    state = scanstate.ScanState(
+        app.scan_state_file,
+        scanstate.signature(completed_dir, exclude_patterns),
+        resume=not app.full_scan,
+    )
 
-    def delete(item_path):
-        if app.dry_run:
-            logger.info(f"Skipping {item_path} because --dry-run was specified")
-            return
+    deletions = journal.Journal(app.journal_file)
+    pending = []
+    if deletions.interrupted():
+        removed, pending = deletions.summary()
+        logger.warning(
+            f"The previous run was interrupted after deleting {len(removed)} items"
+        )
+        for path in removed:
+            logger.info(f"Deleted by the previous run: {path}")
+        for path in pending:
+            logger.warning(f"The previous run was deleting {path} when it stopped")
+    if not app.dry_run:
+        deletions.start()
 
-        try:
-            if os.path.isfile(item_path):
-                os.remove(item_path)
-                logger.info(f"Deleted file {item_path}")
-            elif os.path.isdir(item_path):
-                shutil.rmtree(item_path)
-                logger.info(f"Deleted folder {item_path}")
-            else:
-                logger.debug(f"{item_path} does not exist")
-        except Exception as e:
-            logger.error(f"An error occurred: {e}")
+    # A dry run plans the same deletions, the pool only skips them
+    pool = deleter.Deleter(
+        logger,
+        workers=app.delete_workers,
+        per_device=app.device_concurrency,
+        rate=app.delete_rate,
+        dry_run=app.dry_run,
+        journal=deletions,
+    )
+
+    def excluded(path):
+        name = os.path.basename(path)
+        return any(
+            fnmatch(name, pattern) or fnmatch(path, pattern)
+            for pattern in exclude_patterns
+        )
 
-    def cleanup_dir(folder_path, owned_files):
+    # The scan skips the paths being deleted again, so they are counted once
+    resumed = set()
+    root = os.path.join(os.path.normpath(completed_dir), "")
+    for path in pending:
+        if not os.path.lexists(path):
+            logger.info(f"{path} was removed by the previous run")
+        elif not path.startswith(root) or excluded(path) or not orphan(trie, path):
+            logger.info(f"Keeping {path}, it is not orphaned anymore")
+        elif orphan(trie, os.path.dirname(path)):
+            continue  # The scan deletes its folder as a whole
+        else:
+            logger.info(f"Finishing the deletion of {path}")
+            is_dir = os.path.isdir(path) and not os.path.islink(path)
+            pool.delete(path, is_dir=is_dir)
+            resumed.add(path)
+
+    def cleanup_dir(folder_path, node):
         """
         Clean up files and folders within `folder_path` that are not owned by qbittorrent
         :param folder_path: parent folder where we are cleaning up
-        :param owned_files: files and folders that should not be deleted
+        :param node: trie node of `folder_path` holding the owned files and folders below it
         :return:
         """
-        for item in os.listdir(folder_path):
-            item_path = os.path.join(folder_path, item)
-            if item_path in owned_files:
+        try:
+            st = os.stat(folder_path)
+        except FileNotFoundError:
+            return
+        folder_key = scanstate.key(node, OWNED)
+
+        subfolders = state.unchanged(folder_path, st, folder_key)
+        if subfolders is not None:
+            for name in subfolders:
+                child = node.get(name)
+                if child is not None and OWNED not in child:
+                    cleanup_dir(os.path.join(folder_path, name), child)
+            return
+
+        with os.scandir(folder_path) as it:
+            entries = list(it)
+
+        subfolders = []
+        clean = True
+        for entry in entries:
+            child = node.get(entry.name)
+            if child is not None and OWNED in child:
                 continue
-            if any(
-                fnmatch(item, pattern) or fnmatch(item_path, pattern)
-                for pattern in exclude_patterns
-            ):
+            if entry.path in resumed:
+                clean = False
+                continue
+            if excluded(entry.path):
                 logger.info(
-                    f"Skipping {item_path} because it matches an exclude pattern"
+                    f"Skipping {entry.path} because it matches an exclude pattern"
                 )
                 continue
 
-            if os.path.isfile(item_path):
-                delete(item_path)
-            elif os.path.isdir(item_path):
-                owned_subfiles = set(
-                    filter(lambda x: x.startswith(item_path), owned_files)
-                )
-                if not owned_subfiles and item_path not in categories:
-                    delete(item_path)
-                else:
-                    cleanup_dir(item_path, owned_subfiles)
+            if not entry.is_dir(follow_symlinks=False):
+                pool.delete(entry.path, is_dir=False)
+                clean = False
+            elif child is None:
+                pool.delete(entry.path, is_dir=True)
+                clean = False
+            else:
+                cleanup_dir(entry.path, child)
+                subfolders.append(entry.name)
 
-    # Gather list of all paths owned by qBittorrent
-    qbittorrent_items = set()
-    for torrent in app.client.torrents.info():
-        # arbitrary cut-off to prevent traversing excessively large torrents
-        if len(torrent.files) > 100:
-            qbittorrent_items.add(torrent.content_path)
-        else:
-            qbittorrent_items.update(
-                [os.path.join(torrent.save_path, file.name) for file in torrent.files]
-            )
+        if clean:
+            state.record(folder_path, st, folder_key, subfolders)
 
     # Delete orphaned files on disk not owned by qBittorrent
-    cleanup_dir(completed_dir, qbittorrent_items)
+    timer = metrics.Timer("orphaned")
+    timer.phase("mutate")
+    try:
+        cleanup_dir(completed_dir, insert(trie, completed_dir))
+    except BaseException:
+        pool.close(cancel=True)
+        state.save()
+        raise
+    result = pool.close()
+    state.save(complete=True)
+    deletions.close()
+    timer.stop()
+    if state.skipped:
+        logger.info(f"Skipped {state.skipped} unchanged folders")
+    return result
+
+
+def insert(trie, path):
+    """
+    Add a path to the trie of paths, one node per path component
+    :param trie: root node
+    :param path: absolute path
+    :return: node of the path
+    """
+    node = trie
+    for part in os.path.normpath(path).split(os.sep):
+        if part:
+            node = node.setdefault(part, {})
+    return node
+
+
+def orphan(trie, path):
+    """
+    :return: True when qBittorrent owns nothing at, above or below `path`
+    """
+    node = trie
+    for part in os.path.normpath(path).split(os.sep):
+        if OWNED in node:
+            return False
+        if part:
+            node = node.get(part)
+            if node is None:
+                return True
+    return False
+
+
+def merge(trie, other):
+    """
+    Add the paths of another trie to `trie`
+    """
+    for part, node in other.items():
+        if part == OWNED:
+            trie[OWNED] = True
+        else:
+            merge(trie.setdefault(part, {}), node)
 
 
 def add_arguments(command, subparser):
@@ -104,3 +329,24 @@ def add_arguments(command, subparser):
         default=False,
         required=False,
     )
+    parser.add_argument(
+        "--files-cache-file",
+        default="/config/files-cache.json",
+        help="Path to the cache of file lists of completed torrents",
+    )
+    parser.add_argument(
+        "--scan-state-file",
+        default="/config/orphaned-scan.json",
+        help="Path to the state of the folders checked by previous scans",
+    )
+    parser.add_argument(
+        "--journal-file",
+        default="/config/orphaned-journal.jsonl",
+        help="Path to the journal the deletions of every run are appended to",
+    )
+    parser.add_argument(
+        "--full-scan",
+        action="store_true",
+        help="List every folder again, even when it did not change since the last scan",
+    )
+    deleter.add_arguments(parser)
@@ -1,9 +1,26 @@
-from qbtools import utils
+import os
+import asyncio
+
+from qbtools import asyncclient, deleter, metrics, query, utils
 from fnmatch import fnmatch
 
+# Fields of the streamed torrent records, besides the hash, category and tags
+FIELDS = ["content_path", "name", "ratio", "save_path", "seeding_time"]
+
+# The state store is synced without tracker lists, this command never reads them
+TRACKERS = False
+
 
 def __init__(app, logger):
-    categories = list(app.client.torrent_categories.categories.keys())
+    aio = asyncclient.session(app)
+    timer = metrics.Timer("prune")
+    timer.phase("fetch")
+
+    if app.snapshot:
+        all_categories = list(app.snapshot.categories.keys())
+    else:
+        all_categories = list(aio.run(aio.client.torrents_categories()).keys())
+    categories = all_categories
 
     if app.include_category:
         includes = [i for s in app.include_category for i in s]
@@ -22,19 +39,21 @@ def __init__(app, logger):
             "No torrents can be pruned since no categories were included based on selectors"
         )
 
-    torrents = app.client.torrents.info()
-    torrents = list(filter(lambda x: x.category in categories, torrents))
-
+    # Categories and included tags are filtered by qBittorrent where possible
     include_tags = [i for s in app.include_tag for i in s]
-    if include_tags:
-        torrents = list(
-            filter(lambda x: all(y in x.tags for y in include_tags), torrents)
-        )
+    plan = query.plan(categories, include_tags, all_categories=all_categories)
+    logger.debug(f"Fetching torrents with {len(plan.requests)} request(s)")
+    if app.snapshot:
+        torrents = plan.select(app.snapshot, app.client)
+    else:
+        torrents = aio.iterate(plan.stream(aio.client, FIELDS), timer)
 
+    timer.phase("evaluate")
     exclude_tags = [i for s in app.exclude_tag for i in s]
     if exclude_tags:
-        torrents = list(
-            filter(lambda x: not any(y in x.tags for y in exclude_tags), torrents)
+        torrents = filter(
+            lambda x: not any(y in utils.split_tags(x.tags) for y in exclude_tags),
+            torrents,
         )
 
     logger.info(
@@ -42,16 +61,100 @@ def __init__(app, logger):
         f"but does not contain tags [{' OR '.join(exclude_tags)}]..."
     )
 
+    hashes = []
+    pruned = []
     for t in torrents:
         logger.info(
             f"Pruned torrent {t['name']} with category [{t.category}] "
             f"and tags [{t.tags}] and ratio [{round(t['ratio'], 2)}] "
             f"and seeding time [{utils.dhms(t['seeding_time'])}]"
         )
-        if not app.dry_run:
-            t.delete(delete_files=app.with_data)
+        hashes.append(t.hash)
+        pruned.append(t)
+
+    # Data deleted locally is removed from qBittorrent without its data
+    local = {}
+    if app.with_data and app.local_delete:
+        local = local_paths(app, aio, logger, pruned)
+    remote = [h for h in hashes if h not in local]
+
+    async def delete():
+        await asyncio.gather(
+            *(
+                aio.client.torrents_delete(chunk, app.with_data)
+                for chunk in utils.chunks(remote, app.chunk_size)
+            ),
+            *(
+                aio.client.torrents_delete(chunk, False)
+                for chunk in utils.chunks(list(local), app.chunk_size)
+            ),
+        )
+
+    timer.phase("mutate")
+    if not app.dry_run:
+        aio.run(delete())
+
+    if local:
+        pool = deleter.Deleter(
+            logger,
+            workers=app.delete_workers,
+            per_device=app.device_concurrency,
+            rate=app.delete_rate,
+            dry_run=app.dry_run,
+        )
+        for path in sorted({p for p in local.values() if p}):
+            pool.delete(path, os.path.isdir(path))
+        pool.close()
+    timer.stop()
+
+    logger.info(f"Deleted {len(hashes)} torrents")
+
 
-    logger.info(f"Deleted {len(torrents)} torrents")
+def local_paths(app, aio, logger, pruned):
+    """
+    Pick the content of the pruned torrents that can be deleted by qbtools itself
+
+    Content stored directly in the save path is left to qBittorrent, and content
+    still used by a torrent that is not pruned is kept.
+    :return: hash -> content path to delete, or None to keep the data
+    """
+    hashes = {t.hash for t in pruned}
+    if app.snapshot:
+        torrents = app.snapshot.torrents_info(app.client)
+    else:
+        torrents = aio.iterate(aio.client.torrents_stream(["content_path"]))
+    # Content paths of the other torrents, and every folder containing one of them
+    kept = set()
+    containing = set()
+    for t in torrents:
+        if t.hash not in hashes:
+            kept.add(os.path.normpath(t.content_path))
+            containing.update(ancestors(t.content_path))
+
+    paths = {}
+    for t in pruned:
+        path = os.path.normpath(t.content_path)
+        if not path.startswith(os.path.join(os.path.normpath(t.save_path), "")):
+            continue
+        if path in containing or any(p in kept for p in ancestors(path)):
+            logger.info(f"Keeping {path}, it is still used by another torrent")
+            paths[t.hash] = None
+        else:
+            paths[t.hash] = path
+    return paths
+
+
+def ancestors(path):
+    """
+    :return: a path and every folder above it
+    """
+    path = os.path.normpath(path)
+    while True:
+        yield path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
 
 
 def add_arguments(command, subparser):
@@ -71,7 +174,7 @@ def add_arguments(command, subparser):
         action="append",
         metavar="mytag",
         default=[],
-        help="Include torrents containing all of these tags, can be repeated multiple times",
+        help="Include torrents having all of these tags, compared as whole tags, can be repeated multiple times",
         required=True,
     )
     parser.add_argument(
@@ -80,7 +183,7 @@ def add_arguments(command, subparser):
         action="append",
         metavar="mytag",
         default=[],
-        help="Exclude torrents containing any of these tags, can be repeated multiple times",
+        help="Exclude torrents having any of these tags, compared as whole tags, can be repeated multiple times",
         required=False,
     )
     parser.add_argument(
@@ -115,3 +218,15 @@ def add_arguments(command, subparser):
         default=False,
         required=False,
     )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=500,
+        help="The maximum number of torrents deleted by a single request",
+    )
+    parser.add_argument(
+        "--local-delete",
+        action="store_true",
+        help="With --with-data, delete the data here on a pool of workers instead of in qBittorrent",
+    )
+    deleter.add_arguments(parser)
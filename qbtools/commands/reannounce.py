@@ -1,22 +1,179 @@
 import time
+import heapq
+import asyncio
 
+from qbtools import asyncclient, metrics, utils
 from qbittorrentapi import TrackersList
 from qbittorrentapi import TrackerStatus
 
+STALLED_STATES = {
+    "stalled_downloading": "stalledDL",
+    "stalled_uploading": "stalledUP",
+}
+
+
+class Scheduler:
+    """
+    Adaptive timing of the reannounce passes
+
+    Passes back off up to `max_interval` while the stalled set stays empty or
+    unchanged and tighten back to `interval` when new torrents stall. Each torrent
+    is reannounced on its own timer, kept in a heap keyed by due time: it waits
+    `interval` after each of its first `fast_retries` reannounces, like with a fixed
+    interval, and twice as long after each later one. A torrent whose trackers
+    changed since its last reannounce is due at once and starts over.
+    """
+
+    def __init__(self, interval, max_interval, fast_retries):
+        self.min_interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.fast_retries = fast_retries
+        self.interval = interval
+        self.stalled = set()
+        self.due = {}
+        self.attempts = {}
+        self.states = {}
+        self.heap = []
+
+    def observe(self, stalled):
+        """
+        Adapt the pass interval to the stalled torrents found by the latest pass
+        :return: whether new torrents stalled
+        """
+        new = stalled - self.stalled
+        if new:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+        # Torrents that recovered start over when they stall again
+        for torrent_hash in self.stalled - stalled:
+            self.due.pop(torrent_hash, None)
+            self.attempts.pop(torrent_hash, None)
+            self.states.pop(torrent_hash, None)
+        self.stalled = set(stalled)
+        return bool(new)
+
+    def is_due(self, torrent_hash, now, state=None):
+        """
+        :param state: state of the trackers of the torrent
+        """
+        if self.states.get(torrent_hash, state) != state:
+            return True
+        return self.due.get(torrent_hash, 0) <= now
+
+    def schedule(self, torrent_hash, now, state=None):
+        """
+        Time the next reannounce of a torrent that was just reannounced
+        :param state: state of the trackers of the torrent when it was reannounced
+        """
+        if self.states.get(torrent_hash, state) != state:
+            self.attempts.pop(torrent_hash, None)
+        self.states[torrent_hash] = state
+        attempts = self.attempts[torrent_hash] = self.attempts.get(torrent_hash, 0) + 1
+        backoff = max(0, attempts - self.fast_retries)
+        delay = min(self.min_interval * 2**backoff, self.max_interval)
+        self.due[torrent_hash] = now + delay
+        heapq.heappush(self.heap, (now + delay, torrent_hash))
+
+    def next_due(self):
+        # Entries of rescheduled or recovered torrents are dropped lazily
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def delay(self, now):
+        """
+        :return: seconds until the next pass, at least the minimum interval
+        """
+        wake = now + self.interval
+        next_due = self.next_due()
+        if next_due is not None:
+            wake = min(wake, next_due)
+        # Torrents skipped while due, because they have peers, stay due
+        return max(self.min_interval, wake - now)
+
 
 def __init__(app, logger):
     logger.info("Starting reannounce process...")
 
-    retries = {}
+    while True:
+        # Errors, like qBittorrent restarting, are logged and the loop goes on
+        if app.store:
+            try:
+                app.store.update(app.client)
+            except Exception as e:
+                logger.error(e)
+        wait(app, logger, run(app, logger))
+
 
-    def process_torrents(status):
-        torrents = app.client.torrents.info(
-            includeTrackers="true",
-            status_filter=status,
-            sort="time_active",
-        )
-        torrents_retries = retries.get(status, {})
+def wait(app, logger, delay):
+    """
+    Sleep until the next pass, waking up early when a torrent stalls
+
+    Stalls are detected from `sync/maindata` deltas every `interval` seconds, which
+    are much cheaper than listing the stalled torrents with their trackers.
+    """
+    deadline = time.monotonic() + delay
+    while (remaining := deadline - time.monotonic()) > 0:
+        time.sleep(min(remaining, app.interval))
+        if remaining <= app.interval:
+            continue
+        try:
+            if stalled_since_last_probe(app):
+                return
+        except Exception as e:
+            logger.error(e)
+
+
+def stalled_since_last_probe(app):
+    states = set(STALLED_STATES.values())
+    if app.store:
+        changed = app.store.update(app.client, trackers=False)
+        records = app.store.records(changed)
+        return any(r["state"] in states for r in records.values())
+
+    first = "probe_rid" not in vars(app)
+    data = app.client.sync_maindata(rid=vars(app).get("probe_rid", 0))
+    app.probe_rid = data.get("rid", 0)
+    # The first response lists every torrent, the pass before it already saw them
+    return not first and any(
+        delta.get("state") in states for delta in data.get("torrents", {}).values()
+    )
+
+
+def run(app, logger):
+    """
+    :return: seconds until the next pass
+    """
+    retries = vars(app).setdefault("retries", {})
+    scheduler = vars(app).setdefault(
+        "scheduler", Scheduler(app.interval, app.max_interval, app.fast_retries)
+    )
+    stalled = set()
+    aio = asyncclient.session(app)
 
+    async def process_torrents(status):
+        timer = metrics.Timer("reannounce")
+        timer.phase("fetch")
+
+        if app.snapshot:
+            torrents = app.snapshot.torrents_info(
+                app.client, where=lambda t: t["state"] == STALLED_STATES[status]
+            )
+            torrents.sort(key=lambda t: t.time_active)
+        else:
+            torrents = await aio.client.torrents_info(
+                includeTrackers="true",
+                filter=status,
+                sort="time_active",
+            )
+        if app.store:
+            torrents_retries = app.store.retries(status)
+        else:
+            torrents_retries = retries.get(status, {})
+
+        timer.phase("evaluate")
         if torrents:
             torrents = list(
                 filter(
@@ -38,7 +195,14 @@ def __init__(app, logger):
         if not torrents:
             torrents_retries.clear()
 
+        stalled.update(t.hash for t in torrents)
+        now = time.monotonic()
+
+        reannounce = []
         for t in torrents:
+            if not scheduler.is_due(t.hash, now, tracker_state(t)):
+                continue
+
             peers = t.num_seeds + t.num_leechs
             if peers:
                 logger.debug(
@@ -53,23 +217,53 @@ def __init__(app, logger):
                 )
                 continue
 
-            t.reannounce()
-            torrents_retries[t.hash] = torrent_retries = torrent_retries + 1
+            reannounce.append(t)
+
+        timer.phase("mutate")
+        await asyncio.gather(
+            *(
+                aio.client.torrents_reannounce(chunk)
+                for chunk in utils.chunks([t.hash for t in reannounce], app.chunk_size)
+            )
+        )
+
+        for t in reannounce:
+            torrents_retries[t.hash] = torrent_retries = (
+                torrents_retries.get(t.hash, 0) + 1
+            )
+            scheduler.schedule(t.hash, now, tracker_state(t))
             logger.info(
                 f"Reannounced torrent {t.name} ({t.hash}) {torrent_retries}/{app.max_retries}",
             )
 
         retries[status] = torrents_retries
+        if app.store:
+            app.store.save_retries(status, torrents_retries)
+        timer.stop()
+
+    async def process():
+        await process_torrents(status="stalled_downloading")
+        if app.process_seeding:
+            await process_torrents(status="stalled_uploading")
+
+    try:
+        aio.run(process())
+    except Exception as e:
+        logger.error(e)
+    else:
+        if scheduler.observe(stalled):
+            logger.debug(f"New stalled torrents, next pass in {scheduler.interval}s")
+
+    return scheduler.delay(time.monotonic())
 
-    while True:
-        try:
-            process_torrents(status="stalled_downloading")
-            if app.process_seeding:
-                process_torrents(status="stalled_uploading")
-        except Exception as e:
-            logger.error(e)
 
-        time.sleep(app.interval)
+def tracker_state(torrent):
+    """
+    :return: status and message of every tracker of a torrent
+    """
+    if "trackers" not in torrent:
+        return torrent.tracker
+    return tuple((s.status, s.msg) for s in TrackersList(torrent.get("trackers")))
 
 
 def add_arguments(command, subparser):
@@ -96,10 +290,28 @@ def add_arguments(command, subparser):
         "--interval",
         type=int,
         default=5,
-        help="The interval to process reannouncements in seconds.",
+        help="The minimum interval to process reannouncements in seconds.",
+    )
+    parser.add_argument(
+        "--max-interval",
+        type=int,
+        default=60,
+        help="The maximum interval to process reannouncements in seconds while no new torrents stall.",
+    )
+    parser.add_argument(
+        "--fast-retries",
+        type=int,
+        default=6,
+        help="The number of reannounces of a torrent followed by --interval seconds, the delay doubles after each later one up to --max-interval.",
     )
     parser.add_argument(
         "--process-seeding",
         action="store_true",
         help="Process seeding torrents as well.",
     )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=500,
+        help="The maximum number of torrents reannounced by a single request.",
+    )
@@ -1,13 +1,11 @@
-import tldextract
+import json
 import collections
+import numpy as np
 
-from qbtools import utils
+from qbtools import asyncclient, classifier, columns, fingerprint, linkscan, metrics
+from qbtools import mutations, query, resolver, snapshot, utils
 from datetime import datetime
 
-from qbittorrentapi import TrackersList
-from qbittorrentapi import TrackerStatus
-
-
 DEFAULT_TAGS = [
     "activity:",
     "added:",
@@ -49,110 +47,278 @@ MAINTENANCE_MATCHES = [
     "TRACKER UNAVILABLE",
 ]
 
+# Fields of the streamed torrent records, besides the hash
+FIELDS = [
+    "added_on",
+    "category",
+    "content_path",
+    "last_activity",
+    "ratio",
+    "save_path",
+    "seeding_time",
+    "size",
+    "state",
+    "tags",
+    "tracker",
+    "trackers",
+]
+
+# Torrents are evaluated in batches as they are decoded
+BATCH_SIZE = 1000
+
 
 def __init__(app, logger):
     logger.info("Tagging torrents in qBittorrent...")
 
     today = datetime.today()
-    config = app.config.get("trackers", [])
-    config = {y: x for x in config for y in x["urls"]}
-    torrents = app.client.torrents.info(includeTrackers="true")
+    config = app.config.get("trackers") or []
+
+    timer = metrics.Timer("tagging")
+    timer.phase("fetch")
 
+    # Excluded categories are left out by qBittorrent where possible
     exclude_categories = [i for s in app.exclude_category for i in s]
-    if exclude_categories:
-        torrents = list(
-            filter(lambda x: x.category not in exclude_categories, torrents)
-        )
 
-    exclude_tags = [i for s in app.exclude_tag for i in s]
-    if exclude_tags:
-        torrents = list(
-            filter(lambda x: any(y not in x.tags for y in exclude_tags), torrents)
+    def selection(categories):
+        categories = [*categories, ""]  # Torrents without a category
+        if not exclude_categories:
+            return query.plan()
+        return query.plan(
+            [c for c in categories if c not in exclude_categories],
+            all_categories=categories,
         )
 
-    extractTLD = tldextract.TLDExtract(cache_dir=None)
-    tags = collections.defaultdict(list)
-    paths = []
-
-    for t in torrents:
-        tags_to_add = []
-
-        trackers = TrackersList(t.get("trackers")) if "trackers" in t else t.trackers
-        trackers = list(filter(lambda s: s.tier >= 0, trackers))
-
-        url = t.tracker
-        if not url and trackers:
-            url = trackers[0].url
-
-        tracker = config.get(extractTLD(url).registered_domain)
+    state = None
+    changed = set()
+    if app.snapshot:
+        torrents = selection(app.snapshot.categories).select(app.snapshot, app.client)
+    elif app.incremental:
+        state = utils.load_json(app.state_file, {})
+        snap = snapshot.Snapshot(state.get("snapshot"))
+        changed = snap.update(app.client)
+        torrents = selection(snap.categories).select(snap, app.client)
+        logger.info(f"Synced {len(changed)} changed torrents of {len(snap)}")
+    else:
+        aio = asyncclient.session(app)
+        categories = []
+        if exclude_categories:
+            categories = aio.run(aio.client.torrents_categories())
+        plan = selection(categories)
+        logger.debug(f"Fetching torrents with {len(plan.requests)} request(s)")
+        torrents = aio.iterate(
+            plan.stream(aio.client, FIELDS, includeTrackers="true"), timer
+        )
 
-        if app.added_on:
-            tags_to_add.append(calculate_date_tags("added", t.added_on, today))
+    current = {}
+    exclude_tags = [i for s in app.exclude_tag for i in s]
 
-        if app.last_activity:
-            tags_to_add.append(calculate_date_tags("activity", t.last_activity, today))
+    def selected(torrents):
+        for t in torrents:
+            torrent_tags = utils.split_tags(t.tags)
+            # Torrents having all the excluded tags are left alone
+            if exclude_tags and all(y in torrent_tags for y in exclude_tags):
+                continue
+            current[t.hash] = torrent_tags
+            yield t
+
+    timer.phase("evaluate")
+
+    # Tags of unchanged torrents are reused as long as the options are the same, tags
+    # depending on the current time or the seeding counters are evaluated again for
+    # every torrent
+    signature = evaluation_signature(app, config)
+    cache = {}
+    if state and state.get("tagging", {}).get("signature") == signature:
+        cache = state["tagging"]["tags"]
+
+    trackers_resolver = resolver.TrackerResolver(config, app.domain_cache_file)
+    messages = app.config.get("tracker_messages") or {}
+    messages_classifier = classifier.MessageClassifier(
+        {
+            "unregistered": UNREGISTERED_MATCHES + messages.get("unregistered", []),
+            "tracker-down": MAINTENANCE_MATCHES + messages.get("tracker-down", []),
+        }
+    )
+    tags = collections.defaultdict(set)
+    evaluated = {}
+
+    # Rules of the configuration are compiled once and evaluated per batch
+    ruleset = timed_ruleset = None
+    managed = set()
+    if app.config.get("rules"):
+        from qbtools import rules
+
+        config_rules = app.config["rules"]
+        ruleset = rules.RuleSet([r for r in config_rules if not rules.is_timed(r)])
+        timed_ruleset = rules.RuleSet([r for r in config_rules if rules.is_timed(r)])
+        managed = ruleset.tags | timed_ruleset.tags
+        tags.update({tag: set() for tag in managed})
+
+    def site(url):
+        tracker = trackers_resolver.site(url)
+        return tracker["name"] if tracker else None
+
+    sites = {tracker["name"]: tracker for tracker in config}
+    now = today.timestamp()
+
+    def evaluate(batch, timed=False):
+        """
+        :param timed: evaluate the tags depending on the current time or on the
+            seeding counters, which are never cached, instead of the others
+        :return: tag -> hashes of the torrents of the batch getting the tag
+        """
+        cols = columns.Columns(batch, site, now)
+        found = {}
+
+        def add(groups):
+            for tag, hashes in groups.items():
+                if hashes:
+                    found.setdefault(tag, []).extend(hashes)
+
+        if timed:
+            if app.added_on:
+                labels = [f"added:{label}" for label in columns.DATE_LABELS]
+                add(cols.group(columns.date_buckets(cols, "added_on"), labels))
+
+            if app.last_activity:
+                labels = [f"activity:{label}" for label in columns.DATE_LABELS]
+                add(cols.group(columns.date_buckets(cols, "last_activity"), labels))
+
+            if app.expired:
+                add({"expired": cols.select(columns.expired(cols, sites))})
+
+            if timed_ruleset:
+                add(timed_ruleset.evaluate(cols))
+            return found
 
         if app.sites:
-            if tracker:
-                tags_to_add.append(f"site:{tracker['name']}")
-            else:
-                tags_to_add.append(f"site:unmapped")
+            codes, names = cols.text("site")
+            add(cols.group(codes, [f"site:{n or 'unmapped'}" for n in names]))
 
         if app.unregistered or app.tracker_down or app.not_working:
-            if not any(s.status == TrackerStatus.WORKING.value for s in trackers):
-                messages = [z.msg.upper() for z in trackers]
-                if app.unregistered and any(
-                    match in msg for msg in messages for match in UNREGISTERED_MATCHES
-                ):
-                    tags_to_add.append("unregistered")
-                elif app.tracker_down and any(
-                    match in msg for msg in messages for match in MAINTENANCE_MATCHES
-                ):
-                    tags_to_add.append("tracker-down")
+            # Messages are classified once per distinct set of tracker messages
+            codes, messages = cols.text("message")
+            codes = np.where(cols.boolean("working"), len(messages), codes)
+            counts = np.bincount(codes, minlength=len(messages) + 1).tolist()
+            labels = []
+            for message, count in zip(messages, counts):
+                if not count:
+                    labels.append(None)
+                    continue
+                matches = messages_classifier.match(message.split("\n"), count)
+                if app.unregistered and "unregistered" in matches:
+                    labels.append("unregistered")
+                elif app.tracker_down and "tracker-down" in matches:
+                    labels.append("tracker-down")
                 elif app.not_working:
-                    tags_to_add.append("not-working")
-
-        if app.expired and tracker and t.state_enum.is_complete:
-            if (
-                tracker.get("required_seed_ratio")
-                and t.ratio >= tracker["required_seed_ratio"]
-            ) or (
-                tracker.get("required_seed_days")
-                and t.seeding_time >= utils.seconds(tracker["required_seed_days"])
-            ):
-                tags_to_add.append("expired")
-
-        if app.duplicates:
-            if t.content_path in paths and not t.content_path == t.save_path:
-                tags_to_add.append("dupe")
-            else:
-                paths.append(t.content_path)
+                    labels.append("not-working")
+                else:
+                    labels.append(None)
+            add(cols.group(codes, labels + [None]))
+
+        if app.not_linked:
+            codes, paths = cols.text("content_path")
+            unlinked = np.array([not linked[path] for path in paths], dtype=bool)
+            add({"not-linked": cols.select(unlinked[codes])})
+
+        if ruleset:
+            add(ruleset.evaluate(cols))
+
+        return found
+
+    linked = {}
+    scanner = None
+    if app.not_linked:
+        scanner = linkscan.LinkScanner(
+            app.link_cache_file, app.link_workers, app.link_cache_max_age
+        )
 
-        if app.not_linked and not utils.is_linked(t.content_path):
-            tags_to_add.append("not-linked")
+    content_paths = set()
+    duplicates = set()
+    completed = []
+    for batch in utils.batches(selected(torrents), BATCH_SIZE):
+        pending = [t for t in batch if t.hash not in cache or t.hash in changed]
+        if scanner:
+            scanner.keep(t.content_path for t in batch)
+            linked = scanner.scan(t.content_path for t in pending)
+
+        for t in batch:
+            if t.hash in cache and t.hash not in changed:
+                evaluated[t.hash] = list(cache[t.hash])
+                for tag in evaluated[t.hash]:
+                    tags[tag].add(t.hash)
+
+        for tag, hashes in evaluate(batch, timed=True).items():
+            tags[tag].update(hashes)
+
+        if pending:
+            if state is not None:
+                evaluated.update((t.hash, []) for t in pending)
+            for tag, hashes in evaluate(pending).items():
+                tags[tag].update(hashes)
+                if state is not None:
+                    for torrent_hash in hashes:
+                        evaluated[torrent_hash].append(tag)
 
-        for tag in tags_to_add:
-            tags[tag].append(t)
+        if app.duplicates:
+            duplicates.update(find_duplicates(batch, content_paths))
+        if app.duplicate_content:
+            completed.extend(
+                fingerprint.Torrent(t.hash, t.size, t.save_path)
+                for t in batch
+                if columns.is_complete(t.state)
+            )
 
-    for tag, tagged in sorted(tags.items()):
-        old_hashes = [t.hash for t in torrents if tag in t.tags and not t in tagged]
-        new_hashes = [t.hash for t in tagged if not tag in t.tags]
+    if scanner:
+        scanner.save()
 
-        if old_hashes:
-            app.client.torrents_remove_tags(tags=tag, torrent_hashes=old_hashes)
+    if app.duplicate_content:
+        aio = asyncclient.session(app)
+        finder = fingerprint.DuplicateFinder(
+            aio.client, app.fingerprint_cache_file, app.fingerprint_workers
+        )
+        duplicates.update(aio.run(finder.find(completed)))
+        finder.save()
 
-        if new_hashes:
-            app.client.torrents_add_tags(tags=tag, torrent_hashes=new_hashes)
+    if duplicates:
+        tags["dupe"] = duplicates
 
-        if old_hashes or new_hashes:
+    additions, removals = diff_tags(current, tags)
+    for tag in sorted(tags):
+        if additions[tag] or removals[tag]:
             logger.info(
-                f"{tag} - untagged {len(old_hashes)} old and tagged {len(new_hashes)} new"
+                f"{tag} - untagged {len(removals[tag])} old and tagged {len(additions[tag])} new"
             )
 
+    hits = messages_classifier.hits
+    for category, count in sorted(hits.items()):
+        metrics.TRACKER_MESSAGES.inc(count, category=category)
+    if hits:
+        logger.info(
+            f"Tracker messages: {dict(hits)} "
+            f"({len(messages_classifier.memo)} distinct messages classified)"
+        )
+
+    trackers_resolver.save()
+
+    timer.phase("mutate")
+
+    operations = mutations.plan(additions, removals, app.tag_chunk_size)
+    if operations:
+        mutations.apply(app.client, operations, app.tag_workers)
+        expected = mutations.baseline(additions, removals, app.tag_chunk_size)
+        logger.info(
+            f"Applied tag changes with {len(operations)} requests "
+            f"({expected - len(operations)} saved compared to one request per tag and chunk)"
+        )
+
     empty_tags = list(
         filter(
-            lambda tag: tag not in tags
-            and any(tag.lower().startswith(x.lower()) for x in DEFAULT_TAGS),
+            lambda tag: not tags.get(tag)
+            and (
+                tag in managed
+                or any(tag.lower().startswith(x.lower()) for x in DEFAULT_TAGS)
+            ),
             app.client.torrents_tags(),
         )
     )
@@ -160,21 +326,64 @@ def __init__(app, logger):
         app.client.torrents_delete_tags(tags=empty_tags)
         logger.info(f"Removed {len(empty_tags)} old tags from qBittorrent")
 
+    if state is not None:
+        utils.save_json(
+            app.state_file,
+            dict(
+                snapshot=snap.to_dict(),
+                tagging=dict(signature=signature, tags=evaluated),
+            ),
+        )
+
+    timer.stop()
     logger.info("Finished tagging torrents in qBittorrent")
 
 
-def calculate_date_tags(prefix, timestamp, today):
-    diff = today - datetime.fromtimestamp(timestamp)
-    if diff.days == 0:
-        return f"{prefix}:1d"
-    elif diff.days <= 7:
-        return f"{prefix}:7d"
-    elif diff.days <= 30:
-        return f"{prefix}:30d"
-    elif diff.days <= 180:
-        return f"{prefix}:180d"
-    else:
-        return f"{prefix}:>180d"
+def find_duplicates(torrents, seen=None):
+    """
+    Find torrents sharing their content path with a torrent seen before them
+    :param torrents: torrents in evaluation order
+    :param seen: content paths of the torrents of earlier batches, updated in place
+    :return: hashes of the duplicate torrents
+    """
+    seen = set() if seen is None else seen
+    duplicates = set()
+    for t in torrents:
+        if t.content_path in seen and t.content_path != t.save_path:
+            duplicates.add(t.hash)
+        seen.add(t.content_path)
+    return duplicates
+
+
+def diff_tags(current, desired):
+    """
+    Compute the tag changes needed to go from the current to the desired tags
+    :param current: hash -> set of tags the torrent currently has
+    :param desired: tag -> set of hashes that should have the tag
+    :return: (additions, removals) as tag -> set of hashes
+    """
+    tagged = collections.defaultdict(set)
+    for torrent_hash, torrent_tags in current.items():
+        for tag in torrent_tags:
+            tagged[tag].add(torrent_hash)
+
+    additions = {tag: hashes - tagged[tag] for tag, hashes in desired.items()}
+    removals = {tag: tagged[tag] - hashes for tag, hashes in desired.items()}
+    return additions, removals
+
+
+def evaluation_signature(app, config):
+    # Date and expired tags are left out, they are never cached
+    options = [
+        app.sites,
+        app.unregistered,
+        app.tracker_down,
+        app.not_working,
+        app.not_linked,
+    ]
+    messages = app.config.get("tracker_messages")
+    rules = app.config.get("rules")
+    return json.dumps([options, config, messages, rules], sort_keys=True)
 
 
 def add_arguments(command, subparser):
@@ -216,6 +425,11 @@ def add_arguments(command, subparser):
         action="store_true",
         help="Tag torrents with the same content path",
     )
+    parser.add_argument(
+        "--duplicate-content",
+        action="store_true",
+        help="Also tag completed torrents with identical files under different paths",
+    )
     parser.add_argument(
         "--expired",
         action="store_true",
@@ -251,3 +465,60 @@ def add_arguments(command, subparser):
         action="store_true",
         help="Tag torrents with unregistered tracker status message",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only fetch and re-evaluate torrents that changed since the last run (uses --state-file)",
+    )
+    parser.add_argument(
+        "--state-file",
+        default="/config/tagging-state.json",
+        help="Path to the state file used by --incremental",
+    )
+    parser.add_argument(
+        "--tag-chunk-size",
+        type=int,
+        default=1000,
+        help="The maximum number of torrents changed by a single tag request",
+    )
+    parser.add_argument(
+        "--tag-workers",
+        type=int,
+        default=4,
+        help="The number of tag requests sent to qBittorrent concurrently",
+    )
+    parser.add_argument(
+        "--link-cache-file",
+        default="/config/links-cache.json",
+        help="Path to the cache of hardlink scan results used by --not-linked",
+    )
+    parser.add_argument(
+        "--link-workers",
+        type=int,
+        default=8,
+        help="The number of folders and chunks of files scanned for hardlinks concurrently",
+    )
+    parser.add_argument(
+        "--link-cache-max-age",
+        type=int,
+        default=86400,
+        help="Seconds a cached hardlink scan result is reused while its content path "
+        "is unchanged, a new hardlink to a file in a subfolder is only noticed after "
+        "that, 0 to scan every content path on every run",
+    )
+    parser.add_argument(
+        "--fingerprint-cache-file",
+        default="/config/fingerprints-cache.json",
+        help="Path to the cache of content fingerprints used by --duplicate-content",
+    )
+    parser.add_argument(
+        "--fingerprint-workers",
+        type=int,
+        default=8,
+        help="The number of torrents fingerprinted concurrently",
+    )
+    parser.add_argument(
+        "--domain-cache-file",
+        default="/config/domains-cache.json",
+        help="Path to the cache of registered domains of announce hosts",
+    )
@@ -0,0 +1,228 @@
+import os
+import stat
+import time
+import shutil
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+
+class RateLimiter:
+    """Start calls of any thread at most `rate` per second, 0 for no limit"""
+
+    def __init__(self, rate=0):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(self.next, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Deleter:
+    """
+    Delete files and folders on a bounded pool of threads
+
+    At most `per_device` deletions run at once on the same device and deletions
+    start at most `rate` per second, to spare network storage. The bytes freed by
+    every deletion are measured before it, files still linked elsewhere free
+    nothing. A dry run goes through the same plan and the same measurements and
+    only skips the deletions, so it reports what a real run would delete and free.
+    """
+
+    def __init__(
+        self,
+        logger,
+        workers=8,
+        per_device=4,
+        rate=0,
+        dry_run=False,
+        journal=None,
+        interval=10,
+    ):
+        """
+        :param journal: `Journal` the deletions are written to
+        :param interval: seconds between progress reports
+        """
+        self.logger = logger
+        self.per_device = per_device
+        self.dry_run = dry_run
+        self.journal = journal
+        self.interval = interval
+        self.limiter = RateLimiter(rate)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Keep the queue short, the scan waits for the workers instead of piling up
+        self.slots = threading.BoundedSemaphore(workers * 4)
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.planned = 0
+        self.deleted = 0
+        self.failed = 0
+        self.freed = 0
+        self.reported = time.monotonic()
+
+    def delete(self, path, is_dir):
+        """
+        Queue the deletion of a file or a folder with everything below it
+        """
+        self.slots.acquire()
+        self.planned += 1
+        try:
+            self.executor.submit(self.remove, path, is_dir)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def device(self, path):
+        try:
+            dev = os.lstat(path).st_dev
+        except OSError:
+            dev = None
+        with self.lock:
+            if dev not in self.devices:
+                self.devices[dev] = threading.Semaphore(self.per_device)
+            return self.devices[dev]
+
+    def remove(self, path, is_dir):
+        try:
+            with self.device(path):
+                size = freed_bytes(path)
+                if self.dry_run:
+                    self.logger.info(
+                        f"Skipping {path} ({utils.format_bytes(size)}) "
+                        "because --dry-run was specified"
+                    )
+                    self.progress(size)
+                    return
+
+                self.limiter.wait()
+                self.unlink(path, is_dir, size)
+        except Exception as e:
+            self.logger.error(f"An error occurred deleting {path}: {e}")
+            with self.lock:
+                self.failed += 1
+        finally:
+            self.slots.release()
+
+    def unlink(self, path, is_dir, size):
+        if self.journal:
+            self.journal.intent(path, is_dir)
+        try:
+            if is_dir:
+                shutil.rmtree(path)
+                self.logger.info(f"Deleted folder {path}")
+            else:
+                os.remove(path)
+                self.logger.info(f"Deleted file {path}")
+        except FileNotFoundError:
+            self.logger.debug(f"{path} does not exist")
+            if self.journal:
+                self.journal.write("missing", path)
+            self.progress(0)
+            return
+        except Exception as e:
+            if self.journal:
+                self.journal.write("failed", path, error=str(e))
+            raise
+
+        if self.journal:
+            self.journal.write("deleted", path, size=size)
+        self.progress(size)
+
+    def progress(self, size):
+        with self.lock:
+            self.deleted += 1
+            self.freed += size
+            if time.monotonic() - self.reported < self.interval:
+                return
+            self.reported = time.monotonic()
+            deleted, planned, freed = self.deleted, self.planned, self.freed
+        verb = "Would delete" if self.dry_run else "Deleted"
+        self.logger.info(
+            f"{verb} {deleted} of {planned} items so far, "
+            f"{utils.format_bytes(freed)} freed"
+        )
+
+    def close(self, cancel=False):
+        """
+        Wait for the queued deletions and report the totals
+        :param cancel: drop the deletions that did not start yet
+        :return: (items deleted, bytes freed)
+        """
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+        if self.planned:
+            freed = utils.format_bytes(self.freed)
+            if self.dry_run:
+                self.logger.info(f"Would delete {self.deleted} items and free {freed}")
+            else:
+                failed = f", {self.failed} failed" if self.failed else ""
+                self.logger.info(
+                    f"Deleted {self.deleted} of {self.planned} items and freed "
+                    f"{freed}{failed}"
+                )
+        return self.deleted, self.freed
+
+
+def freed_bytes(path):
+    """
+    :return: size of the files below `path` that have no other link
+    """
+
+    def size(st):
+        if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+            return st.st_size
+        return 0
+
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return 0
+    if not stat.S_ISDIR(st.st_mode):
+        return size(st)
+
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        total += size(entry.stat(follow_symlinks=False))
+        except OSError:
+            continue
+    return total
+
+
+def add_arguments(parser):
+    """
+    Options of the deletion pool, shared by the commands deleting data
+    """
+    parser.add_argument(
+        "--delete-workers",
+        type=int,
+        default=8,
+        help="Maximum number of files and folders deleted concurrently",
+    )
+    parser.add_argument(
+        "--device-concurrency",
+        type=int,
+        default=4,
+        help="Maximum number of concurrent deletions on the same device",
+    )
+    parser.add_argument(
+        "--delete-rate",
+        type=float,
+        default=0,
+        help="Maximum number of deletions started per second, 0 for no limit",
+    )
@@ -0,0 +1,61 @@
+import asyncio
+import utils
+
+
+class FileLists:
+    """
+    Fetch the file lists of many torrents concurrently through an `AsyncClient`
+
+    The file list of a completed torrent never changes, so it is cached on disk by
+    infohash and only fetched once, in the state store when one is given.
+    """
+
+    def __init__(self, client, cache_file=None, store=None):
+        self.client = client
+        self.cache_file = cache_file
+        self.store = store
+        if store:
+            self.cache = store.files()
+        else:
+            self.cache = utils.load_json(cache_file, {}) if cache_file else {}
+
+    async def fetch(self, torrents):
+        """
+        Get the file names of torrents, relative to their save path
+        :param torrents: torrents to get the files of
+        :return: hash -> list of file names
+        """
+        torrents = list(torrents)
+        missing = [t for t in torrents if t.hash not in self.cache]
+
+        fetched = {}
+        results = await asyncio.gather(*(self.fetch_one(t) for t in missing))
+        for t, names in zip(missing, results):
+            fetched[t.hash] = names
+            if names and t.state_enum.is_complete:
+                self.cache[t.hash] = names
+
+        # Forget torrents that were removed from qBittorrent
+        hashes = {t.hash for t in torrents}
+        self.cache = {h: names for h, names in self.cache.items() if h in hashes}
+
+        return {
+            t.hash: fetched.get(t.hash) or self.cache.get(t.hash, []) for t in torrents
+        }
+
+    async def fetch_one(self, torrent):
+        import httpx
+
+        try:
+            files = await self.client.torrents_files(torrent.hash)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return []
+            raise
+        return [file["name"] for file in files]
+
+    def save(self):
+        if self.store:
+            self.store.save_files(self.cache)
+        elif self.cache_file:
+            utils.save_json(self.cache_file, self.cache)
@@ -0,0 +1,136 @@
+import os
+import mmap
+import asyncio
+import hashlib
+import collections
+import utils
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Files up to this size are hashed whole, larger ones by a sample at the start,
+# the middle and the end
+SAMPLE_SIZE = 64 * 1024
+WHOLE_FILE_SIZE = 3 * SAMPLE_SIZE
+
+Torrent = collections.namedtuple("Torrent", ["hash", "size", "save_path"])
+
+
+class DuplicateFinder:
+    """
+    Find completed torrents with identical content stored under different paths
+
+    Torrents are grouped by total size, then by the multiset of their file sizes,
+    and only torrents still sharing a group are read from disk. A file is identified
+    by its inode, so hardlinked copies are read once, and otherwise by a hash of
+    samples read through a memory map. File lists and fingerprints are cached by
+    infohash, the content of a completed torrent does not change.
+    """
+
+    def __init__(self, client, cache_file=None, workers=8):
+        self.client = client
+        self.cache_file = cache_file
+        self.workers = workers
+        self.cache = utils.load_json(cache_file, {}) if cache_file else {}
+        self.inodes = {}
+
+    async def find(self, torrents):
+        """
+        :param torrents: `Torrent` of every completed torrent, in evaluation order
+        :return: hashes of the torrents with the same content as an earlier one
+        """
+        torrents = list(torrents)
+
+        by_size = collections.defaultdict(list)
+        for t in torrents:
+            by_size[t.size].append(t)
+        candidates = [t for group in by_size.values() if len(group) > 1 for t in group]
+
+        missing = [t for t in candidates if t.hash not in self.cache]
+        results = await asyncio.gather(*(self.fetch_files(t) for t in missing))
+        for t, files in zip(missing, results):
+            if files:
+                self.cache[t.hash] = dict(files=files, fingerprint=None)
+
+        # Forget torrents that were removed from qBittorrent or no longer complete
+        hashes = {t.hash for t in torrents}
+        self.cache = {h: entry for h, entry in self.cache.items() if h in hashes}
+
+        by_files = collections.defaultdict(list)
+        for t in candidates:
+            if t.hash in self.cache:
+                sizes = sorted(size for _, size in self.cache[t.hash]["files"])
+                by_files[(t.size, *sizes)].append(t)
+        candidates = [t for group in by_files.values() if len(group) > 1 for t in group]
+
+        pending = [t for t in candidates if not self.cache[t.hash]["fingerprint"]]
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            fingerprints = await asyncio.gather(
+                *(loop.run_in_executor(executor, self.fingerprint, t) for t in pending)
+            )
+        for t, fingerprint in zip(pending, fingerprints):
+            self.cache[t.hash]["fingerprint"] = fingerprint
+
+        seen = set()
+        duplicates = set()
+        for t in candidates:
+            fingerprint = self.cache[t.hash]["fingerprint"]
+            if not fingerprint:
+                continue
+            if fingerprint in seen:
+                duplicates.add(t.hash)
+            seen.add(fingerprint)
+        return duplicates
+
+    async def fetch_files(self, torrent):
+        import httpx
+
+        try:
+            files = await self.client.torrents_files(torrent.hash)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return []
+            raise
+        return [[file["name"], file["size"]] for file in files]
+
+    def fingerprint(self, torrent):
+        """
+        :return: digest of the content of the files, or None when a file is missing
+        """
+        digests = []
+        for name, size in self.cache[torrent.hash]["files"]:
+            path = os.path.join(torrent.save_path, name)
+            try:
+                st = os.stat(path)
+                if st.st_size != size:
+                    return None
+                inode = (st.st_dev, st.st_ino)
+                if inode not in self.inodes:
+                    self.inodes[inode] = sample_hash(path, size)
+            except OSError:
+                return None
+            digests.append(self.inodes[inode])
+
+        # Files are compared as a multiset, their names may differ between copies
+        digest = hashlib.blake2b(digest_size=16)
+        for file_digest in sorted(digests):
+            digest.update(file_digest.encode())
+        return digest.hexdigest()
+
+    def save(self):
+        if self.cache_file:
+            utils.save_json(self.cache_file, self.cache)
+
+
+def sample_hash(path, size):
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    if size:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as m:
+            if size <= WHOLE_FILE_SIZE:
+                digest.update(m)
+            else:
+                for offset in (0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE):
+                    digest.update(m[offset : offset + SAMPLE_SIZE])
+    return digest.hexdigest()
@@ -0,0 +1,186 @@
+import os
+import time
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InstanceLogger(logging.LoggerAdapter):
+    """Prefix every message with the name of the instance"""
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['name']}] {msg}", kwargs
+
+
+def arguments(options):
+    """
+    Turn the options of an instance into command line arguments
+    :param options: option names without dashes and their values, `True` for flags
+        and a list for options taking several values
+    :return: list of arguments
+    """
+    args = []
+    for key, value in options.items():
+        if value is None or value is False:
+            continue
+        if value is True:
+            args.append(f"--{key}")
+        elif isinstance(value, list):
+            args += [f"--{key}", *map(str, value)]
+        else:
+            args.append(f"--{key}={value}")
+    return args
+
+
+def load(app, parser, argv):
+    """
+    Build the namespace of every selected instance of the `instances` section
+
+    An instance has a `name`, its connection settings (`server`, `port`, `username`,
+    `password`) and may override any other option of the command, like `state-db`.
+    The options are parsed by the command parser after the command line, so they
+    get the same types and checks. The state and cache files it does not override
+    get the instance name as suffix, so concurrent instances never share them.
+    :param parser: parser of the command line
+    :param argv: command line arguments
+    :return: list of namespaces
+    """
+    configured = app.config.get("instances") or []
+    names = [instance.get("name") for instance in configured]
+    if not all(names) or len(set(names)) != len(names):
+        raise ValueError("Every instance needs a unique name")
+
+    unknown = set(app.instances) - set(names)
+    if unknown:
+        raise ValueError(f"Unknown instances: {', '.join(sorted(unknown))}")
+
+    instances = []
+    for options in configured:
+        if app.instances and options["name"] not in app.instances:
+            continue
+
+        overrides = {k: v for k, v in options.items() if k != "name"}
+        try:
+            instance = parser.parse_args([*argv, *arguments(overrides)])
+        except SystemExit:
+            # The parser printed the invalid option
+            raise ValueError(f"Invalid options of instance {options['name']}")
+        instance.name = options["name"]
+        instance.config = app.config
+
+        overridden = {key.replace("-", "_") for key in overrides}
+        for name, value in vars(instance).items():
+            if name in overridden:
+                continue
+            if value and (name == "state_db" or name.endswith("_file")):
+                root, ext = os.path.splitext(value)
+                setattr(instance, name, f"{root}-{instance.name}{ext}")
+
+        if not instance.server or not instance.port:
+            raise ValueError(f"Instance {instance.name} needs a server and a port")
+        instances.append(instance)
+
+    if not instances:
+        raise ValueError("No instances configured in the instances section")
+    return instances
+
+
+def run(app, mod, logger, connect, parser, argv):
+    """
+    Run a command against every selected instance on a pool of `workers` threads
+    :param mod: command module
+    :param connect: function returning the authenticated client of a namespace
+    :param parser: parser of the command line, see `load`
+    :param argv: command line arguments
+    :return: exit status, 1 when the command failed on any instance
+    """
+    instances = [
+        (instance, InstanceLogger(logger, dict(name=instance.name)))
+        for instance in load(app, parser, argv)
+    ]
+    workers = app.workers
+    # Looping commands never return, every instance needs a worker of its own
+    if app.command == "daemon" or hasattr(mod, "run"):
+        workers = max(workers, len(instances))
+
+    logger.info(
+        f"Running {app.command} on {len(instances)} instances with {workers} workers"
+    )
+    started = time.perf_counter()
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            connected = list(executor.map(lambda i: setup(*i, connect, mod), instances))
+            failed = [i for (i, _), ok in zip(instances, connected) if not ok]
+            targets = [(i, log) for (i, log), ok in zip(instances, connected) if ok]
+
+            # Commands needing the state of every instance at once fan out themselves
+            if hasattr(mod, "run_instances") and failed:
+                logger.error(f"Skipping {app.command}, it needs every instance")
+            elif hasattr(mod, "run_instances"):
+                failed += mod.run_instances(targets, executor)
+            else:
+                results = executor.map(lambda i: execute(*i, mod), targets)
+                failed += [i for (i, _), ok in zip(targets, results) if not ok]
+        finally:
+            for instance, instance_logger in instances:
+                teardown(instance, instance_logger)
+
+    elapsed = time.perf_counter() - started
+    if failed:
+        logger.error(
+            f"{app.command} failed on {len(failed)} of {len(instances)} instances "
+            f"in {elapsed:.1f}s: {', '.join(i.name for i in failed)}"
+        )
+        return 1
+    logger.info(
+        f"{app.command} finished on {len(instances)} instances in {elapsed:.1f}s"
+    )
+    return 0
+
+
+def setup(instance, logger, connect, mod):
+    """
+    Connect to the instance and load its state store
+    :param mod: command module, its tracker lists are only synced when it reads them
+    :return: True when the instance is ready
+    """
+    try:
+        instance.client = connect(instance, logger)
+        if instance.state_db:
+            import store
+
+            instance.store = instance.snapshot = store.Store(instance.state_db)
+            instance.store.update(
+                instance.client, trackers=getattr(mod, "TRACKERS", True)
+            )
+    except SystemExit:
+        # The error was logged when connecting
+        return False
+    except Exception:
+        logger.error("Error connecting to the instance", exc_info=True)
+        return False
+    return True
+
+
+def execute(instance, logger, mod):
+    started = time.perf_counter()
+    try:
+        mod.__init__(instance, logger)
+    except (Exception, SystemExit):
+        logger.error(f"Error executing command: {instance.command}", exc_info=True)
+        return False
+    logger.info(f"Finished in {time.perf_counter() - started:.1f}s")
+    return True
+
+
+def teardown(instance, logger):
+    try:
+        if instance.aio:
+            instance.aio.close()
+        if instance.store:
+            instance.store.close()
+        if getattr(instance, "client", None):
+            instance.client.auth_log_out()
+    except Exception as e:
+        logger.error(f"Error closing the instance: {e}")
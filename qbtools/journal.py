@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import threading
+
+# A journal larger than this is moved to a `.1` file, replacing the older one,
+# before a run is appended to it
+MAX_BYTES = 8 * 2**20
+
+
+class Journal:
+    """
+    Append-only journal of the deletions of the orphaned runs
+
+    Every deletion is written, and synced to disk, before it is attempted and its
+    outcome after it, from any thread. A run starts with a `start` record and a
+    finished run ends with an `end` record, so the journal of a crashed run tells
+    exactly what it removed and what it was removing when it stopped. Runs are
+    appended after the previous ones, the entries of the last run are read before.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.previous = last_run(read(path)) if path else []
+        self.stream = None
+        self.lock = threading.Lock()
+
+    def interrupted(self):
+        """
+        :return: True when the previous run stopped without finishing
+        """
+        return bool(self.previous) and self.previous[-1].get("event") != "end"
+
+    def summary(self):
+        """
+        :return: (paths removed, paths being removed without an outcome) by the
+            previous run
+        """
+        removed = []
+        pending = {}
+        for entry in self.previous:
+            event, path = entry.get("event"), entry.get("path")
+            if event == "delete":
+                pending[path] = entry
+            elif event in ("deleted", "missing", "failed"):
+                pending.pop(path, None)
+                if event == "deleted":
+                    removed.append(path)
+        return removed, list(pending)
+
+    def start(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            if os.path.getsize(self.path) > MAX_BYTES:
+                os.replace(self.path, f"{self.path}.1")
+        except FileNotFoundError:
+            pass
+        self.stream = open(self.path, "a")
+        if not terminated(self.path):
+            # End the line a crash cut short, it must not swallow the next record
+            self.stream.write("\n")
+        self.write("start")
+
+    def write(self, event, path=None, sync=False, **extra):
+        if not self.stream:
+            return
+        entry = dict(event=event, time=round(time.time(), 3), **extra)
+        if path is not None:
+            entry["path"] = path
+        with self.lock:
+            self.stream.write(json.dumps(entry) + "\n")
+            self.stream.flush()
+            if sync:
+                os.fsync(self.stream.fileno())
+
+    def intent(self, path, is_dir):
+        self.write("delete", path, sync=True, dir=is_dir)
+
+    def close(self):
+        if self.stream:
+            self.write("end", sync=True)
+            self.stream.close()
+            self.stream = None
+
+
+def last_run(entries):
+    """
+    :return: entries from the last `start` record on
+    """
+    starts = [i for i, entry in enumerate(entries) if entry.get("event") == "start"]
+    return entries[starts[-1] :] if starts else entries
+
+
+def terminated(path):
+    """
+    :return: True when a file is empty or ends with a newline
+    """
+    with open(path, "rb") as stream:
+        if not stream.seek(0, os.SEEK_END):
+            return True
+        stream.seek(-1, os.SEEK_END)
+        return stream.read(1) == b"\n"
+
+
+def read(path):
+    """
+    :return: entries of a journal, a line cut short by a crash is left out
+    """
+    entries = []
+    try:
+        with open(path, "r") as stream:
+            for line in stream:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
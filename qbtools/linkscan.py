@@ -0,0 +1,151 @@
+import os
+import stat
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import utils
+
+# Files of a folder are checked by the worker listing it up to this many, the others
+# are checked in chunks of this size by the other workers
+FILES_PER_TASK = 256
+
+
+class LinkScanner:
+    """
+    Detect content paths containing hardlinks or symlinks
+
+    The folders of every content path are listed in parallel and the files of large
+    folders are checked in parallel chunks, so a single large content path is spread
+    over the workers too. The scan of a content path stops at its first linked file.
+    Results are cached by (inode, mtime, size) of the content path, so unchanged
+    content is not walked again until the cached result is older than `max_age`
+    seconds. The mtime of a folder only changes when entries are added to or removed
+    from it, a file below it gaining or losing a hardlink does not, so a cached result
+    can be stale for up to `max_age` seconds, 0 disables the cache. Paths not seen by
+    a run are forgotten.
+    """
+
+    def __init__(self, cache_file=None, workers=8, max_age=86400):
+        self.cache_file = cache_file
+        self.workers = workers
+        self.max_age = max_age
+        self.cache = utils.load_json(cache_file, {}) if cache_file else {}
+        self.seen = set()
+
+    def keep(self, paths):
+        """
+        Keep the cached results of content paths this run does not scan
+        """
+        self.seen.update(paths)
+
+    def scan(self, paths):
+        """
+        Check many content paths in parallel
+        :param paths: content paths to check
+        :return: content path -> linked
+        """
+        paths = list(set(paths))
+        self.seen.update(paths)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = dict(zip(paths, executor.map(self.check, paths)))
+            # Folders that are not cached get None and are walked together
+            folders = [path for path, linked in results.items() if linked is None]
+            results.update(walk(executor, folders))
+
+        now = int(time.time())
+        for path in folders:
+            self.cache[path][3:] = [results[path], now]
+        return results
+
+    def check(self, path):
+        """
+        :return: whether a content path is linked, or None when it has to be walked
+        """
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+
+        if stat.S_ISLNK(st.st_mode):
+            return True
+        if not stat.S_ISDIR(st.st_mode):
+            return st.st_nlink > 1
+
+        key = [st.st_ino, st.st_mtime_ns, st.st_size]
+        cached = self.cache.get(path)
+        if cached and cached[:3] == key and time.time() - cached[4] < self.max_age:
+            return cached[3]
+        self.cache[path] = key
+        return None
+
+    def save(self):
+        # Forget content paths of torrents that were removed from qBittorrent
+        self.cache = {p: entry for p, entry in self.cache.items() if p in self.seen}
+        if self.cache_file:
+            utils.save_json(self.cache_file, self.cache)
+
+
+def walk(executor, roots):
+    """
+    Walk many folders at once, every folder listing and chunk of files is a task
+    :return: root -> linked
+    """
+    linked = dict.fromkeys(roots, False)
+    pending = {executor.submit(list_folder, root): root for root in roots}
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            root = pending.pop(future)
+            result = future.result()
+            if linked[root]:
+                continue
+            if isinstance(result, bool):
+                linked[root] = result
+                continue
+
+            found, folders, chunks = result
+            if found:
+                linked[root] = True
+                continue
+            for folder in folders:
+                pending[executor.submit(list_folder, folder)] = root
+            for chunk in chunks:
+                pending[executor.submit(check_files, chunk)] = root
+    return linked
+
+
+def list_folder(path):
+    """
+    :return: (linked, subfolders, chunks of files left to check) of a folder
+    """
+    folders, files = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    return True, [], []
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                else:
+                    files.append(entry.path)
+    except OSError:
+        return False, [], []
+
+    chunks = utils.chunks(files, FILES_PER_TASK)
+    if chunks and check_files(chunks[0]):
+        return True, [], []
+    return False, folders, chunks[1:]
+
+
+def check_files(paths):
+    """
+    :return: True when any of the files has another link
+    """
+    for path in paths:
+        try:
+            if os.lstat(path).st_nlink > 1:
+                return True
+        except OSError:
+            continue
+    return False
@@ -0,0 +1,232 @@
+import time
+import logging
+import threading
+import collections
+
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    labels = ",".join(f'{n}="{escape(v)}"' for n, v in zip(names, values))
+    return f"{{{labels}}}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = collections.defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self.lock:
+            self.values[key] += amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{format_labels(self.labels, key)} {value}"
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self.lock:
+            buckets, count, total = self.values.get(
+                key, ([0] * len(self.buckets), 0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    buckets[i] += 1
+            self.values[key] = (buckets, count + 1, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = {k: (list(b), c, t) for k, (b, c, t) in self.values.items()}
+        names = self.labels + ["le"]
+        for key, (buckets, count, total) in sorted(values.items()):
+            for bound, value in zip(self.buckets, buckets):
+                yield f"{self.name}_bucket{format_labels(names, key + (bound,))} {value}"
+            yield f"{self.name}_bucket{format_labels(names, key + ('+Inf',))} {count}"
+            yield f"{self.name}_sum{format_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(
+    Counter(
+        "qbtools_api_requests_total",
+        "API requests sent",
+        ["service", "endpoint", "method", "status"],
+    )
+)
+SENT_BYTES = REGISTRY.register(
+    Counter(
+        "qbtools_api_sent_bytes_total",
+        "Bytes sent in API request bodies",
+        ["service", "endpoint"],
+    )
+)
+RECEIVED_BYTES = REGISTRY.register(
+    Counter(
+        "qbtools_api_received_bytes_total",
+        "Bytes received in API response bodies",
+        ["service", "endpoint"],
+    )
+)
+LATENCY = REGISTRY.register(
+    Histogram(
+        "qbtools_api_request_duration_seconds",
+        "API request latency",
+        ["service", "endpoint"],
+    )
+)
+TRACKER_MESSAGES = REGISTRY.register(
+    Counter(
+        "qbtools_tracker_messages_total",
+        "Torrents whose tracker messages matched a category",
+        ["category"],
+    )
+)
+PHASES = REGISTRY.register(
+    Histogram(
+        "qbtools_phase_duration_seconds",
+        "Duration of command phases",
+        ["command", "phase"],
+    )
+)
+
+
+def endpoint(url):
+    path = urlsplit(str(url)).path
+    return path.split("/api/v2/", 1)[-1]
+
+
+def observe_request(service, endpoint, method, status, seconds, sent, received):
+    REQUESTS.inc(service=service, endpoint=endpoint, method=method, status=status)
+    SENT_BYTES.inc(sent, service=service, endpoint=endpoint)
+    RECEIVED_BYTES.inc(received, service=service, endpoint=endpoint)
+    LATENCY.observe(seconds, service=service, endpoint=endpoint)
+
+
+def requests_hook(response, *args, **kwargs):
+    """Response hook counting the requests of the synchronous qBittorrent client"""
+    body = response.request.body or b""
+    observe_request(
+        "qbittorrent",
+        endpoint(response.url),
+        response.request.method,
+        response.status_code,
+        response.elapsed.total_seconds(),
+        len(body),
+        len(response.content),
+    )
+
+
+class Timer:
+    """
+    Time the consecutive phases of a command
+
+    Calling `phase` ends the running phase and starts the next one, `stop` ends it
+    and records how long every phase took. Time spent in one phase while another is
+    running, like pulling the batches of a lazy stream, is moved with `credit`.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.current = None
+        self.started = None
+        self.totals = {}
+
+    def phase(self, name):
+        self.end()
+        self.current = name
+        self.started = time.perf_counter()
+
+    def credit(self, name, seconds):
+        """
+        Count `seconds` spent while the running phase goes on under phase `name`
+        """
+        self.totals[name] = self.totals.get(name, 0) + seconds
+        if self.current:
+            self.started += seconds
+
+    def end(self):
+        if self.current:
+            seconds = time.perf_counter() - self.started
+            self.totals[self.current] = self.totals.get(self.current, 0) + seconds
+        self.current = None
+
+    def stop(self):
+        self.end()
+        for name, seconds in self.totals.items():
+            PHASES.observe(seconds, command=self.command, phase=name)
+            logger.debug(f"{self.command} {name} took {seconds:.3f}s")
+        self.totals = {}
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlsplit(self.path).path != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
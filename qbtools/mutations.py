@@ -0,0 +1,76 @@
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+
+def plan_direction(changes, chunk_size):
+    """
+    Plan the requests for one direction (adding or removing tags)
+    :param changes: tag -> hashes to change
+    :param chunk_size: maximum number of hashes per request
+    :return: list of (tags, hashes) requests
+    """
+    per_tag = [
+        ([tag], chunk)
+        for tag, hashes in sorted(changes.items())
+        for chunk in utils.chunks(sorted(hashes), chunk_size)
+    ]
+
+    # Torrents sharing the same delta can be changed with a single request
+    deltas = collections.defaultdict(set)
+    for tag, hashes in changes.items():
+        for torrent_hash in hashes:
+            deltas[torrent_hash].add(tag)
+
+    groups = collections.defaultdict(set)
+    for torrent_hash, tags in deltas.items():
+        groups[tuple(sorted(tags))].add(torrent_hash)
+
+    per_delta = [
+        (list(tags), chunk)
+        for tags, hashes in sorted(groups.items())
+        for chunk in utils.chunks(sorted(hashes), chunk_size)
+    ]
+
+    return per_delta if len(per_delta) < len(per_tag) else per_tag
+
+
+def plan(additions, removals, chunk_size):
+    """
+    Compute the smallest set of requests applying all tag changes at once
+    :param additions: tag -> hashes that should get the tag
+    :param removals: tag -> hashes that should lose the tag
+    :param chunk_size: maximum number of hashes per request
+    :return: list of (method, tags, hashes) requests
+    """
+    return [
+        ("torrents_remove_tags", tags, hashes)
+        for tags, hashes in plan_direction(removals, chunk_size)
+    ] + [
+        ("torrents_add_tags", tags, hashes)
+        for tags, hashes in plan_direction(additions, chunk_size)
+    ]
+
+
+def baseline(additions, removals, chunk_size):
+    """
+    One request per tag and direction, as issued before planning, with the hashes
+    of a tag split in requests of at most `chunk_size` hashes like `plan` does
+    """
+    return sum(
+        -(-len(hashes) // chunk_size)
+        for changes in (additions, removals)
+        for hashes in changes.values()
+    )
+
+
+def apply(client, operations, workers):
+    def request(operation):
+        method, tags, hashes = operation
+        getattr(client, method)(tags=tags, torrent_hashes=hashes)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Consume the results so errors are raised here
+        list(executor.map(request, operations))
@@ -1,18 +1,38 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import utils
 import importlib
-import qbittorrentapi
 import argparse
 import logging
-import yaml
 import sys
 
 logger = logging.getLogger(__name__)
 
+# Lightweight metadata of the commands, a command module is only imported when the
+# command is selected
+COMMANDS = {
+    "daemon": "Run the commands configured in the daemon section on their intervals",
+    "limiter": "Limit speeds while SABnzbd is downloading",
+    "orphaned": "Delete files not owned by any torrent",
+    "prune": "Delete torrents matching tags",
+    "reannounce": "Reannounce stalled torrents",
+    "tagging": "Tag torrents",
+}
 
-def add_default_args(parser):
+
+def __getattr__(name):
+    """
+    Import the shared modules on first use, so `from qbtools import x` in a command
+    only loads what the command needs
+    """
+    if os.path.isfile(os.path.join(os.path.dirname(__file__), f"{name}.py")):
+        return importlib.import_module(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def add_default_args(parser, instances=False):
     parser.add_argument(
         "-c",
         "--config",
@@ -25,7 +45,7 @@ def add_default_args(parser):
         action=utils.EnvDefault,
         envvar="QBITTORRENT_HOST",
         help="qBittorrent server address",
-        required=True,
+        required=not instances,
     )
     parser.add_argument(
         "-p",
@@ -33,7 +53,7 @@ def add_default_args(parser):
         action=utils.EnvDefault,
         envvar="QBITTORRENT_PORT",
         help="qBittorrent server port",
-        required=True,
+        required=not instances,
     )
     parser.add_argument(
         "-U",
@@ -51,10 +71,65 @@ def add_default_args(parser):
         help="Password for qBittorrent",
         required=False,
     )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=10,
+        help="Maximum number of connections kept open to qBittorrent",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of concurrent requests sent to qBittorrent",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        action=utils.EnvDefault,
+        envvar="QBTOOLS_METRICS_PORT",
+        type=int,
+        help="Serve Prometheus metrics on this port at /metrics",
+        required=False,
+    )
+    parser.add_argument(
+        "--metrics-host",
+        default="0.0.0.0",
+        help="Address the metrics endpoint listens on",
+    )
+    parser.add_argument(
+        "--state-db",
+        action=utils.EnvDefault,
+        envvar="QBTOOLS_STATE_DB",
+        help="Keep a local SQLite copy of the torrents in this file and read from it",
+        required=False,
+    )
+    parser.add_argument(
+        "--instances",
+        nargs="*",
+        metavar="NAME",
+        help="Run against the configured instances, all of them when no names are given",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Maximum number of instances processed concurrently",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Report the import time of each module",
+    )
+
+
+def selected_command(argv):
+    # The main parser has no options taking values, the first positional is the command
+    return next((arg for arg in argv if not arg.startswith("-")), None)
 
 
-def load_commands(subparsers):
+def load_commands(subparsers, argv):
     directory = "commands"
+    selected = selected_command(argv)
 
     def load_command(command):
         try:
@@ -62,24 +137,31 @@ def load_commands(subparsers):
             mod.add_arguments(command, subparsers)
             subparser = subparsers.choices.get(command)
             if subparser:
-                add_default_args(subparser)
+                # The instances section provides the servers
+                add_default_args(subparser, instances="--instances" in argv)
         except ImportError:
             logger.error(f"Error loading module: {command}", exc_info=True)
             sys.exit(1)
         else:
             globals()[command] = mod
 
-    for cmd in os.listdir(f"{os.path.dirname(__file__)}/{directory}"):
-        if cmd.startswith("__") or not cmd.endswith(".py"):
-            continue
-        load_command(cmd[:-3])
+    for cmd, description in COMMANDS.items():
+        if cmd == selected:
+            load_command(cmd)
+        else:
+            subparsers.add_parser(cmd, help=description, add_help=False)
+
 
+def qbit_client(app, logger=logger):
+    import metrics
+    import qbittorrentapi
 
-def qbit_client(app):
     client = qbittorrentapi.Client(
         host=f"{app.server}:{app.port}",
         username=app.username,
         password=app.password,
+        HTTPADAPTER_ARGS=dict(pool_connections=1, pool_maxsize=app.pool_size),
+        REQUESTS_ARGS=dict(hooks=dict(response=[metrics.requests_hook])),
     )
 
     try:
@@ -95,6 +177,8 @@ def qbit_client(app):
 
 
 def get_config(app):
+    import yaml
+
     try:
         with open(app.config, "r") as stream:
             config = yaml.safe_load(stream)
@@ -109,6 +193,11 @@ def get_config(app):
 
 
 def main():
+    started = time.perf_counter()
+    profiler = None
+    if "--profile-startup" in sys.argv:
+        profiler = utils.ImportProfiler().install()
+
     logging.getLogger("filelock").setLevel(logging.ERROR)  # Suppress lock messages
     logging.getLogger("httpx").setLevel(logging.ERROR)  # Suppress httpx messages
     logging.basicConfig(
@@ -119,24 +208,57 @@ def main():
     )
 
     parser = argparse.ArgumentParser(description="qBittorrent API Client")
+    parser.set_defaults(snapshot=None, store=None, aio=None)
     subparsers = parser.add_subparsers(dest="command")
-    load_commands(subparsers)  # Load all commands
+    load_commands(subparsers, sys.argv[1:])  # Load the selected command
     app = parser.parse_args()
 
     if not app.command:
         parser.print_help()
         sys.exit(1)
 
-    app.client = qbit_client(app)
+    if app.metrics_port:
+        import metrics
+
+        metrics.serve(app.metrics_host, app.metrics_port)
+
     app.config = get_config(app)
+    mod = globals()[app.command]
+
+    if app.instances is not None:
+        import instances
+
+        try:
+            status = instances.run(app, mod, logger, qbit_client, parser, sys.argv[1:])
+        except ValueError as e:
+            logger.error(f"Invalid instances configuration: {e}")
+            status = 1
+        sys.exit(status)
+
+    app.client = qbit_client(app)
+
+    if app.state_db:
+        import store
+
+        # The store answers the same queries as a snapshot
+        app.store = app.snapshot = store.Store(app.state_db)
+        app.store.update(app.client, trackers=getattr(mod, "TRACKERS", True))
+
+    if profiler:
+        profiler.uninstall()
+        profiler.report(logger)
+        logger.info(f"Startup took {(time.perf_counter() - started) * 1000:.1f} ms")
 
     try:
-        mod = globals()[app.command]
         mod.__init__(app, logger)
     except Exception:
         logger.error(f"Error executing command: {app.command}", exc_info=True)
         sys.exit(1)
     finally:
+        if app.aio:
+            app.aio.close()
+        if app.store:
+            app.store.close()
         app.client.auth_log_out()
 
 
@@ -0,0 +1,123 @@
+import utils
+
+# More requests than this cost more than filtering one full listing locally
+MAX_REQUESTS = 8
+
+
+class Plan:
+    """
+    Server-side filtered `torrents/info` requests and the predicates left to check
+
+    The endpoint takes a single category, a single tag and a list of hashes per
+    request, so only part of the selectors can be pushed down to it.
+    """
+
+    def __init__(self, requests, categories=None, tags=(), hashes=None):
+        """
+        :param requests: filters of each request, a subset of category, tag and hashes
+        :param categories: categories a torrent must be in, None for any
+        :param tags: tags a torrent must all have
+        :param hashes: hashes a torrent must be one of, None for any
+        """
+        self.requests = requests
+        self.categories = categories
+        self.tags = set(tags)
+        self.hashes = hashes
+
+    def matches(self, torrent, pushed=None):
+        """
+        :param pushed: filters the server already applied to the torrent
+        """
+        pushed = pushed or {}
+        if self.categories is not None and "category" not in pushed:
+            if torrent.category not in self.categories:
+                return False
+        if self.hashes is not None and "hashes" not in pushed:
+            if torrent.hash not in self.hashes:
+                return False
+        return self.tags.issubset(utils.split_tags(torrent.tags) | {pushed.get("tag")})
+
+    def merge(self, results):
+        """
+        Merge the torrents of all requests and apply the leftover predicates
+        :param results: list of torrents of each request, in the order of `requests`
+        """
+        torrents = {}
+        for params, result in zip(self.requests, results):
+            for t in result:
+                if t.hash not in torrents and self.matches(t, params):
+                    torrents[t.hash] = t
+        return list(torrents.values())
+
+    async def stream(self, client, fields, **params):
+        """
+        Run the requests one after the other, decoding torrents as they arrive
+        :param fields: fields of the records, besides those the plan checks
+        :return: async generator of lists of records
+        """
+        fields = ("category", "tags", *fields)
+        seen = set()
+        for request in self.requests:
+            async for batch in client.torrents_stream(
+                fields, **encode(request), **params
+            ):
+                batch = [
+                    t for t in batch if t.hash not in seen and self.matches(t, request)
+                ]
+                seen.update(t.hash for t in batch)
+                if batch:
+                    yield batch
+
+    def select(self, source, client):
+        """
+        Run the requests against a local `Snapshot` or `Store`
+        """
+        return self.merge(
+            [source.torrents_info(client, **request) for request in self.requests]
+        )
+
+
+def encode(request):
+    if "hashes" in request:
+        request = dict(request, hashes="|".join(request["hashes"]))
+    return request
+
+
+def plan(categories=None, tags=(), hashes=None, all_categories=None):
+    """
+    Plan the smallest set of requests selecting torrents
+    :param categories: categories to select, None for any
+    :param tags: tags a torrent must all have
+    :param hashes: hashes to select, None for any
+    :param all_categories: every category of the client, to tell whether filtering
+        by category excludes anything
+    :return: `Plan`
+    """
+    tags = sorted(tags)
+    categories = None if categories is None else sorted(set(categories))
+
+    request = {}
+    if hashes is not None:
+        hashes = set(hashes)
+        request["hashes"] = sorted(hashes)
+    if tags:
+        request["tag"] = tags[0]
+
+    if categories is None:
+        requests = [request]
+    elif not categories or (hashes is not None and not hashes):
+        requests = []
+    elif len(categories) == 1:
+        requests = [dict(request, category=categories[0])]
+    elif (
+        "tag" not in request
+        and "hashes" not in request
+        and len(categories) <= MAX_REQUESTS
+        and set(categories) != set(all_categories or [])
+    ):
+        # One request per category only pays off when nothing narrower is pushed down
+        requests = [dict(request, category=category) for category in categories]
+    else:
+        requests = [request]
+
+    return Plan(requests, categories, tags, hashes)
@@ -0,0 +1,141 @@
+import re
+import json
+import codecs
+import functools
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class ArrayDecoder:
+    """
+    Decode the elements of a JSON array incrementally from chunks of bytes
+
+    Only the undecoded tail of the response is buffered, so a large response never
+    has to be held in memory as a whole.
+    """
+
+    def __init__(self):
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.started = False
+        self.finished = False
+
+    def feed(self, data, final=False):
+        """
+        :param data: next chunk of the response
+        :param final: whether this is the last chunk
+        :return: list of the elements completed by this chunk
+        """
+        buffer = self.buffer + self.text.decode(data, final)
+        items = []
+        pos = 0
+        while not self.finished:
+            pos = WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if not self.started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                self.started = True
+                pos += 1
+            elif buffer[pos] == ",":
+                pos += 1
+            elif buffer[pos] == "]":
+                self.finished = True
+                pos += 1
+            else:
+                try:
+                    item, end = self.decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break  # The element continues in the next chunk
+                if end == len(buffer) and not final:
+                    break  # A number may have more digits in the next chunk
+                items.append(item)
+                pos = end
+
+        if final and not self.finished:
+            raise ValueError("Truncated JSON array")
+        self.buffer = buffer[pos:]
+        return items
+
+
+class Tracker:
+    __slots__ = ("url", "status", "tier", "msg")
+
+    def __init__(self, data):
+        for name in self.__slots__:
+            setattr(self, name, data.get(name))
+
+
+class Record:
+    """
+    Base of the compact torrent records, read like a `TorrentDictionary`
+
+    Subclasses made by `record_type` only keep the fields a command needs.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, data):
+        for name in self.__slots__:
+            value = data.get(name)
+            if name == "trackers" and value is not None:
+                value = tracker_list(
+                    tuple(tuple(map(s.get, Tracker.__slots__)) for s in value)
+                )
+            setattr(self, name, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    @property
+    def state_enum(self):
+        from qbittorrentapi import TorrentState
+
+        return TorrentState(self.state)
+
+
+@functools.lru_cache(maxsize=4096)
+def tracker_list(entries):
+    """
+    Torrents of a site mostly have the same trackers, statuses and messages, they
+    share one tuple instead of holding a copy each
+    :param entries: tuple of the values of the `Tracker` slots of every tracker
+    :return: tuple of `Tracker`
+    """
+    return tuple(Tracker(dict(zip(Tracker.__slots__, e))) for e in entries)
+
+
+@functools.lru_cache(maxsize=None)
+def record_type(fields):
+    """
+    :param fields: tuple of the fields to keep, the hash is always kept
+    :return: `Record` class with these slots
+    """
+    fields = tuple(sorted({"hash", *fields}))
+    return type("Torrent", (Record,), {"__slots__": fields})
+
+
+def trackers(torrent):
+    """
+    Trackers of a record or of a `TorrentDictionary`, fetched if not included
+    """
+    if isinstance(torrent, Record):
+        return torrent.trackers or []
+    if "trackers" in torrent:
+        from qbittorrentapi import TrackersList
+
+        return TrackersList(torrent.get("trackers"))
+    return torrent.trackers
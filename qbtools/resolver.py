@@ -0,0 +1,43 @@
+import functools
+import tldextract
+import utils
+
+from urllib.parse import urlsplit
+
+
+class TrackerResolver:
+    """
+    Resolve announce URLs to the `trackers` entries of the configuration
+
+    Registered domains are memoized per announce host and persisted in `cache_file`.
+    The public suffix list is only loaded, from the snapshot bundled with tldextract,
+    when a host is seen for the first time.
+    """
+
+    def __init__(self, trackers, cache_file=None):
+        self.sites = {url: tracker for tracker in trackers for url in tracker["urls"]}
+        self.cache_file = cache_file
+        self.domains = utils.load_json(cache_file, {}) if cache_file else {}
+        self.extract = None
+        self.site = functools.lru_cache(maxsize=4096)(self.resolve)
+
+    def domain(self, url):
+        host = urlsplit(url).hostname or url
+        if host not in self.domains:
+            if self.extract is None:
+                self.extract = tldextract.TLDExtract(
+                    cache_dir=None, suffix_list_urls=()
+                )
+            self.domains[host] = self.extract(host).registered_domain
+        return self.domains[host]
+
+    def resolve(self, url):
+        """
+        :param url: announce URL
+        :return: the matching tracker configuration, or None
+        """
+        return self.sites.get(self.domain(url or ""))
+
+    def save(self):
+        if self.cache_file:
+            utils.save_json(self.cache_file, self.domains)
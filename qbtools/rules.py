@@ -0,0 +1,230 @@
+import re
+import json
+import operator
+import itertools
+import numpy as np
+import utils
+
+from columns import Columns
+
+NUMERIC_FIELDS = {"added_on", "last_activity", "ratio", "seeding_time"}
+
+# Ages in days, computed from the timestamps or durations of the torrents
+DAYS_FIELDS = {
+    "added_days": "added_on",
+    "activity_days": "last_activity",
+    "seeding_days": "seeding_time",
+}
+
+TEXT_FIELDS = {
+    "category",
+    "content_path",
+    "message",
+    "save_path",
+    "site",
+    "state",
+    "tags",
+    "tracker",
+}
+
+BOOLEAN_FIELDS = {"working"}
+
+# Ages of timestamps change with the current time and the seeding counters with every
+# sync, a torrent is not reported as changed for them
+TIMED_FIELDS = {
+    "activity_days",
+    "added_days",
+    "last_activity",
+    "ratio",
+    "seeding_days",
+    "seeding_time",
+}
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+OPERATORS = {*COMPARISONS, "in", "not_in", "contains", "matches"}
+
+
+def compile_condition(condition):
+    """
+    Compile a condition of the rules section into a function of `Columns`
+
+    A condition is a mapping of field names to predicates, which must all match,
+    or one of `all: [conditions]`, `any: [conditions]` and `not: condition`. A
+    predicate is a mapping of operators to values, a plain value for `==` or a list
+    of values for `in`. `contains` and `matches` ignore case, `contains` on `tags`
+    matches whole tags.
+    :return: function returning the boolean mask of the matching torrents
+    """
+    if not isinstance(condition, dict) or not condition:
+        raise ValueError(f"Invalid condition: {condition!r}")
+
+    parts = []
+    for key, value in condition.items():
+        if key in ("all", "any"):
+            if not isinstance(value, list) or not value:
+                raise ValueError(f"{key} needs a list of conditions")
+            children = [compile_condition(c) for c in value]
+            combine = np.logical_and if key == "all" else np.logical_or
+            parts.append(reduce_masks(children, combine))
+        elif key == "not":
+            parts.append(negate(compile_condition(value)))
+        elif isinstance(value, dict):
+            parts.extend(compile_predicate(key, op, v) for op, v in value.items())
+        elif isinstance(value, list):
+            parts.append(compile_predicate(key, "in", value))
+        else:
+            parts.append(compile_predicate(key, "==", value))
+
+    return parts[0] if len(parts) == 1 else reduce_masks(parts, np.logical_and)
+
+
+def referenced(condition):
+    """
+    :return: names of the fields a condition reads
+    """
+    if isinstance(condition, list):
+        return set().union(*map(referenced, condition))
+    if not isinstance(condition, dict):
+        return set()
+    fields = set()
+    for key, value in condition.items():
+        if key in ("all", "any", "not"):
+            fields |= referenced(value)
+        else:
+            fields.add(key)
+    return fields
+
+
+def is_timed(rule):
+    """
+    :return: True when the result of a rule can change without the torrent changing
+    """
+    return isinstance(rule, dict) and bool(TIMED_FIELDS & referenced(rule.get("when")))
+
+
+def reduce_masks(functions, combine):
+    def evaluate(columns):
+        mask = functions[0](columns)
+        for function in functions[1:]:
+            mask = combine(mask, function(columns))
+        return mask
+
+    return evaluate
+
+
+def negate(function):
+    return lambda columns: ~function(columns)
+
+
+def compile_predicate(field, op, value):
+    if op not in OPERATORS:
+        raise ValueError(f"Unknown operator {op} for {field}")
+    if op in ("in", "not_in") and not isinstance(value, list):
+        value = [value]
+    key = json.dumps([field, op, value], sort_keys=True)
+
+    if field in NUMERIC_FIELDS or field in DAYS_FIELDS:
+        if op in COMPARISONS:
+            test = lambda column: COMPARISONS[op](column, float(value))
+        elif op in ("in", "not_in"):
+            test = lambda column: np.isin(column, [float(v) for v in value])
+        else:
+            raise ValueError(f"Operator {op} is not supported for {field}")
+        if op == "not_in":
+            test = negate(test)
+        extract = Columns.numeric
+        if field in DAYS_FIELDS:
+            extract = lambda columns, field: columns.days(DAYS_FIELDS[field])
+    elif field in TEXT_FIELDS:
+        test = text_predicate(field, op, value)
+        extract = Columns.text
+    elif field in BOOLEAN_FIELDS:
+        if op not in ("==", "!="):
+            raise ValueError(f"Operator {op} is not supported for {field}")
+        test = lambda column: (column == bool(value)) == (op == "==")
+        extract = Columns.boolean
+    else:
+        raise ValueError(f"Unknown field: {field}")
+
+    def evaluate(columns):
+        if key not in columns.results:
+            columns.results[key] = test(extract(columns, field))
+        return columns.results[key]
+
+    return evaluate
+
+
+def text_predicate(field, op, value):
+    """
+    :return: function of (codes, distinct values) returning the mask of the torrents
+    """
+    # The matches of the distinct values are mapped by builtins where possible, a
+    # text column of paths or names has about one distinct value per torrent
+    invert = op in ("not_in", "!=")
+    if op == "contains" and field == "tags":
+        needle = str(value).lower()
+        match = lambda v: needle in {tag.lower() for tag in utils.split_tags(v)}
+        matches = lambda distinct: map(match, distinct)
+    elif op == "contains":
+        needle = str(value).lower()
+        matches = lambda distinct: map(
+            operator.contains, map(str.lower, distinct), itertools.repeat(needle)
+        )
+    elif op == "matches":
+        search = re.compile(str(value), re.IGNORECASE).search
+        matches = lambda distinct: map(bool, map(search, distinct))
+    elif op in ("in", "not_in"):
+        matches = lambda distinct: map({str(v) for v in value}.__contains__, distinct)
+    elif op in ("==", "!="):
+        matches = lambda distinct: map(str(value).__eq__, distinct)
+    else:
+        compare = COMPARISONS[op]
+        matches = lambda distinct: map(compare, distinct, itertools.repeat(str(value)))
+
+    def test(column):
+        codes, distinct = column
+        hits = np.fromiter(matches(distinct), dtype=bool, count=len(distinct))
+        return ~hits[codes] if invert else hits[codes]
+
+    return test
+
+
+class RuleSet:
+    """
+    Tags defined by the rules section of the configuration, evaluated per batch
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: list of mappings with a `tag` and a `when` condition
+        """
+        self.rules = []
+        for rule in rules:
+            if not isinstance(rule, dict) or not rule.get("tag"):
+                raise ValueError(f"Rule without a tag: {rule!r}")
+            try:
+                self.rules.append((rule["tag"], compile_condition(rule.get("when"))))
+            except ValueError as e:
+                raise ValueError(f"Invalid rule for tag {rule['tag']}: {e}") from None
+        self.tags = {tag for tag, _ in self.rules}
+
+    def evaluate(self, columns):
+        """
+        :param columns: `Columns` of a batch of torrents
+        :return: tag -> hashes of the matching torrents, in the order of the rules
+        """
+        masks = {}
+        for tag, condition in self.rules:
+            mask = condition(columns)
+            # Rules sharing a tag add up
+            masks[tag] = masks[tag] | mask if tag in masks else mask
+
+        return {tag: columns.select(mask) for tag, mask in masks.items()}
@@ -0,0 +1,89 @@
+import os
+import time
+import hashlib
+
+import utils
+
+# Folders modified this close to the start of a scan may change again within the
+# resolution of their mtime, they are listed again by the next scan
+RACY_SECONDS = 2
+
+
+class ScanState:
+    """
+    Per-folder progress of the orphaned scans
+
+    A folder is recorded once its entries were checked without finding anything to
+    delete, with its mtime and a key of the names qBittorrent owns in it. Adding or
+    removing an entry changes the mtime of a folder and adding or removing a torrent
+    changes its key, so a later scan skips listing a folder when neither changed and
+    only descends into the subfolders it scanned last time. The state is saved every
+    `interval` seconds, an interrupted scan resumes from the folders it recorded.
+    """
+
+    def __init__(self, state_file=None, signature=None, interval=30, resume=True):
+        """
+        :param signature: options of the scan, the state of other options is discarded
+        :param resume: skip the folders recorded by previous scans
+        """
+        self.state_file = state_file
+        self.signature = signature
+        self.interval = interval
+        state = utils.load_json(state_file, {}) if state_file else {}
+        self.folders = {}
+        if resume and state.get("signature") == signature:
+            self.folders = state.get("folders", {})
+        self.visited = set()
+        self.skipped = 0
+        self.started = time.time()
+        self.saved = time.monotonic()
+
+    def unchanged(self, path, st, key):
+        """
+        :param st: stat of the folder, taken before it is listed
+        :return: names of the subfolders scanned last time, or None when the folder
+            has to be listed again
+        """
+        self.visited.add(path)
+        record = self.folders.get(path)
+        if record and record[0] == st.st_mtime_ns and record[1] == key:
+            self.skipped += 1
+            return record[2]
+        # Only a folder listed to the end without deleting anything is recorded again
+        self.folders.pop(path, None)
+        return None
+
+    def record(self, path, st, key, subfolders):
+        if st.st_mtime_ns < (self.started - RACY_SECONDS) * 1e9:
+            self.folders[path] = [st.st_mtime_ns, key, subfolders]
+        if time.monotonic() - self.saved >= self.interval:
+            self.save()
+
+    def save(self, complete=False):
+        """
+        :param complete: the scan finished, forget the folders it did not visit
+        """
+        if complete:
+            self.folders = {p: r for p, r in self.folders.items() if p in self.visited}
+        if self.state_file:
+            utils.save_json(
+                self.state_file, dict(signature=self.signature, folders=self.folders)
+            )
+        self.saved = time.monotonic()
+
+
+def key(node, owned):
+    """
+    :param node: trie node of a folder
+    :param owned: marker of the nodes owned by qBittorrent
+    :return: digest of the names below the folder and whether they are owned
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(node):
+        if name != owned:
+            digest.update(f"{name}\0{int(owned in node[name])}\0".encode())
+    return digest.hexdigest()
+
+
+def signature(completed_dir, exclude_patterns):
+    return [os.path.normpath(completed_dir), sorted(exclude_patterns)]
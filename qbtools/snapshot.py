@@ -0,0 +1,177 @@
+import qbittorrentapi
+import utils
+
+# Only the fields commands read are kept, so the snapshot stays small on disk
+TORRENT_FIELDS = [
+    "added_on",
+    "category",
+    "content_path",
+    "last_activity",
+    "name",
+    "num_leechs",
+    "num_seeds",
+    "ratio",
+    "save_path",
+    "seeding_time",
+    "size",
+    "state",
+    "tags",
+    "time_active",
+    "tracker",
+]
+
+TRACKER_FIELDS = ["url", "status", "tier", "msg"]
+
+# Counters that move on almost every sync of an active torrent. Their values are kept
+# current, but a change in them alone does not make a torrent changed, the tags
+# reading them are evaluated again on every run instead
+VOLATILE_FIELDS = {
+    "last_activity",
+    "num_leechs",
+    "num_seeds",
+    "ratio",
+    "seeding_time",
+    "time_active",
+}
+
+# A change in any of these invalidates the cached tracker list of a torrent, the
+# current tracker of a torrent is cleared when none of its trackers works
+TRACKER_TRIGGERS = {"tracker", "trackers_count", "state"}
+
+# The triggers are kept too, a full update sends every field of every torrent and
+# only a different value means the tracker list may have changed
+STORED_FIELDS = TORRENT_FIELDS + sorted(TRACKER_TRIGGERS - set(TORRENT_FIELDS))
+
+TRACKER_CHUNK_SIZE = 500
+
+
+class Snapshot:
+    """
+    Compact local copy of the torrent list kept current with `sync/maindata` deltas
+    """
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.rid = data.get("rid", 0)
+        self.torrents = data.get("torrents", {})
+        self.trackers = data.get("trackers", {})
+        self.categories = data.get("categories", {})
+        self.tags = set(data.get("tags", []))
+        self.server_state = data.get("server_state", {})
+
+    def __len__(self):
+        return len(self.torrents)
+
+    def count(self, states):
+        """
+        :return: number of torrents in any of `states`
+        """
+        return sum(
+            1 for record in self.torrents.values() if record.get("state") in states
+        )
+
+    def to_dict(self):
+        return dict(
+            rid=self.rid,
+            torrents=self.torrents,
+            trackers=self.trackers,
+            categories=self.categories,
+            tags=sorted(self.tags),
+            server_state=self.server_state,
+        )
+
+    def update(self, client, trackers=True):
+        """
+        Apply the changes since the last response id
+        :param client: authenticated qBittorrent client
+        :param trackers: also refresh tracker lists of torrents that need it
+        :return: hashes of torrents that were added or changed
+        """
+        data = client.sync_maindata(rid=self.rid)
+
+        # Every new session starts with a full update, it is compared with the
+        # previous records like a delta
+        previous, previous_trackers = self.torrents, self.trackers
+        if data.get("full_update"):
+            self.torrents = {}
+            self.trackers = {}
+            self.categories = {}
+            self.tags = set()
+
+        changed = set()
+        stale = set()
+
+        for torrent_hash, delta in data.get("torrents", {}).items():
+            record = self.torrents[torrent_hash] = previous.get(torrent_hash, {})
+            updated = {
+                k for k, v in delta.items() if k in STORED_FIELDS and record.get(k) != v
+            }
+            record.update((k, delta[k]) for k in updated)
+            if (updated - VOLATILE_FIELDS).intersection(TORRENT_FIELDS):
+                changed.add(torrent_hash)
+            if torrent_hash not in previous_trackers or updated & TRACKER_TRIGGERS:
+                stale.add(torrent_hash)
+            elif torrent_hash not in self.trackers:
+                self.trackers[torrent_hash] = previous_trackers[torrent_hash]
+
+        for torrent_hash in data.get("torrents_removed", []):
+            self.torrents.pop(torrent_hash, None)
+            self.trackers.pop(torrent_hash, None)
+            changed.discard(torrent_hash)
+            stale.discard(torrent_hash)
+
+        for name, category in data.get("categories", {}).items():
+            self.categories.setdefault(name, {}).update(category)
+        for name in data.get("categories_removed", []):
+            self.categories.pop(name, None)
+
+        self.tags.update(data.get("tags", []))
+        self.tags.difference_update(data.get("tags_removed", []))
+
+        self.server_state.update(data.get("server_state", {}))
+        self.rid = data.get("rid", self.rid)
+
+        if trackers and stale:
+            changed.update(self.refresh_trackers(client, stale))
+
+        return changed
+
+    def refresh_trackers(self, client, hashes):
+        refreshed = set()
+        for chunk in utils.chunks(sorted(hashes), TRACKER_CHUNK_SIZE):
+            for t in client.torrents.info(torrent_hashes=chunk, includeTrackers="true"):
+                trackers = t.get("trackers") if "trackers" in t else t.trackers
+                trackers = [{k: s.get(k) for k in TRACKER_FIELDS} for s in trackers]
+                if self.trackers.get(t.hash) != trackers:
+                    self.trackers[t.hash] = trackers
+                    refreshed.add(t.hash)
+        return refreshed
+
+    def torrent(self, client, torrent_hash):
+        data = dict(self.torrents[torrent_hash], hash=torrent_hash)
+        data["trackers"] = self.trackers.get(torrent_hash, [])
+        return qbittorrentapi.TorrentDictionary(data, client=client)
+
+    def torrents_info(
+        self, client, where=None, category=None, tag=None, state=None, hashes=None
+    ):
+        """
+        :param where: predicate on the torrent record
+        :param category: only torrents of this category
+        :param tag: only torrents with this tag
+        :param state: only torrents in this state
+        :param hashes: only these torrents
+        """
+        if hashes is None:
+            records = self.torrents.items()
+        else:
+            records = [(h, self.torrents[h]) for h in hashes if h in self.torrents]
+
+        return [
+            self.torrent(client, h)
+            for h, record in records
+            if (category is None or record.get("category") == category)
+            and (tag is None or tag in utils.split_tags(record.get("tags", "")))
+            and (state is None or record.get("state") == state)
+            and (where is None or where(record))
+        ]
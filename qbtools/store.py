@@ -0,0 +1,366 @@
+import os
+import json
+import sqlite3
+import qbittorrentapi
+import utils
+
+from snapshot import STORED_FIELDS, TORRENT_FIELDS, TRACKER_FIELDS, TRACKER_TRIGGERS
+from snapshot import VOLATILE_FIELDS
+
+TRACKER_CHUNK_SIZE = 500
+
+# Stay below the default limit of host parameters of a statement
+QUERY_CHUNK_SIZE = 900
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS torrents (hash TEXT PRIMARY KEY, {", ".join(STORED_FIELDS)});
+CREATE INDEX IF NOT EXISTS torrents_category ON torrents (category);
+CREATE INDEX IF NOT EXISTS torrents_content_path ON torrents (content_path);
+CREATE TABLE IF NOT EXISTS torrent_tags (hash TEXT, tag TEXT, PRIMARY KEY (hash, tag));
+CREATE INDEX IF NOT EXISTS torrent_tags_tag ON torrent_tags (tag);
+CREATE TABLE IF NOT EXISTS trackers (hash TEXT, {", ".join(TRACKER_FIELDS)});
+CREATE INDEX IF NOT EXISTS trackers_hash ON trackers (hash);
+CREATE TABLE IF NOT EXISTS stale_trackers (hash TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS files (hash TEXT, name TEXT);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE TABLE IF NOT EXISTS categories (name TEXT PRIMARY KEY, save_path TEXT);
+CREATE TABLE IF NOT EXISTS tags (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS retries (
+    status TEXT, hash TEXT, count INTEGER, PRIMARY KEY (status, hash)
+);
+"""
+
+TORRENT_TABLES = [
+    "torrents",
+    "torrent_tags",
+    "trackers",
+    "stale_trackers",
+    "files",
+    "retries",
+]
+
+PLACEHOLDERS = ", ".join("?" * (len(STORED_FIELDS) + 1))
+INSERT_TORRENT = (
+    f"INSERT OR REPLACE INTO torrents (hash, {', '.join(STORED_FIELDS)}) "
+    f"VALUES ({PLACEHOLDERS})"
+)
+
+
+class Store:
+    """
+    Local SQLite copy of the torrents, trackers, tags and categories of a client
+
+    It is kept current with `sync/maindata` deltas and answers the same queries as a
+    `Snapshot`, so commands can read from it instead of the API. It also keeps the
+    file lists of completed torrents and the reannounce retry counters across runs.
+    """
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        # Stores created before a field was kept get its column, empty until synced
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(torrents)")}
+        for field in STORED_FIELDS:
+            if field not in columns:
+                self.db.execute(f"ALTER TABLE torrents ADD COLUMN {field}")
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM torrents").fetchone()[0]
+
+    def meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", [key]).fetchone()
+        return row[0] if row else default
+
+    @property
+    def rid(self):
+        return self.meta("rid", 0)
+
+    @property
+    def server_state(self):
+        return json.loads(self.meta("server_state", "{}"))
+
+    def count(self, states):
+        """
+        :return: number of torrents in any of `states`
+        """
+        states = list(states)
+        return self.db.execute(
+            f"SELECT COUNT(*) FROM torrents WHERE state IN ({', '.join('?' * len(states))})",
+            states,
+        ).fetchone()[0]
+
+    @property
+    def categories(self):
+        return {
+            row["name"]: {"name": row["name"], "savePath": row["save_path"]}
+            for row in self.db.execute("SELECT * FROM categories")
+        }
+
+    @property
+    def tags(self):
+        return {row[0] for row in self.db.execute("SELECT name FROM tags")}
+
+    def records(self, hashes=None):
+        """
+        :param hashes: hashes to get, or None for all torrents
+        :return: hash -> torrent record, with the tracker triggers
+        """
+        if hashes is None:
+            rows = self.db.execute("SELECT * FROM torrents")
+        else:
+            rows = self.select("SELECT * FROM torrents WHERE hash IN ({})", hashes)
+        return {row["hash"]: {k: row[k] for k in STORED_FIELDS} for row in rows}
+
+    def select(self, query, values):
+        """Run a query with an `IN ({})` placeholder in chunks of values"""
+        rows = []
+        for chunk in utils.chunks(list(values), QUERY_CHUNK_SIZE):
+            placeholders = ", ".join("?" * len(chunk))
+            rows.extend(self.db.execute(query.format(placeholders), chunk))
+        return rows
+
+    def update(self, client, trackers=True):
+        """
+        Apply the changes since the last response id
+        :param client: authenticated qBittorrent client
+        :param trackers: also refresh tracker lists of torrents that need it
+        :return: hashes of torrents that were added or changed
+        """
+        data = client.sync_maindata(rid=self.rid)
+        deltas = data.get("torrents", {})
+
+        with self.db:
+            if data.get("full_update"):
+                existing = self.records()
+                removed = set(existing) - set(deltas)
+                self.db.execute("DELETE FROM categories")
+                self.db.execute("DELETE FROM tags")
+            else:
+                existing = self.records(deltas)
+                removed = set(data.get("torrents_removed", []))
+
+            changed = set()
+            stale = set()
+
+            # A full update, sent to every new session, is compared with the stored
+            # rows like a delta
+            for torrent_hash, delta in deltas.items():
+                record = existing.get(torrent_hash, {})
+                updated = {
+                    k
+                    for k, v in delta.items()
+                    if k in STORED_FIELDS and record.get(k) != v
+                }
+                if updated:
+                    record = {
+                        **dict.fromkeys(STORED_FIELDS),
+                        **record,
+                        **{k: delta[k] for k in updated},
+                    }
+                    self.db.execute(
+                        INSERT_TORRENT,
+                        [torrent_hash, *(record[k] for k in STORED_FIELDS)],
+                    )
+                    if "tags" in updated:
+                        self.db.execute(
+                            "DELETE FROM torrent_tags WHERE hash = ?", [torrent_hash]
+                        )
+                        self.db.executemany(
+                            "INSERT INTO torrent_tags VALUES (?, ?)",
+                            [
+                                (torrent_hash, tag)
+                                for tag in utils.split_tags(record["tags"])
+                            ],
+                        )
+                if (updated - VOLATILE_FIELDS).intersection(TORRENT_FIELDS):
+                    changed.add(torrent_hash)
+                if torrent_hash not in existing or updated & TRACKER_TRIGGERS:
+                    stale.add(torrent_hash)
+
+            for table in TORRENT_TABLES:
+                self.select(f"DELETE FROM {table} WHERE hash IN ({{}})", removed)
+            changed -= removed
+
+            # Tracker lists skipped by an update without trackers are refreshed later
+            self.db.executemany(
+                "INSERT OR IGNORE INTO stale_trackers VALUES (?)",
+                [(h,) for h in stale - removed],
+            )
+
+            self.db.executemany(
+                "INSERT INTO categories VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE "
+                "SET save_path = COALESCE(excluded.save_path, save_path)",
+                [
+                    (name, category.get("savePath"))
+                    for name, category in data.get("categories", {}).items()
+                ],
+            )
+            self.select(
+                "DELETE FROM categories WHERE name IN ({})",
+                data.get("categories_removed", []),
+            )
+
+            self.db.executemany(
+                "INSERT OR IGNORE INTO tags VALUES (?)",
+                [(tag,) for tag in data.get("tags", [])],
+            )
+            self.select(
+                "DELETE FROM tags WHERE name IN ({})", data.get("tags_removed", [])
+            )
+
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [
+                    ("rid", data.get("rid", self.rid)),
+                    (
+                        "server_state",
+                        json.dumps(
+                            {**self.server_state, **data.get("server_state", {})}
+                        ),
+                    ),
+                ],
+            )
+
+        if trackers:
+            stale = [row[0] for row in self.db.execute("SELECT * FROM stale_trackers")]
+            changed.update(self.refresh_trackers(client, stale))
+
+        return changed
+
+    def refresh_trackers(self, client, hashes):
+        refreshed = set()
+        for chunk in utils.chunks(sorted(hashes), TRACKER_CHUNK_SIZE):
+            current = self.trackers(chunk)
+            with self.db:
+                for t in client.torrents.info(
+                    torrent_hashes=chunk, includeTrackers="true"
+                ):
+                    trackers = t.get("trackers") if "trackers" in t else t.trackers
+                    trackers = [{k: s.get(k) for k in TRACKER_FIELDS} for s in trackers]
+                    if current.get(t.hash, []) == trackers:
+                        continue
+                    self.db.execute("DELETE FROM trackers WHERE hash = ?", [t.hash])
+                    self.db.executemany(
+                        "INSERT INTO trackers VALUES (?, ?, ?, ?, ?)",
+                        [(t.hash, *(s[k] for k in TRACKER_FIELDS)) for s in trackers],
+                    )
+                    refreshed.add(t.hash)
+                self.select("DELETE FROM stale_trackers WHERE hash IN ({})", chunk)
+        return refreshed
+
+    def trackers(self, hashes=None):
+        """
+        :return: hash -> list of trackers
+        """
+        query = "SELECT * FROM trackers"
+        if hashes is None:
+            rows = self.db.execute(f"{query} ORDER BY rowid")
+        else:
+            rows = self.select(f"{query} WHERE hash IN ({{}}) ORDER BY rowid", hashes)
+
+        trackers = {}
+        for row in rows:
+            trackers.setdefault(row["hash"], []).append(
+                {k: row[k] for k in TRACKER_FIELDS}
+            )
+        return trackers
+
+    def torrent(self, client, torrent_hash):
+        torrents = self.torrents_info(client, hashes=[torrent_hash])
+        if not torrents:
+            # Like a missing torrent of a `Snapshot`
+            raise KeyError(torrent_hash)
+        return torrents[0]
+
+    def torrents_info(
+        self, client, where=None, category=None, tag=None, state=None, hashes=None
+    ):
+        """
+        :param where: predicate on the torrent record, like `Snapshot.torrents_info`
+        :param category: only torrents of this category, answered from the index
+        :param tag: only torrents with this tag, answered from the index
+        :param state: only torrents in this state
+        :param hashes: only these torrents
+        """
+        clauses, values = [], []
+        if category is not None:
+            clauses.append("category = ?")
+            values.append(category)
+        if tag is not None:
+            clauses.append("hash IN (SELECT hash FROM torrent_tags WHERE tag = ?)")
+            values.append(tag)
+        if state is not None:
+            clauses.append("state = ?")
+            values.append(state)
+
+        query = "SELECT * FROM torrents"
+        if clauses:
+            query += f" WHERE {' AND '.join(clauses)}"
+
+        if hashes is None:
+            rows = self.db.execute(query, values).fetchall()
+        else:
+            rows = [
+                row
+                for chunk in utils.chunks(list(hashes), QUERY_CHUNK_SIZE)
+                for row in self.db.execute(
+                    f"{query} {'AND' if clauses else 'WHERE'} hash IN ({', '.join('?' * len(chunk))})",
+                    [*values, *chunk],
+                )
+            ]
+
+        records = {row["hash"]: {k: row[k] for k in TORRENT_FIELDS} for row in rows}
+        if where is not None:
+            records = {h: r for h, r in records.items() if where(r)}
+
+        # Loading every tracker at once is cheaper than one query per torrent
+        trackers = self.trackers(None if hashes is None and not clauses else records)
+        return [
+            qbittorrentapi.TorrentDictionary(
+                dict(record, hash=h, trackers=trackers.get(h, [])), client=client
+            )
+            for h, record in records.items()
+        ]
+
+    def files(self):
+        """
+        :return: hash -> file names of the cached file lists
+        """
+        files = {}
+        for row in self.db.execute("SELECT hash, name FROM files ORDER BY rowid"):
+            files.setdefault(row["hash"], []).append(row["name"])
+        return files
+
+    def save_files(self, files):
+        with self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.executemany(
+                "INSERT INTO files VALUES (?, ?)",
+                [(h, name) for h, names in files.items() for name in names],
+            )
+
+    def retries(self, status):
+        """
+        :return: hash -> reannounce retries of the torrents in `status`
+        """
+        rows = self.db.execute(
+            "SELECT hash, count FROM retries WHERE status = ?", [status]
+        )
+        return {row["hash"]: row["count"] for row in rows}
+
+    def save_retries(self, status, retries):
+        with self.db:
+            self.db.execute("DELETE FROM retries WHERE status = ?", [status])
+            self.db.executemany(
+                "INSERT INTO retries VALUES (?, ?, ?)",
+                [(status, h, count) for h, count in retries.items()],
+            )
+
+    def close(self):
+        self.db.close()
@@ -1,6 +1,9 @@
 import argparse
+import itertools
+import json
 import os
-import pathlib
+import sys
+import time
 
 
 def format_bytes(size):
@@ -36,15 +39,38 @@ def dhms(total_seconds: int) -> str:
     return f"{days}d{hours}h{minutes}m{seconds}s"
 
 
-def is_linked(path):
-    path = pathlib.Path(path)
-    if os.path.islink(path):
-        return True
-    if os.path.isfile(path) and os.lstat(path).st_nlink > 1:
-        return True
-    if os.path.isdir(path):
-        linked = [os.path.join(path, x) for path, subdirs, files in os.walk(path) for x in files if os.lstat(os.path.join(path, x)).st_nlink > 1 or os.path.islink(os.path.join(path, x))]
-        return len(linked) > 0
+def chunks(items, size):
+    items = list(items)
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def batches(items, size):
+    """Like `chunks`, without materialising `items`"""
+    items = iter(items)
+    while batch := list(itertools.islice(items, size)):
+        yield batch
+
+
+def split_tags(tags):
+    return {tag.strip() for tag in tags.split(",") if tag.strip()}
+
+
+def load_json(path, default=None):
+    try:
+        with open(path, "r") as stream:
+            return json.load(stream)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def save_json(path, data):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as stream:
+        json.dump(data, stream, separators=(",", ":"))
+    os.replace(tmp_path, path)
 
 
 class EnvDefault(argparse.Action):
@@ -58,3 +84,67 @@ class EnvDefault(argparse.Action):
 
     def __call__(self, parser, namespace, values, option_string=None):
         setattr(namespace, self.dest, values)
+
+
+class ImportProfiler:
+    """
+    Meta path finder timing the execution of every module imported while installed
+
+    `times` maps each module to its (self, cumulative) import time in seconds, the
+    self time excluding the modules it imported in turn.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+
+        # Builtin and frozen importers are classes shared by all their modules
+        loader = spec.loader
+        if loader is None or isinstance(loader, type):
+            return spec
+        exec_module = getattr(loader, "exec_module", None)
+        if exec_module is None:
+            return spec
+
+        def timed_exec_module(module):
+            started = time.perf_counter()
+            self.stack.append(0.0)
+            try:
+                exec_module(module)
+            finally:
+                elapsed = time.perf_counter() - started
+                children = self.stack.pop()
+                if self.stack:
+                    self.stack[-1] += elapsed
+                self.times[fullname] = (elapsed - children, elapsed)
+
+        loader.exec_module = timed_exec_module
+        return spec
+
+    def report(self, logger, threshold=0.001):
+        """Log the modules whose import took at least `threshold` seconds, slowest first"""
+        ranked = sorted(self.times.items(), key=lambda x: x[1][1], reverse=True)
+        for name, (own, cumulative) in ranked:
+            if cumulative < threshold:
+                break
+            logger.info(
+                f"Imported {name} in {cumulative * 1000:.1f} ms (self {own * 1000:.1f} ms)"
+            )
@@ -0,0 +1,75 @@
+import os
+import sys
+
+import pytest
+import qbittorrentapi
+
+# The modules of qbtools import each other by name, like when run from its folder
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "qbtools"))
+
+
+class FakeClient:
+    """
+    Queued `sync/maindata` responses and tracker lists, in place of a qBittorrent
+    client
+    """
+
+    def __init__(self):
+        self.responses = []
+        self.trackers = {}
+        self.rids = []
+        self.info_calls = []
+
+    @property
+    def torrents(self):
+        return self
+
+    def sync_maindata(self, rid=0):
+        self.rids.append(rid)
+        return self.responses.pop(0)
+
+    def info(self, torrent_hashes=None, includeTrackers=None):
+        self.info_calls.append(list(torrent_hashes))
+        return [
+            qbittorrentapi.TorrentDictionary(
+                dict(hash=h, trackers=self.trackers.get(h, [])), client=None
+            )
+            for h in torrent_hashes
+        ]
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+def torrent(**fields):
+    """
+    :return: fields of a torrent as sent by a full `sync/maindata` update
+    """
+    return dict(
+        dict(
+            added_on=1_700_000_000,
+            category="tv",
+            content_path="/data/tv/show",
+            last_activity=1_700_000_000,
+            name="show",
+            num_complete=10,
+            num_leechs=0,
+            num_seeds=1,
+            ratio=1.0,
+            save_path="/data/tv",
+            seeding_time=3600,
+            size=1000,
+            state="uploading",
+            tags="",
+            time_active=3600,
+            tracker="https://tracker.example.org/announce",
+            trackers_count=1,
+        ),
+        **fields,
+    )
+
+
+def tracker(url="https://tracker.example.org/announce", status=2, msg=""):
+    return dict(url=url, status=status, tier=0, msg=msg)
@@ -0,0 +1,43 @@
+import classifier
+
+
+def test_categories_matching_at_the_same_position():
+    messages = classifier.MessageClassifier(
+        {"unregistered": ["TORRENT NOT"], "tracker-down": ["torrent not reachable"]}
+    )
+
+    assert messages.classify("Torrent not reachable") == {
+        "unregistered",
+        "tracker-down",
+    }
+    assert messages.classify("torrent not registered") == {"unregistered"}
+
+
+def test_overlapping_and_separate_matches():
+    messages = classifier.MessageClassifier(
+        {"unregistered": ["NOT REGISTERED"], "tracker-down": ["DOWN", "UNREACHABLE"]}
+    )
+
+    assert messages.classify("tracker down, torrent not registered") == {
+        "unregistered",
+        "tracker-down",
+    }
+    assert messages.classify("Tracker is unreachable") == {"tracker-down"}
+    assert messages.classify("") == set()
+    assert messages.classify("all good") == set()
+
+
+def test_patterns_are_literal():
+    messages = classifier.MessageClassifier({"odd": ["a.b (c)"], "empty": []})
+
+    assert messages.classify("A.B (C) happened") == {"odd"}
+    assert messages.classify("axb c") == set()
+
+
+def test_hits_and_memo():
+    messages = classifier.MessageClassifier({"down": ["down"], "gone": ["gone"]})
+
+    assert messages.match(["down", "gone"], count=3) == {"down", "gone"}
+    assert messages.match(["down"]) == {"down"}
+    assert messages.hits == {"down": 4, "gone": 3}
+    assert set(messages.memo) == {"down", "gone"}
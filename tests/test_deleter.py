@@ -0,0 +1,84 @@
+import os
+import logging
+
+import deleter
+import journal
+
+logger = logging.getLogger("test")
+
+
+def write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as stream:
+        stream.write(b"x" * size)
+
+
+def tree(root):
+    """
+    :return: (path, is_dir) of the items to delete
+    """
+    write(root / "single.mkv", 100)
+    write(root / "Folder/a.mkv", 10)
+    write(root / "Folder/Sub/b.nfo", 5)
+    write(root / "Folder/linked.mkv", 1000)
+    os.link(root / "Folder/linked.mkv", root / "kept.mkv")
+    write(root / "hardlink.mkv", 50)
+    os.link(root / "hardlink.mkv", root / "other.mkv")
+    os.symlink(root / "single.mkv", root / "symlink.mkv")
+    return [
+        (str(root / "single.mkv"), False),
+        (str(root / "Folder"), True),
+        (str(root / "hardlink.mkv"), False),
+        (str(root / "symlink.mkv"), False),
+        (str(root / "missing.mkv"), False),
+    ]
+
+
+def run(items, **options):
+    pool = deleter.Deleter(logger, workers=3, per_device=2, **options)
+    for path, is_dir in items:
+        pool.delete(path, is_dir)
+    return pool, pool.close()
+
+
+def test_dry_run_plans_what_a_real_run_deletes(tmp_path):
+    items = tree(tmp_path)
+    before = sorted(os.listdir(tmp_path))
+
+    dry, planned = run(items, dry_run=True)
+    assert sorted(os.listdir(tmp_path)) == before
+
+    deletions = journal.Journal(str(tmp_path / "journal" / "run.jsonl"))
+    deletions.start()
+    real, deleted = run(items, journal=deletions)
+    deletions.close()
+
+    # Files linked elsewhere free nothing
+    assert planned == deleted == (5, 100 + 10 + 5)
+    assert dry.planned == real.planned == 5
+    assert dry.failed == real.failed == 0
+    assert sorted(os.listdir(tmp_path)) == ["journal", "kept.mkv", "other.mkv"]
+
+    events = [(e["event"], e.get("path")) for e in journal.read(deletions.path)]
+    assert ("deleted", str(tmp_path / "Folder")) in events
+    assert ("missing", str(tmp_path / "missing.mkv")) in events
+
+
+def test_freed_bytes(tmp_path):
+    tree(tmp_path)
+
+    assert deleter.freed_bytes(str(tmp_path / "Folder")) == 15
+    assert deleter.freed_bytes(str(tmp_path / "hardlink.mkv")) == 0
+    assert deleter.freed_bytes(str(tmp_path / "symlink.mkv")) == 0
+    assert deleter.freed_bytes(str(tmp_path / "missing.mkv")) == 0
+
+
+def test_failures_are_counted(tmp_path):
+    write(tmp_path / "file.mkv", 10)
+
+    # Removing a file as a folder fails
+    pool, result = run([(str(tmp_path / "file.mkv"), True)])
+
+    assert result == (0, 0)
+    assert pool.failed == 1
+    assert os.path.exists(tmp_path / "file.mkv")
@@ -0,0 +1,70 @@
+import argparse
+
+import pytest
+
+import instances
+import qbtools
+
+
+def load(argv, configured):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    qbtools.load_commands(subparsers, argv)
+    app = parser.parse_args(argv)
+    app.config = {"instances": configured}
+    return instances.load(app, parser, argv)
+
+
+def test_options_are_parsed_by_the_command():
+    argv = ["prune", "--include-tag", "expired", "--instances"]
+    tv, movies = load(
+        argv,
+        [
+            dict(name="tv", server="qbt-tv", port=8080, **{"state-db": "/db/tv.db"}),
+            {
+                "name": "movies",
+                "server": "qbt-movies",
+                "port": 8081,
+                "pool-size": 3,
+                "dry-run": True,
+                "exclude-tag": ["keep", "seeding"],
+            },
+        ],
+    )
+
+    assert tv.name == "tv"
+    assert tv.server == "qbt-tv"
+    assert tv.state_db == "/db/tv.db"
+    assert not tv.dry_run
+    assert movies.pool_size == 3
+    assert movies.dry_run
+    assert movies.include_tag == [["expired"]]
+    assert movies.exclude_tag == [["keep", "seeding"]]
+    assert movies.config is tv.config
+
+
+def test_state_files_get_the_instance_name():
+    argv = ["prune", "--include-tag", "x", "--state-db", "/db/state.db", "--instances"]
+    (tv,) = load(argv, [dict(name="tv", server="qbt-tv", port=8080)])
+
+    assert tv.state_db == "/db/state-tv.db"
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"pool-size": "many"},
+        {"dry-run": "yes"},
+        {"unknown": 1},
+        {"pool-size": [1, 2]},
+    ],
+)
+def test_invalid_options(options):
+    argv = ["prune", "--include-tag", "x", "--instances"]
+    with pytest.raises(ValueError, match="Invalid options of instance tv"):
+        load(argv, [dict(name="tv", server="qbt-tv", port=8080, **options)])
+
+
+def test_instances_need_a_server():
+    with pytest.raises(ValueError, match="needs a server"):
+        load(["prune", "--include-tag", "x", "--instances"], [dict(name="tv")])
@@ -0,0 +1,82 @@
+import os
+
+import linkscan
+
+
+def tree(root, files):
+    for name in files:
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+
+
+def test_links_anywhere_below_a_content_path(tmp_path):
+    tree(tmp_path / "plain", ["a/b/c.mkv", "d.mkv"])
+    tree(tmp_path / "nested", ["a/b/c.mkv", "d.mkv"])
+    os.link(tmp_path / "nested/a/b/c.mkv", tmp_path / "elsewhere.mkv")
+    tree(tmp_path / "symlinked", ["a/b.mkv"])
+    os.symlink(tmp_path / "elsewhere.mkv", tmp_path / "symlinked/a/link.mkv")
+
+    scanner = linkscan.LinkScanner(workers=4)
+    paths = [str(tmp_path / name) for name in ["plain", "nested", "symlinked"]]
+    result = scanner.scan(paths + [str(tmp_path / "missing")])
+
+    assert result == {
+        paths[0]: False,
+        paths[1]: True,
+        paths[2]: True,
+        str(tmp_path / "missing"): False,
+    }
+    # Single files are checked directly
+    assert scanner.scan([str(tmp_path / "elsewhere.mkv")]) == {
+        str(tmp_path / "elsewhere.mkv"): True
+    }
+
+
+def test_large_folders_are_checked_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(linkscan, "FILES_PER_TASK", 4)
+    tree(tmp_path / "pack", [f"e{i:02}.mkv" for i in range(30)])
+    os.link(tmp_path / "pack/e29.mkv", tmp_path / "other.mkv")
+    tree(tmp_path / "unlinked", [f"e{i:02}.mkv" for i in range(30)])
+
+    result = linkscan.LinkScanner(workers=3).scan(
+        [str(tmp_path / "pack"), str(tmp_path / "unlinked")]
+    )
+
+    assert result == {str(tmp_path / "pack"): True, str(tmp_path / "unlinked"): False}
+
+
+def test_cache(tmp_path):
+    tree(tmp_path / "show", ["s01/e01.mkv"])
+    path = str(tmp_path / "show")
+    cache_file = str(tmp_path / "cache.json")
+
+    scanner = linkscan.LinkScanner(cache_file)
+    assert scanner.scan([path]) == {path: False}
+    scanner.save()
+
+    # A new link in a subfolder does not change the content path, the cached result
+    # is reused until it is older than max_age
+    os.link(tmp_path / "show/s01/e01.mkv", tmp_path / "linked.mkv")
+    assert linkscan.LinkScanner(cache_file).scan([path]) == {path: False}
+    assert linkscan.LinkScanner(cache_file, max_age=0).scan([path]) == {path: True}
+
+    # Adding an entry to the content path changes its mtime
+    tree(tmp_path / "show", ["s02/e01.mkv"])
+    os.utime(path, ns=(0, 0))
+    assert linkscan.LinkScanner(cache_file).scan([path]) == {path: True}
+
+
+def test_unseen_paths_are_forgotten(tmp_path):
+    tree(tmp_path, ["a/1.mkv", "b/1.mkv"])
+    cache_file = str(tmp_path / "cache.json")
+    a, b = str(tmp_path / "a"), str(tmp_path / "b")
+
+    scanner = linkscan.LinkScanner(cache_file)
+    scanner.scan([a, b])
+    scanner.save()
+
+    scanner = linkscan.LinkScanner(cache_file)
+    scanner.keep([a])
+    scanner.save()
+    assert set(linkscan.LinkScanner(cache_file).cache) == {a}
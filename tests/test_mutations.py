@@ -0,0 +1,63 @@
+import mutations
+
+
+def applied(operations):
+    """
+    :return: (tag, hash) pairs added and removed by the requests
+    """
+    result = {"torrents_add_tags": set(), "torrents_remove_tags": set()}
+    for method, tags, hashes in operations:
+        result[method].update((tag, h) for tag in tags for h in hashes)
+    return result["torrents_add_tags"], result["torrents_remove_tags"]
+
+
+def pairs(changes):
+    return {(tag, h) for tag, hashes in changes.items() for h in hashes}
+
+
+def test_shared_deltas_are_grouped():
+    additions = {"a": {"1", "2", "3"}, "b": {"1", "2", "3"}, "c": {"1", "2", "3"}}
+
+    operations = mutations.plan(additions, {}, 100)
+
+    assert operations == [("torrents_add_tags", ["a", "b", "c"], ["1", "2", "3"])]
+    assert mutations.baseline(additions, {}, 100) == 3
+
+
+def test_per_tag_requests_when_deltas_differ():
+    additions = {"a": {"1", "2"}, "b": {"3", "4"}}
+    removals = {"c": {"1", "3"}}
+
+    operations = mutations.plan(additions, removals, 100)
+
+    assert len(operations) == 3
+    assert operations[0] == ("torrents_remove_tags", ["c"], ["1", "3"])
+    assert applied(operations) == (pairs(additions), pairs(removals))
+
+
+def test_every_change_is_applied_once():
+    additions = {f"t{i}": {str(h) for h in range(i, 50, i + 1)} for i in range(8)}
+    removals = {"old": {str(h) for h in range(0, 50, 3)}, "gone": set()}
+
+    operations = mutations.plan(additions, removals, 7)
+
+    added, removed = applied(operations)
+    assert added == pairs(additions)
+    assert removed == pairs(removals)
+    assert all(len(hashes) <= 7 for _, _, hashes in operations)
+    sent = [(tag, h) for _, tags, hashes in operations for tag in tags for h in hashes]
+    assert len(sent) == len(set(sent))
+
+
+def test_baseline_counts_chunks():
+    additions = {"a": {str(h) for h in range(25)}, "b": set()}
+    removals = {"c": {"1"}}
+
+    assert mutations.baseline(additions, removals, 10) == 4
+    # Planning never needs more requests than the chunked baseline
+    assert len(mutations.plan(additions, removals, 10)) <= 4
+
+
+def test_nothing_to_do():
+    assert mutations.plan({"a": set()}, {}, 10) == []
+    assert mutations.baseline({"a": set()}, {}, 10) == 0
@@ -0,0 +1,239 @@
+import os
+import json
+import logging
+import argparse
+
+import pytest
+
+import journal
+import scanstate
+from commands import orphaned
+
+logger = logging.getLogger("test")
+
+# Older than the racy window of the scan state
+OLD = 1_600_000_000
+
+
+def write(path, data="x"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as stream:
+        stream.write(data)
+
+
+def age(root):
+    """
+    Date every file and folder below `root` back, out of the racy window
+    """
+    for folder, names, files in os.walk(root):
+        for name in names + files:
+            os.utime(os.path.join(folder, name), (OLD, OLD))
+    os.utime(root, (OLD, OLD))
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / "downloads"
+    write(root / "tv/Show/e01.mkv")
+    write(root / "tv/Show/e02.mkv")
+    write(root / "movies/Film/film.mkv")
+    write(root / "music/Album/track.flac")
+    age(root)
+    return str(root)
+
+
+@pytest.fixture
+def app(tmp_path):
+    return argparse.Namespace(
+        exclude_pattern=[],
+        scan_state_file=str(tmp_path / "scan.json"),
+        journal_file=str(tmp_path / "journal.jsonl"),
+        full_scan=False,
+        dry_run=False,
+        delete_workers=2,
+        device_concurrency=2,
+        delete_rate=0,
+    )
+
+
+def trie(root, *owned):
+    result = {}
+    for path in owned:
+        orphaned.insert(result, os.path.join(root, path))[orphaned.OWNED] = True
+    orphaned.insert(result, os.path.join(root, "tv"))
+    return result
+
+
+def owned(root):
+    return trie(root, "tv/Show", "movies/Film", "music/Album")
+
+
+@pytest.fixture
+def listed(monkeypatch):
+    """
+    Folders listed by the scans
+    """
+    folders = []
+    unchanged = scanstate.ScanState.unchanged
+
+    def listing(self, path, st, key):
+        subfolders = unchanged(self, path, st, key)
+        if subfolders is None:
+            folders.append(os.path.basename(path))
+        return subfolders
+
+    monkeypatch.setattr(scanstate.ScanState, "unchanged", listing)
+    return folders
+
+
+def files(root):
+    return sorted(
+        os.path.relpath(os.path.join(folder, name), root)
+        for folder, names, names_files in os.walk(root)
+        for name in names + names_files
+    )
+
+
+def test_unchanged_folders_are_skipped(app, root, listed):
+    assert orphaned.cleanup(app, logger, root, owned(root)) == (0, 0)
+    assert sorted(listed) == ["downloads", "movies", "music", "tv"]
+
+    listed.clear()
+    assert orphaned.cleanup(app, logger, root, owned(root)) == (0, 0)
+    assert listed == []
+
+    app.full_scan = True
+    orphaned.cleanup(app, logger, root, owned(root))
+    assert sorted(listed) == ["downloads", "movies", "music", "tv"]
+
+
+def test_changed_child_is_listed_again(app, root, listed):
+    orphaned.cleanup(app, logger, root, owned(root))
+    listed.clear()
+
+    write(os.path.join(root, "tv/extra.nfo"), "12345")
+
+    assert orphaned.cleanup(app, logger, root, owned(root)) == (1, 5)
+    assert listed == ["tv"]
+    assert "tv/extra.nfo" not in files(root)
+
+
+def test_changed_ownership_is_listed_again(app, root, listed):
+    orphaned.cleanup(app, logger, root, owned(root))
+    listed.clear()
+
+    # The torrent of the film was replaced, the folder mtime did not change
+    changed = trie(root, "tv/Show", "movies/Other", "music/Album")
+    assert orphaned.cleanup(app, logger, root, changed) == (1, 1)
+    assert listed == ["movies"]
+    assert "movies/Film" not in files(root)
+    assert "tv/Show/e01.mkv" in files(root)
+
+
+def test_recently_modified_folders_are_not_recorded(app, root, listed):
+    os.utime(os.path.join(root, "music"))
+    orphaned.cleanup(app, logger, root, owned(root))
+    listed.clear()
+
+    # Within RACY_SECONDS of the scan, a change in the same mtime tick would be missed
+    orphaned.cleanup(app, logger, root, owned(root))
+    assert listed == ["music"]
+
+    state = json.load(open(app.scan_state_file))["folders"]
+    assert os.path.join(root, "music") not in state
+    assert os.path.join(root, "movies") in state
+
+
+def test_scan_state_key():
+    node = {"a": {orphaned.OWNED: True}, "b": {}}
+    key = scanstate.key(node, orphaned.OWNED)
+
+    assert scanstate.key({"b": {}, "a": {"": True}}, orphaned.OWNED) == key
+    assert scanstate.key({"a": {}, "b": {}}, orphaned.OWNED) != key
+    assert scanstate.key({"a": {orphaned.OWNED: True}}, orphaned.OWNED) != key
+
+
+def test_dry_run_deletes_nothing_and_counts_the_same(app, root, tmp_path):
+    write(os.path.join(root, "tv/Show/sample.mkv"), "123")
+    write(os.path.join(root, "movies/Old/old.mkv"), "1234567")
+    write(os.path.join(root, "movies/Old/Subs/en.srt"), "12")
+    write(os.path.join(root, "linked.mkv"), "123456")
+    os.link(os.path.join(root, "linked.mkv"), tmp_path / "elsewhere.mkv")
+    before = files(root)
+
+    app.dry_run = True
+    planned = orphaned.cleanup(app, logger, root, trie(root, "tv/Show/e01.mkv"))
+    assert files(root) == before
+    assert not os.path.exists(app.journal_file)
+    # Folders with orphans are not recorded, the real run lists them again
+    state = json.load(open(app.scan_state_file))["folders"]
+    assert set(state) == {os.path.join(root, "tv")}
+
+    app.dry_run = False
+    deleted = orphaned.cleanup(app, logger, root, trie(root, "tv/Show/e01.mkv"))
+
+    # e02 and sample in the show, the movies and music folders and the linked file,
+    # which frees nothing
+    assert planned == deleted == (5, 1 + 3 + (1 + 7 + 2) + 1)
+    assert files(root) == ["tv", "tv/Show", "tv/Show/e01.mkv"]
+
+
+def test_journal_keeps_every_run(app, root):
+    write(os.path.join(root, "first.nfo"))
+    orphaned.cleanup(app, logger, root, owned(root))
+    write(os.path.join(root, "second.nfo"))
+    orphaned.cleanup(app, logger, root, owned(root))
+
+    entries = journal.read(app.journal_file)
+    assert [e["event"] for e in entries] == ["start", "delete", "deleted", "end"] * 2
+    assert [e["path"] for e in entries if e["event"] == "deleted"] == [
+        os.path.join(root, "first.nfo"),
+        os.path.join(root, "second.nfo"),
+    ]
+    assert journal.Journal(app.journal_file).previous == entries[4:]
+
+
+def test_journal_is_rotated(app, monkeypatch):
+    monkeypatch.setattr(journal, "MAX_BYTES", 100)
+    for _ in range(3):
+        deletions = journal.Journal(app.journal_file)
+        deletions.start()
+        deletions.write("deleted", "/data/" + "x" * 100)
+        deletions.close()
+
+    assert len(journal.read(app.journal_file)) == 3
+    assert len(journal.read(app.journal_file + ".1")) == 3
+
+
+def test_interrupted_deletions_are_finished(app, root, listed):
+    orphaned.cleanup(app, logger, root, owned(root))
+    # A crash while deleting the music folder, the film was deleted before it
+    write(os.path.join(root, "movies/Film/extra.nfo"), "12")
+    with open(app.journal_file, "a") as stream:
+        for event, path in [
+            ("start", None),
+            ("delete", "music/Album"),
+            ("delete", "movies/Film/extra.nfo"),
+            ("delete", "tv/gone.nfo"),
+        ]:
+            entry = dict(event=event, time=OLD)
+            if path:
+                entry["path"] = os.path.join(root, path)
+            stream.write(json.dumps(entry) + "\n")
+    stream = open(app.journal_file, "a")
+    stream.write('{"event": "del')
+    stream.close()
+    listed.clear()
+
+    # The film is owned again, the album is not anymore
+    result = orphaned.cleanup(
+        app, logger, root, trie(root, "tv/Show", "movies/Film", "music/Other")
+    )
+
+    assert result == (1, 1)
+    assert "music/Album" not in files(root)
+    assert "movies/Film/extra.nfo" in files(root)
+    # The music folder changed but the album is not deleted twice
+    assert listed == ["music"]
+    entries = journal.Journal(app.journal_file).previous
+    assert [e["event"] for e in entries] == ["start", "delete", "deleted", "end"]
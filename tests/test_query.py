@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+from conftest import torrent
+
+import query
+import snapshot
+
+
+def record(torrent_hash, category="tv", tags=""):
+    return SimpleNamespace(hash=torrent_hash, category=category, tags=tags)
+
+
+def test_single_category_and_first_tag_are_pushed_down():
+    plan = query.plan(["tv"], tags=["old", "expired"])
+
+    assert plan.requests == [{"category": "tv", "tag": "expired"}]
+    assert plan.matches(record("a", tags="old"), plan.requests[0])
+    assert not plan.matches(record("a", tags="expired"), plan.requests[0])
+
+
+def test_one_request_per_category():
+    plan = query.plan(["tv", "movies"], all_categories=["tv", "movies", "music"])
+    assert plan.requests == [{"category": "movies"}, {"category": "tv"}]
+
+    # Filtering by every category excludes nothing
+    plan = query.plan(["tv", "movies"], all_categories=["tv", "movies"])
+    assert plan.requests == [{}]
+
+    categories = [f"c{i}" for i in range(query.MAX_REQUESTS + 1)]
+    assert query.plan(categories).requests == [{}]
+
+    # A tag narrows the request more than splitting it by category
+    plan = query.plan(["tv", "movies"], tags=["x"])
+    assert plan.requests == [{"tag": "x"}]
+    assert not plan.matches(record("a", category="music", tags="x"), {"tag": "x"})
+
+
+def test_nothing_to_select():
+    assert query.plan([]).requests == []
+    assert query.plan(["tv"], hashes=[]).requests == []
+    assert query.plan(hashes=["b", "a", "b"]).requests == [{"hashes": ["a", "b"]}]
+    assert query.encode({"hashes": ["a", "b"]}) == {"hashes": "a|b"}
+
+
+def test_tags_match_whole_tags():
+    plan = query.plan(tags=["expired", "site:a"])
+
+    assert plan.matches(record("a", tags="expired, site:a"))
+    assert plan.matches(record("a", tags="site:a,expired,other"))
+    assert not plan.matches(record("a", tags="not-expired, site:a"))
+    assert not plan.matches(record("a", tags="expired, site:abc"))
+    assert not plan.matches(record("a", tags=""))
+
+
+def test_merge_keeps_each_torrent_once():
+    plan = query.plan(["tv", "movies"], tags=["x"], all_categories=["tv", "movies"])
+    plan.requests = [{"category": "tv"}, {"category": "movies"}]
+    results = [
+        [record("a", tags="x"), record("b")],
+        [record("a", category="movies", tags="x"), record("c", "movies", "x, y")],
+    ]
+
+    assert [t.hash for t in plan.merge(results)] == ["a", "c"]
+
+
+def test_select_from_a_snapshot(client):
+    client.responses.append(
+        dict(
+            rid=1,
+            full_update=True,
+            torrents={
+                "a": torrent(tags="expired"),
+                "b": torrent(tags="not-expired"),
+                "c": torrent(category="movies", tags="expired, keep"),
+                "d": torrent(category="music", tags="expired"),
+            },
+        )
+    )
+    snap = snapshot.Snapshot()
+    snap.update(client, trackers=False)
+
+    plan = query.plan(["tv", "movies"], tags=["expired"], hashes=["a", "b", "c"])
+
+    assert sorted(t.hash for t in plan.select(snap, client)) == ["a", "c"]
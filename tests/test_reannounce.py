@@ -0,0 +1,59 @@
+from commands import reannounce
+
+
+def delays(scheduler, torrent_hash, count, state=None):
+    """
+    :return: delays after `count` reannounces of a torrent, each sent once it is due
+    """
+    now = 0
+    result = []
+    for _ in range(count):
+        assert scheduler.is_due(torrent_hash, now, state)
+        scheduler.schedule(torrent_hash, now, state)
+        due = scheduler.next_due()
+        result.append(due - now)
+        assert not scheduler.is_due(torrent_hash, due - 1, state)
+        now = due
+    return result
+
+
+def test_first_retries_keep_the_interval():
+    scheduler = reannounce.Scheduler(5, 60, 3)
+    assert delays(scheduler, "a", 8) == [5, 5, 5, 10, 20, 40, 60, 60]
+
+
+def test_tracker_change_starts_over():
+    scheduler = reannounce.Scheduler(5, 60, 1)
+    assert delays(scheduler, "a", 4, state="down") == [5, 10, 20, 40]
+
+    # Due at once, long before its timer, and back to the interval
+    assert scheduler.is_due("a", 0, "unregistered")
+    assert delays(scheduler, "a", 2, state="unregistered") == [5, 10]
+
+
+def test_recovered_torrents_start_over():
+    scheduler = reannounce.Scheduler(5, 60, 1)
+    scheduler.observe({"a"})
+    delays(scheduler, "a", 3)
+
+    scheduler.observe(set())
+    assert scheduler.is_due("a", 0)
+    assert delays(scheduler, "a", 2) == [5, 10]
+
+
+def test_pass_interval_backs_off_while_nothing_stalls():
+    scheduler = reannounce.Scheduler(5, 60, 1)
+    assert scheduler.observe({"a"})
+    assert scheduler.interval == 5
+    assert not scheduler.observe({"a"})
+    assert not scheduler.observe({"a"})
+    assert scheduler.interval == 20
+    assert scheduler.delay(0) == 20
+
+    # A torrent due earlier wakes the loop up, never sooner than the interval
+    scheduler.schedule("a", 0)
+    assert scheduler.delay(0) == 5
+    assert scheduler.delay(100) == 5
+
+    assert scheduler.observe({"a", "b"})
+    assert scheduler.interval == 5
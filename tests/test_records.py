@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import records
+
+ITEMS = [
+    {"hash": "a", "name": 'Film (2001) – Müller \\ "cut"', "size": 123456, "tags": ""},
+    {"hash": "b", "name": "日本語 🎬", "ratio": -1.5e-3, "trackers": [{"msg": ""}]},
+    12345,
+    "x",
+    None,
+]
+
+
+def decode(chunks):
+    decoder = records.ArrayDecoder()
+    items = []
+    for chunk in chunks:
+        items.extend(decoder.feed(chunk))
+    items.extend(decoder.feed(b"", final=True))
+    return items
+
+
+def test_every_split_point():
+    data = json.dumps(ITEMS, ensure_ascii=False, indent=1).encode()
+
+    # Splits mid-string, mid-escape, mid-number and mid-UTF-8 sequence
+    for i in range(len(data) + 1):
+        assert decode([data[:i], data[i:]]) == ITEMS, i
+
+
+def test_byte_by_byte():
+    data = json.dumps(ITEMS, ensure_ascii=False).encode()
+
+    assert decode(data[i : i + 1] for i in range(len(data))) == ITEMS
+
+
+def test_elements_are_returned_as_they_complete():
+    decoder = records.ArrayDecoder()
+
+    assert decoder.feed(b' [{"a": 1}, {"b"') == [{"a": 1}]
+    assert decoder.buffer == '{"b"'
+    assert decoder.feed(b": 2}]") == [{"b": 2}]
+    assert decoder.feed(b"\n", final=True) == []
+    assert decoder.feed(b"[]", final=True) == []
+
+
+def test_empty_array():
+    assert decode([b"[", b" ]"]) == []
+
+
+@pytest.mark.parametrize("data", [b"", b"[1, 2", b'[{"a": 1}', b'["x'])
+def test_truncated_array(data):
+    with pytest.raises(ValueError):
+        decode([data])
+
+
+def test_not_an_array():
+    with pytest.raises(ValueError):
+        records.ArrayDecoder().feed(b'{"a": 1}')
@@ -0,0 +1,88 @@
+import pytest
+import qbittorrentapi
+from conftest import torrent, tracker
+
+import columns
+import records
+import rules
+
+PSEUDO = dict(url="** [DHT] **", status=2, tier=-1, msg="")
+NOW = 1_700_000_000 + 10 * 86400
+
+TORRENTS = {
+    "a": torrent(tags="expired, keep", content_path="/data/tv/Show.S01"),
+    "b": torrent(
+        category="movies",
+        content_path="/data/movies/Film (2001)",
+        tracker="https://other.example.net/announce",
+    ),
+    "c": torrent(state="stalledUP", tracker="", ratio=None, tags="not-expired"),
+}
+TRACKERS = {
+    "a": [PSEUDO, tracker()],
+    "b": [PSEUDO, tracker(url="https://other.example.net/announce")],
+    "c": [PSEUDO, tracker(status=4, msg="Unregistered torrent")],
+}
+
+
+def batches():
+    """
+    :return: the torrents as records and as `TorrentDictionary`
+    """
+    data = [dict(t, hash=h, trackers=TRACKERS[h]) for h, t in TORRENTS.items()]
+    record = records.record_type(tuple(TORRENTS["a"]) + ("trackers",))
+    return [
+        [record(d) for d in data],
+        [qbittorrentapi.TorrentDictionary(d, client=None) for d in data],
+    ]
+
+
+def site(url):
+    return {"https://tracker.example.org/announce": "example"}.get(url)
+
+
+def matching(condition):
+    results = []
+    for batch in batches():
+        ruleset = rules.RuleSet([dict(tag="x", when=condition)])
+        found = ruleset.evaluate(columns.Columns(batch, site, NOW))
+        results.append(sorted(found["x"]))
+    # Records and dictionaries give the same result
+    assert results[0] == results[1]
+    return results[0]
+
+
+@pytest.mark.parametrize(
+    "condition, expected",
+    [
+        ({"category": "tv"}, ["a", "c"]),
+        ({"category": {"!=": "tv"}}, ["b"]),
+        ({"category": ["movies", "music"]}, ["b"]),
+        ({"category": {"not_in": ["movies", "music"]}}, ["a", "c"]),
+        ({"category": {"<": "n"}}, ["b"]),
+        ({"content_path": {"contains": "FILM"}}, ["b"]),
+        ({"content_path": {"matches": r"s\d\d$"}}, ["a"]),
+        ({"tags": {"contains": "Expired"}}, ["a"]),
+        ({"site": "example"}, ["a", "c"]),
+        ({"site": ""}, ["b"]),
+        ({"message": {"contains": "unregistered"}}, ["c"]),
+        ({"working": False}, ["c"]),
+        ({"not": {"working": True}}, ["c"]),
+        ({"ratio": {">=": 1}}, ["a", "b"]),
+        ({"added_days": {">": 9}}, ["a", "b", "c"]),
+        ({"any": [{"state": "stalledUP"}, {"category": "movies"}]}, ["b", "c"]),
+    ],
+)
+def test_conditions(condition, expected):
+    assert matching(condition) == expected
+
+
+def test_records_share_tracker_lists():
+    record = records.record_type(("trackers",))
+    first = record(dict(hash="a", trackers=[PSEUDO, tracker()]))
+    second = record(dict(hash="b", trackers=[PSEUDO, tracker()]))
+    other = record(dict(hash="c", trackers=[PSEUDO, tracker(msg="down")]))
+
+    assert first.trackers is second.trackers
+    assert other.trackers[1].msg == "down"
+    assert record(dict(hash="d")).trackers is None
@@ -0,0 +1,135 @@
+from conftest import torrent, tracker
+
+import snapshot
+
+
+def full(torrents, rid=1, **extra):
+    return dict(rid=rid, full_update=True, torrents=torrents, **extra)
+
+
+def synced(client, torrents=None):
+    """
+    :return: snapshot after a first full update of `torrents`
+    """
+    torrents = torrents or {"a": torrent(), "b": torrent(name="other")}
+    client.trackers = {h: [tracker()] for h in torrents}
+    client.responses.append(
+        full(torrents, categories={"tv": {"savePath": "/data/tv"}}, tags=["x"])
+    )
+    snap = snapshot.Snapshot()
+    snap.update(client)
+    client.info_calls.clear()
+    return snap
+
+
+def test_first_update_fetches_everything(client):
+    client.trackers = {"a": [tracker()]}
+    client.responses.append(full({"a": torrent()}, tags=["x"]))
+    snap = snapshot.Snapshot()
+
+    assert snap.update(client) == {"a"}
+    assert client.info_calls == [["a"]]
+    assert snap.rid == 1
+    assert snap.tags == {"x"}
+    assert snap.trackers["a"] == [tracker()]
+    assert snap.torrents["a"]["name"] == "show"
+    assert set(snap.torrents["a"]) == set(snapshot.STORED_FIELDS)
+
+
+def test_partial_update(client):
+    snap = synced(client)
+    client.responses.append(
+        dict(
+            rid=2,
+            torrents={"a": {"category": "movies"}, "c": torrent()},
+            torrents_removed=["b"],
+            tags_removed=["x"],
+        )
+    )
+    client.trackers["c"] = [tracker()]
+
+    assert snap.update(client) == {"a", "c"}
+    assert client.rids[-1] == 1
+    assert snap.rid == 2
+    assert set(snap.torrents) == {"a", "c"}
+    assert snap.torrents["a"]["category"] == "movies"
+    assert snap.torrents["a"]["name"] == "show"
+    assert "b" not in snap.trackers
+    assert snap.tags == set()
+    # Only the new torrent needs its trackers
+    assert client.info_calls == [["c"]]
+
+
+def test_volatile_counters_do_not_change_a_torrent(client):
+    snap = synced(client)
+    client.responses.append(
+        dict(
+            rid=2,
+            torrents={
+                "a": dict(ratio=2.5, seeding_time=7200, num_seeds=3, num_complete=50)
+            },
+        )
+    )
+
+    assert snap.update(client) == set()
+    assert client.info_calls == []
+    # The values are still kept current
+    assert snap.torrents["a"]["ratio"] == 2.5
+    assert snap.torrents["a"]["seeding_time"] == 7200
+
+
+def test_tracker_triggers_refresh_trackers(client):
+    snap = synced(client)
+    client.responses.append(dict(rid=2, torrents={"a": dict(tracker="")}))
+    client.trackers["a"] = [tracker(status=4, msg="unregistered torrent")]
+
+    assert snap.update(client) == {"a"}
+    assert client.info_calls == [["a"]]
+    assert snap.trackers["a"][0]["msg"] == "unregistered torrent"
+
+
+def test_unchanged_values_are_ignored(client):
+    snap = synced(client)
+    client.responses.append(dict(rid=2, torrents={"a": dict(state="stalledUP")}))
+
+    assert snap.update(client) == {"a"}
+    client.responses.append(dict(rid=3, torrents={"b": dict(trackers_count=1)}))
+    assert snap.update(client) == set()
+
+
+def test_full_update_is_compared_with_previous_records(client):
+    torrents = {"a": torrent(), "b": torrent(name="other")}
+    snap = synced(client, torrents)
+    # A new session starts again with a full update
+    client.responses.append(
+        full(
+            {"a": torrent(ratio=3.0), "c": torrent(name="new")},
+            rid=1,
+            categories={"tv": {"savePath": "/data/tv"}},
+        )
+    )
+    client.trackers["c"] = [tracker()]
+
+    assert snap.update(client) == {"c"}
+    assert set(snap.torrents) == {"a", "c"}
+    assert set(snap.trackers) == {"a", "c"}
+    assert snap.torrents["a"]["ratio"] == 3.0
+    assert snap.categories == {"tv": {"savePath": "/data/tv"}}
+    assert snap.tags == set()
+    assert client.info_calls == [["c"]]
+
+
+def test_update_without_trackers(client):
+    snap = synced(client)
+    client.responses.append(dict(rid=2, torrents={"a": dict(state="stalledUP")}))
+
+    assert snap.update(client, trackers=False) == {"a"}
+    assert client.info_calls == []
+
+
+def test_round_trip(client):
+    snap = synced(client)
+    copy = snapshot.Snapshot(snap.to_dict())
+    assert copy.to_dict() == snap.to_dict()
+    assert len(copy) == 2
+    assert copy.count({"uploading"}) == 2
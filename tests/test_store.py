@@ -0,0 +1,159 @@
+import sqlite3
+
+import pytest
+from conftest import torrent, tracker
+
+import store
+
+
+def full(torrents, rid=1, **extra):
+    return dict(rid=rid, full_update=True, torrents=torrents, **extra)
+
+
+@pytest.fixture
+def db(tmp_path):
+    return str(tmp_path / "state" / "qbtools.db")
+
+
+def synced(client, db):
+    client.trackers = {"a": [tracker()], "b": [tracker(msg="slow down")]}
+    client.responses.append(
+        full(
+            {"a": torrent(tags="x, y"), "b": torrent(category="movies")},
+            categories={"tv": {"savePath": "/data/tv"}, "movies": {}},
+            tags=["x", "y"],
+            server_state={"dl_info_speed": 1},
+        )
+    )
+    state = store.Store(db)
+    state.update(client)
+    client.info_calls.clear()
+    return state
+
+
+def test_full_update(client, db):
+    state = synced(client, db)
+
+    assert len(state) == 2
+    assert state.rid == 1
+    assert state.tags == {"x", "y"}
+    assert state.categories["tv"] == {"name": "tv", "savePath": "/data/tv"}
+    assert state.server_state == {"dl_info_speed": 1}
+    assert state.trackers() == {"a": [tracker()], "b": [tracker(msg="slow down")]}
+    assert state.count({"uploading"}) == 2
+
+
+def test_queries(client, db):
+    state = synced(client, db)
+
+    def hashes(**query):
+        return sorted(t.hash for t in state.torrents_info(None, **query))
+
+    assert hashes() == ["a", "b"]
+    assert hashes(category="movies") == ["b"]
+    assert hashes(tag="y") == ["a"]
+    assert hashes(state="stalledUP") == []
+    assert hashes(where=lambda r: r["category"] == "tv") == ["a"]
+    assert hashes(hashes=["b", "missing"]) == ["b"]
+    assert state.torrent(None, "b")["trackers"] == [tracker(msg="slow down")]
+    with pytest.raises(KeyError):
+        state.torrent(None, "missing")
+
+
+def test_partial_update(client, db):
+    state = synced(client, db)
+    client.responses.append(
+        dict(
+            rid=2,
+            torrents={"a": dict(tags="z"), "c": torrent(name="new")},
+            torrents_removed=["b"],
+            categories_removed=["movies"],
+            tags=["z"],
+            tags_removed=["x"],
+        )
+    )
+    client.trackers["c"] = [tracker()]
+
+    assert state.update(client) == {"a", "c"}
+    assert state.rid == 2
+    assert sorted(state.records()) == ["a", "c"]
+    assert [t.hash for t in state.torrents_info(None, tag="z")] == ["a"]
+    assert state.torrents_info(None, tag="x") == []
+    assert set(state.categories) == {"tv"}
+    assert state.tags == {"y", "z"}
+    assert set(state.trackers()) == {"a", "c"}
+    assert client.info_calls == [["c"]]
+
+
+def test_volatile_counters_do_not_change_a_torrent(client, db):
+    state = synced(client, db)
+    client.responses.append(
+        dict(rid=2, torrents={"a": dict(ratio=4.0, seeding_time=9000, num_seeds=7)})
+    )
+
+    assert state.update(client) == set()
+    assert state.records(["a"])["a"]["ratio"] == 4.0
+    assert client.info_calls == []
+
+
+def test_reopened_store_diffs_full_update(client, db):
+    synced(client, db).close()
+    # A new session gets a full update with the same torrents
+    client.responses.append(
+        full({"a": torrent(tags="x, y"), "b": torrent(category="movies")})
+    )
+
+    state = store.Store(db)
+    assert state.update(client) == set()
+    assert client.info_calls == []
+    assert len(state) == 2
+
+
+def test_stale_trackers_are_refreshed_later(client, db):
+    state = synced(client, db)
+    client.responses.append(dict(rid=2, torrents={"a": dict(tracker="")}))
+    client.trackers["a"] = [tracker(status=4, msg="unregistered torrent")]
+
+    assert state.update(client, trackers=False) == {"a"}
+    assert client.info_calls == []
+
+    client.responses.append(dict(rid=3))
+    assert state.update(client) == {"a"}
+    assert client.info_calls == [["a"]]
+    assert state.trackers(["a"])["a"][0]["msg"] == "unregistered torrent"
+
+
+def test_schema_migration(client, db, tmp_path):
+    # A store created before trackers_count was kept
+    fields = [f for f in store.STORED_FIELDS if f != "trackers_count"]
+    (tmp_path / "state").mkdir()
+    old = sqlite3.connect(db)
+    old.execute(f"CREATE TABLE torrents (hash TEXT PRIMARY KEY, {', '.join(fields)})")
+    old.execute(
+        f"INSERT INTO torrents (hash, {', '.join(fields)}) "
+        f"VALUES ({', '.join('?' * (len(fields) + 1))})",
+        ["a", *(torrent()[f] for f in fields)],
+    )
+    old.commit()
+    old.close()
+
+    state = store.Store(db)
+    assert state.records()["a"]["trackers_count"] is None
+
+    client.trackers = {"a": [tracker()]}
+    client.responses.append(full({"a": torrent()}))
+    # The new column is filled, which invalidates the tracker list once
+    assert state.update(client) == {"a"}
+    assert state.records()["a"]["trackers_count"] == 1
+
+
+def test_files_and_retries(db):
+    state = store.Store(db)
+    state.save_files({"a": ["x.mkv", "y.nfo"], "b": []})
+    state.save_retries("stalledDL", {"a": 2})
+    state.save_retries("metaDL", {"b": 1})
+    state.save_retries("stalledDL", {"c": 1})
+
+    assert state.files() == {"a": ["x.mkv", "y.nfo"]}
+    assert state.retries("stalledDL") == {"c": 1}
+    assert state.retries("metaDL") == {"b": 1}